@@ -24,3 +24,10 @@ class ProductAdmin(admin.ModelAdmin):
             return 'Low'
         return 'Ok'
 # admin.site.register(models.Product, ProductAdmin)
+
+
+@admin.register(models.TaxRate)
+class TaxRateAdmin(admin.ModelAdmin):
+    list_display = ['collection', 'region', 'rate', 'last_updated']
+    list_select_related = ['collection']
+    ordering = ['collection', 'region']
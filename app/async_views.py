@@ -0,0 +1,207 @@
+"""
+Async read paths for the catalog and cart endpoints, mounted under ASGI by
+storefront/asgi_urls.py.
+
+Each view drives its DRF viewset for the parts that don't touch the
+database: filtering, pagination links, serializers, cache keys and
+response headers. Details are fetched with the async ORM, list pages by
+the viewset's paginator in a worker thread.
+
+Only GETs without an Authorization header that negotiate to JSON are served
+here. Everything else (writes, the browsable API, authenticated requests,
+invalid filters or pages, 404s) goes to the sync view in a worker thread.
+Both servers therefore return the same responses. Any other exception is a
+bug and propagates.
+
+Off unless ASYNC_READ_VIEWS is set: on Django 4.1 the async ORM runs its
+queries on one shared thread, which `manage.py bench_asgi` measures slower
+than WSGI.
+"""
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.http import Http404
+from rest_framework.exceptions import APIException, NotAcceptable, NotFound
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.response import Response
+from .caching import CachedResponseMixin, record
+from .conditional import ConditionalGetMixin, check_preconditions
+from .fastlist import ValuesListMixin
+from .views import CartViewSet, CollectionViewSet, ProductViewSet
+
+
+class Fallback(Exception):
+    """Hands the request over to the sync view."""
+
+
+class AsyncReadView:
+    viewset_class = None
+    # The method -> action mapping the router gives the sync view
+    actions = None
+    detail = False
+    suffix = None
+
+    def __init__(self):
+        self.basename = self.viewset_class.queryset.model._meta.object_name.lower()
+        self.sync_view = self.viewset_class.as_view(
+            self.actions, basename=self.basename, detail=self.detail, suffix=self.suffix)
+
+    @classmethod
+    def as_view(cls):
+        self = cls()
+
+        async def view(request, *args, **kwargs):
+            return await self.dispatch(request, *args, **kwargs)
+        # What the browsable API's breadcrumbs (and CSRF) read off a DRF view
+        for attribute in ('cls', 'initkwargs', 'actions', 'csrf_exempt'):
+            setattr(view, attribute, getattr(self.sync_view, attribute))
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method == 'GET' and 'HTTP_AUTHORIZATION' not in request.META:
+            view = self.initialize(request, *args, **kwargs)
+            if view is not None:
+                try:
+                    return await self.respond(view)
+                except (Fallback, Http404, InvalidPage):
+                    pass
+        return await sync_to_async(self.sync_view)(request, *args, **kwargs)
+
+    def initialize(self, request, *args, **kwargs):
+        """Set up the viewset the way as_view() would, or None for non-JSON."""
+        view = self.viewset_class(
+            action=self.actions['get'], basename=self.basename, detail=self.detail,
+            suffix=self.suffix, args=args, kwargs=kwargs, format_kwarg=None)
+        for method, action in self.actions.items():
+            setattr(view, method, getattr(view, action))
+        view.headers = view.default_response_headers
+
+        view.request = Request(
+            request, parsers=view.get_parsers(),
+            negotiator=view.get_content_negotiator(),
+            parser_context=view.get_parser_context(request))
+        try:
+            renderer, media_type = view.perform_content_negotiation(view.request)
+        except NotAcceptable:
+            return None
+        if not isinstance(renderer, JSONRenderer):
+            return None
+        view.request.accepted_renderer = renderer
+        view.request.accepted_media_type = media_type
+        return view
+
+    async def respond(self, view):
+        request = view.request
+        key = None
+        if isinstance(view, CachedResponseMixin):
+            key, entry = await sync_to_async(view.lookup_cache)(request)
+            if entry is not None:
+                record(view.cache_namespace, 'hit')
+                return view.finalize_response(
+                    request, view.cache_hit_response(request, entry))
+
+        validators = {}
+        response = None
+        if isinstance(view, ConditionalGetMixin):
+            validators = await self.call_view(self.get_validators, view)
+            if validators:
+                response = check_preconditions(request, validators)
+        if response is None:
+            response = Response(await self.get_data(view), headers=validators)
+
+        if key is not None:
+            # Only now, as a fallback records its own lookup
+            record(view.cache_namespace, 'miss')
+            await sync_to_async(view.store_response)(key, response)
+        return view.finalize_response(request, response)
+
+    async def call_view(self, function, *args):
+        # For the viewset methods that filter, whose validation errors the
+        # sync view turns into error responses
+        try:
+            return await sync_to_async(function)(*args)
+        except APIException:
+            raise Fallback
+
+    async def filter_queryset(self, view):
+        return await self.call_view(view.filter_queryset, view.get_queryset())
+
+    def get_validators(self, view):
+        raise NotImplementedError
+
+    async def get_data(self, view):
+        raise NotImplementedError
+
+
+class AsyncListView(AsyncReadView):
+    actions = {'get': 'list', 'post': 'create'}
+    suffix = 'List'
+
+    def get_validators(self, view):
+        return view.get_list_validators(view.request)
+
+    def serialize(self, view, objs):
+        if isinstance(view, ValuesListMixin):
+            return view.represent_values(objs)
+        return view.get_serializer(objs, many=True).data
+
+    async def get_data(self, view):
+        queryset = await self.filter_queryset(view)
+        if isinstance(view, ValuesListMixin):
+            queryset = view.get_values_queryset(queryset)
+        paginator = view.paginator
+        if paginator is None:
+            return self.serialize(view, [obj async for obj in queryset])
+        try:
+            page = await sync_to_async(paginator.paginate_queryset)(
+                queryset, view.request, view=view)
+        except NotFound:
+            raise Fallback
+        return paginator.get_paginated_response(self.serialize(view, page)).data
+
+
+class AsyncDetailView(AsyncReadView):
+    detail = True
+    suffix = 'Instance'
+
+    def get_validators(self, view):
+        return view.get_detail_validators(view.request)
+
+    async def get_data(self, view):
+        lookup_url_kwarg = view.lookup_url_kwarg or view.lookup_field
+        queryset = await self.filter_queryset(view)
+        try:
+            # What get_object_or_404 turns into a 404
+            queryset = queryset.filter(**{view.lookup_field: view.kwargs[lookup_url_kwarg]})
+        except (TypeError, ValueError, ValidationError):
+            raise Http404
+        obj = await queryset.afirst()
+        if obj is None:
+            raise Http404
+        return view.get_serializer(obj).data
+
+
+class ProductListView(AsyncListView):
+    viewset_class = ProductViewSet
+
+
+class ProductDetailView(AsyncDetailView):
+    viewset_class = ProductViewSet
+    actions = {'get': 'retrieve', 'put': 'update',
+               'patch': 'partial_update', 'delete': 'destroy'}
+
+
+class CollectionListView(AsyncListView):
+    viewset_class = CollectionViewSet
+
+
+class CartDetailView(AsyncDetailView):
+    viewset_class = CartViewSet
+    actions = {'get': 'retrieve', 'delete': 'destroy'}
+
+
+product_list = ProductListView.as_view()
+product_detail = ProductDetailView.as_view()
+collection_list = CollectionListView.as_view()
+cart_detail = CartDetailView.as_view()
@@ -0,0 +1,55 @@
+"""
+JWT authentication that doesn't touch the database.
+
+Tokens issued through /auth/jwt/create/ carry the user's customer id and
+staff flag as claims. Refreshed access tokens copy them from the refresh
+token. ClaimsJWTAuthentication trusts those claims and returns a TokenUser
+instead of loading the User row, and get_customer_id() reads the customer
+id from the token instead of querying Customer.
+
+Tokens issued before the claims existed have no customer_id. For them the
+view falls back to the regular lookups (User row, then Customer row) until
+they expire.
+
+Because the claims are trusted, a change to is_staff or is_active only
+takes effect once the user gets a new token (ACCESS_TOKEN_LIFETIME).
+"""
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from .models import Customer
+
+CUSTOMER_ID_CLAIM = 'customer_id'
+STAFF_CLAIM = 'is_staff'
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        customer_id = Customer.objects.filter(user_id=user.id) \
+            .values_list('id', flat=True).first()
+        if customer_id is not None:
+            token[CUSTOMER_ID_CLAIM] = customer_id
+        token[STAFF_CLAIM] = user.is_staff
+        return token
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if CUSTOMER_ID_CLAIM in validated_token:
+            return TokenUser(validated_token)
+        return super().get_user(validated_token)
+
+
+def get_customer_id(user):
+    """
+    The customer id of an authenticated user, read from the token when it
+    carries the claim. Raises Customer.DoesNotExist when the user has no
+    customer.
+    """
+    if isinstance(user, TokenUser):
+        customer_id = user.token.get(CUSTOMER_ID_CLAIM)
+        if customer_id is not None:
+            return customer_id
+    return Customer.objects.values_list('id', flat=True).get(user_id=user.id)
@@ -0,0 +1,62 @@
+"""
+Helpers shared by the benchmark management commands (bench_*).
+
+Benchmarks run against a throwaway test database created from the
+configured one, never against the real data.
+"""
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from django.db import connection
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds."""
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+    return {
+        'count': len(samples),
+        'p50_ms': ms(percentile(samples, 0.50)),
+        'p95_ms': ms(percentile(samples, 0.95)),
+        'p99_ms': ms(percentile(samples, 0.99)),
+        'max_ms': ms(max(samples) if samples else None),
+    }
+
+
+@contextmanager
+def benchmark_database(keepdb=False):
+    """
+    Point the default connection at a fresh test database for the duration
+    of the block. In-memory SQLite can't be shared between threads, so SQLite
+    benchmarks get a temporary file instead.
+    """
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    temp_dir = None
+    if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+        temp_dir = tempfile.TemporaryDirectory()
+        test_settings['NAME'] = os.path.join(temp_dir.name, 'benchmark.sqlite3')
+        connection.settings_dict.setdefault('OPTIONS', {}).setdefault('timeout', 30)
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+
+def write_results(path, results):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2, default=str)
@@ -0,0 +1,176 @@
+"""
+Read-through response cache for the catalog endpoints.
+
+Entries are keyed on the absolute URL with its query string sorted, so
+filters, search, ordering and page all get their own entry. Every key also
+embeds the current generation of the namespaces the response depends on:
+
+    products        any product list page
+    product:<id>    one product's detail
+    products:all    every product detail, bumped by bulk updates
+    collections / collection:<id> / collections:all    the same for collections
+
+Invalidation bumps a generation, which orphans the old entries without
+having to find them. The entries then expire on their own. Bumps are deferred
+until the surrounding transaction commits, so a concurrent reader can't
+cache rows that are about to change.
+"""
+import hashlib
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+from .conditional import check_preconditions
+
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified')
+
+_stats = defaultdict(Counter)
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def _generation_key(namespace):
+    return 'catalog:gen:' + namespace
+
+
+def get_generations(namespaces):
+    cache = get_cache()
+    keys = [_generation_key(namespace) for namespace in namespaces]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            # Start evicted or brand new namespaces from a fresh value so
+            # they can't collide with entries written under an older one.
+            cache.add(key, time.time_ns(), timeout=None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def bump_generations(namespaces):
+    cache = get_cache()
+    for namespace in namespaces:
+        key = _generation_key(namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), timeout=None)
+
+
+def invalidate(*namespaces):
+    transaction.on_commit(lambda: bump_generations(namespaces))
+
+
+def invalidate_products(product_ids=None):
+    if product_ids is None:
+        invalidate('products', 'products:all')
+    else:
+        invalidate('products', *['product:%s' % pk for pk in product_ids])
+
+
+def invalidate_collections(collection_ids=None):
+    if collection_ids is None:
+        invalidate('collections', 'collections:all')
+    else:
+        invalidate('collections', *['collection:%s' % pk for pk in collection_ids])
+
+
+def record(name, outcome):
+    with _stats_lock:
+        _stats[name][outcome] += 1
+
+
+def get_cache_stats():
+    with _stats_lock:
+        return {name: dict(counts) for name, counts in _stats.items()}
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class CachedResponseMixin:
+    """
+    Serves list and retrieve from the catalog cache. Set `cache_namespace`
+    to the plural namespace, e.g. 'products', and `cache_object_namespace`
+    to the per-object one, e.g. 'product'.
+
+    Put it before ConditionalGetMixin: the ETag/Last-Modified headers are
+    cached with the data, so a conditional request that hits the cache is
+    answered without touching the database.
+    """
+    cache_namespace = None
+    cache_object_namespace = None
+
+    def get_cache_dependencies(self):
+        if self.action == 'retrieve':
+            lookup = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+            if not lookup.isdigit() or lookup != str(int(lookup)):
+                # /products/007/ would never see the bumps for product:7
+                return None
+            return ['%s:all' % self.cache_namespace,
+                    '%s:%s' % (self.cache_object_namespace, lookup)]
+        return [self.cache_namespace]
+
+    def get_cache_key(self, request, dependencies):
+        generations = get_generations(dependencies)
+        query = urlencode(sorted(request.query_params.lists()), doseq=True)
+        url = '%s?%s %s' % (request.build_absolute_uri(request.path), query,
+                            request.accepted_media_type)
+        digest = hashlib.md5(url.encode('utf-8')).hexdigest()
+        return 'catalog:%s:%s:%s' % (
+            self.cache_namespace,
+            '.'.join(str(generation) for generation in generations),
+            digest)
+
+    def lookup_cache(self, request):
+        """
+        Return (key, entry) for the request. The key is None when the request
+        isn't cached, the entry is None on a miss. The caller records the
+        outcome once it answers the request.
+        """
+        timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+        dependencies = self.get_cache_dependencies()
+        if not timeout or dependencies is None:
+            return None, None
+        key = self.get_cache_key(request, dependencies)
+        return key, get_cache().get(key)
+
+    def cache_hit_response(self, request, entry):
+        data, validators = entry
+        response = check_preconditions(request, validators) \
+            or Response(data, headers=validators)
+        response['X-Cache'] = 'HIT'
+        return response
+
+    def store_response(self, key, response):
+        if response.status_code == 200:
+            validators = {header: response[header]
+                          for header in VALIDATOR_HEADERS if header in response}
+            get_cache().set(key, (response.data, validators),
+                            getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300))
+        response['X-Cache'] = 'MISS'
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        key, entry = self.lookup_cache(request)
+        if key is None:
+            return handler(request, *args, **kwargs)
+        record(self.cache_namespace, 'miss' if entry is None else 'hit')
+        if entry is not None:
+            return self.cache_hit_response(request, entry)
+        response = handler(request, *args, **kwargs)
+        self.store_response(key, response)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
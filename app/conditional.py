@@ -0,0 +1,87 @@
+"""
+Conditional GET for the catalog endpoints.
+
+The validators come from last_updated alone: MAX(last_updated) and COUNT(*)
+of the filtered queryset for a list, the row's last_updated for a detail.
+A matching If-None-Match or If-Modified-Since therefore gets its 304 without
+loading or serializing any rows.
+
+List responses only carry an ETag. Deleting a row lowers the count but
+not MAX(last_updated), so a list Last-Modified could wrongly answer 304.
+"""
+import hashlib
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+
+def make_etag(*parts):
+    digest = hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8'))
+    return '"%s"' % digest.hexdigest()
+
+
+def check_preconditions(request, validators):
+    """
+    Return the 304 (or 412) response the validators call for, or None when
+    the request has to be served in full.
+    """
+    last_modified = validators.get('Last-Modified')
+    placeholder = HttpResponse(headers=validators)
+    response = get_conditional_response(
+        request,
+        etag=validators.get('ETag'),
+        last_modified=last_modified and parse_http_date_safe(last_modified),
+        response=placeholder)
+    return None if response is placeholder else response
+
+
+class ConditionalGetMixin:
+    last_modified_field = 'last_updated'
+
+    def get_list_validators(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        stats = queryset.aggregate(
+            last_modified=Max(self.last_modified_field), count=Count('pk'))
+        last_modified = stats['last_modified']
+        return {'ETag': make_etag(
+            request.get_full_path(), request.accepted_media_type,
+            last_modified and last_modified.isoformat(), stats['count'])}
+
+    def get_detail_validators(self, request):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            last_modified = self.get_queryset() \
+                .filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]}) \
+                .values_list(self.last_modified_field, flat=True).first()
+        except (TypeError, ValueError, ValidationError):
+            last_modified = None
+        if last_modified is None:
+            # Let retrieve() produce its 404
+            return {}
+        return {
+            'ETag': make_etag(
+                request.get_full_path(), request.accepted_media_type,
+                last_modified.isoformat()),
+            'Last-Modified': http_date(last_modified.timestamp()),
+        }
+
+    def conditional_response(self, validators, handler, request, *args, **kwargs):
+        if validators:
+            response = check_preconditions(request, validators)
+            if response is not None:
+                return response
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            for header, value in validators.items():
+                response[header] = value
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(
+            self.get_list_validators(request), super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(
+            self.get_detail_validators(request), super().retrieve, request, *args, **kwargs)
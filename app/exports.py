@@ -0,0 +1,92 @@
+"""
+Order exports for accounting, as CSV or JSON lines.
+
+Orders are read in keyset chunks on their id: a chunk of orders, then the
+items of those orders, both by primary key. Memory stays flat however many
+orders match, with a bounded number of queries per chunk and no long-lived
+cursor or transaction. Django's iterator() only streams from a server-side
+cursor on PostgreSQL, while mysqlclient buffers whole results.
+
+CSV has one row per line item, and the order columns repeat on each row. An
+order without items still gets one row, with empty item columns. JSON lines
+has one order per line, with its items nested the way the orders API nests
+them.
+"""
+import csv
+from datetime import datetime, time, timedelta
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+from .models import Order, OrderItem
+
+FORMATS = ['csv', 'jsonl']
+CONTENT_TYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+CSV_HEADER = ['order_id', 'placed_at', 'customer_id', 'payment_status',
+              'item_id', 'product_id', 'quantity', 'unit_price']
+
+
+def filter_orders(queryset, since=None, until=None, payment_status=None):
+    # since and until are dates, both included
+    if since is not None:
+        queryset = queryset.filter(
+            placed_at__gte=timezone.make_aware(datetime.combine(since, time.min)))
+    if until is not None:
+        queryset = queryset.filter(
+            placed_at__lt=timezone.make_aware(datetime.combine(until + timedelta(days=1), time.min)))
+    if payment_status is not None:
+        queryset = queryset.filter(payment_status=payment_status)
+    return queryset
+
+
+def iter_orders(chunk_size=2000, using=DEFAULT_DB_ALIAS, **filters):
+    """Yield (order, items) for the matching orders, as tuples, by order id."""
+    orders = filter_orders(Order.objects.using(using), **filters).order_by('id') \
+        .values_list('id', 'placed_at', 'customer_id', 'payment_status')
+    last_id = 0
+    while True:
+        chunk = list(orders.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        items = {}
+        for item in OrderItem.objects.using(using) \
+                .filter(order_id__in=[order[0] for order in chunk]).order_by('id') \
+                .values_list('order_id', 'id', 'product_id', 'quantity', 'unit_price'):
+            items.setdefault(item[0], []).append(item[1:])
+        for order in chunk:
+            yield order, items.get(order[0], [])
+        last_id = chunk[-1][0]
+
+
+class _Line:
+    # A file-like object for csv.writer that hands back what was written
+    def write(self, value):
+        return value
+
+
+def csv_lines(orders):
+    writer = csv.writer(_Line())
+    yield writer.writerow(CSV_HEADER)
+    for (order_id, placed_at, customer_id, payment_status), items in orders:
+        order = [order_id, placed_at.isoformat(), customer_id, payment_status]
+        for item in items or [[''] * 4]:
+            yield writer.writerow(order + list(item))
+
+
+def jsonl_lines(orders):
+    encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    for (order_id, placed_at, customer_id, payment_status), items in orders:
+        yield encoder.encode({
+            'id': order_id,
+            'customer': customer_id,
+            'placed_at': placed_at.isoformat(),
+            'payment_status': payment_status,
+            'items': [{'id': item_id, 'product': product_id, 'quantity': quantity,
+                       'unit_price': unit_price}
+                      for item_id, product_id, quantity, unit_price in items],
+        }) + '\n'
+
+
+def export_lines(file_format, **options):
+    """The export as an iterator of text lines."""
+    lines = csv_lines if file_format == 'csv' else jsonl_lines
+    return lines(iter_orders(**options))
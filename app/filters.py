@@ -1,8 +1,14 @@
-from django_filters.rest_framework import FilterSet
+from django_filters.rest_framework import FilterSet, NumberFilter
 from .models import Product
 
 
 class ProductFilter(FilterSet):
+    # An annotation (app/taxes.py), so not in Meta.fields
+    price_with_tax__gt = NumberFilter(field_name='price_with_tax', lookup_expr='gt',
+                                      label='Price with tax is greater than')
+    price_with_tax__lt = NumberFilter(field_name='price_with_tax', lookup_expr='lt',
+                                      label='Price with tax is less than')
+
     class Meta:
         model = Product
         fields = {
@@ -0,0 +1,43 @@
+import time
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+from app.models import DailySales, Order
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the DailySales rollup from the completed orders, one day per '
+            'transaction. Defaults to every day from the first order to today.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date.fromisoformat,
+                            help='First day to rebuild, YYYY-MM-DD')
+        parser.add_argument('--until', type=date.fromisoformat,
+                            help='Last day to rebuild, YYYY-MM-DD. Defaults to today.')
+
+    def handle(self, *args, **options):
+        until = options['until'] or timezone.localdate()
+        since = options['since']
+        if since is None:
+            first = Order.objects.aggregate(first=Min('placed_at'))['first']
+            if first is None:
+                self.stdout.write('There are no orders.')
+                return
+            since = timezone.localdate(first)
+        if since > until:
+            raise CommandError('--since is after --until.')
+
+        days = rows = 0
+        started = time.perf_counter()
+        day = since
+        while day <= until:
+            rows += DailySales.objects.rebuild_day(day)
+            days += 1
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{day}: {rows} rows so far')
+            day += timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {days} days from {since} to {until}, {rows} rows, '
+            f'in {time.perf_counter() - started:.1f}s.'))
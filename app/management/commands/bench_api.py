@@ -0,0 +1,178 @@
+import json
+import platform
+import time
+import django
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from app.bench import benchmark_database, summarize, write_results
+from app.models import Collection, Product
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the hot API endpoints with the test client on a throwaway '
+            'database filled by generate_dataset. Reports latency percentiles, queries '
+            'per request and throughput, and compares against an earlier run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100,
+                            help='Timed requests per scenario')
+        parser.add_argument('--warmup', type=int, default=5,
+                            help='Untimed requests per scenario before the timed ones')
+        parser.add_argument('--products', type=int, default=5_000)
+        parser.add_argument('--orders', type=int, default=2_000)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--cache', action='store_true',
+                            help='Keep the catalog response cache on')
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help='Only run this scenario (repeatable)')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--compare', metavar='BASELINE',
+                            help='Compare with the results JSON of an earlier run')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Relative p95 increase that counts as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help='Exit with an error when --compare finds a regression')
+
+    def handle(self, *args, **options):
+        self.options = options
+        overrides = {'DEBUG': False, 'ALLOWED_HOSTS': ['testserver']}
+        if not options['cache']:
+            overrides['CATALOG_CACHE_TIMEOUT'] = 0
+
+        scenarios = self.get_scenarios()
+        unknown = set(options['scenarios'] or []) - {name for name, _ in scenarios}
+        if unknown:
+            raise CommandError('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+
+        with benchmark_database(), override_settings(**overrides):
+            self.setup()
+            results = {}
+            for name, scenario in scenarios:
+                if not options['scenarios'] or name in options['scenarios']:
+                    results[name] = self.run(scenario)
+
+        results = {
+            'meta': {
+                'database': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'started_at': timezone.now().isoformat(),
+                'iterations': options['iterations'],
+                'products': options['products'],
+                'orders': options['orders'],
+                'cache': options['cache'],
+            },
+            'scenarios': results,
+        }
+        for name, result in results['scenarios'].items():
+            latency = result['latency']
+            self.stdout.write(
+                '%-18s p50 %8.2f  p95 %8.2f  p99 %8.2f ms  %6.1f queries  %7.1f req/s' % (
+                    name, latency['p50_ms'], latency['p95_ms'], latency['p99_ms'],
+                    result['queries']['mean'], result['requests_per_second']))
+        if options['output']:
+            write_results(options['output'], results)
+        if options['compare']:
+            self.compare(options['compare'], results)
+
+    def setup(self):
+        call_command('generate_dataset', seed=self.options['seed'],
+                     products=self.options['products'], orders=self.options['orders'],
+                     customers=max(self.options['orders'] // 10, 1), carts=0, reviews=0,
+                     search_index=True, verbosity=0)
+
+        self.client = APIClient()
+        get_user_model().objects.create_user(
+            username='bench', email='bench@example.com', password='bench')
+        token = self.client.post(
+            '/auth/jwt/create/', {'username': 'bench', 'password': 'bench'}).data['access']
+        self.auth = {'HTTP_AUTHORIZATION': 'JWT ' + token}
+
+        # Well stocked products, so no checkout runs out
+        self.product_ids = list(Product.objects.order_by('id').values_list('id', flat=True)[:20])
+        Product.objects.filter(pk__in=self.product_ids).update(inventory=10 ** 6)
+        self.collection_id = Collection.objects.order_by('-product_count').first().id
+        self.search_term = Product.objects.get(pk=self.product_ids[0]).title.split()[1]
+        self.cart_uuid = self.client.post('/store/carts/').data['cart_id']
+
+    def get_scenarios(self):
+        """(name, scenario) pairs. A scenario returns a request for iteration i."""
+        return [
+            ('product-list', lambda i: ('get', '/store/products/?page=%d' % (i % 5 + 1), None, {})),
+            ('product-filter', lambda i: (
+                'get', '/store/products/?collection_id=%d&unit_price__gt=%d'
+                % (self.collection_id, i % 50), None, {})),
+            ('product-search', lambda i: (
+                'get', '/store/products/?search=%s' % self.search_term, None, {})),
+            ('product-ordering', lambda i: (
+                'get', '/store/products/?ordering=-unit_price&page=%d' % (i % 5 + 1), None, {})),
+            ('collection-list', lambda i: ('get', '/store/collections/', None, {})),
+            ('cart-create', lambda i: ('post', '/store/carts/', None, {})),
+            ('cart-add-item', lambda i: (
+                'post', '/store/carts/%s/items/' % self.cart_uuid,
+                {'product_id': self.product_ids[i % len(self.product_ids)], 'quantity': 1}, {})),
+            ('checkout', self.checkout_request),
+            ('order-list', lambda i: ('get', '/store/orders/', None, self.auth)),
+        ]
+
+    def checkout_request(self, i):
+        # The cart being checked out is set up outside the timed request
+        cart_uuid = self.client.post('/store/carts/').data['cart_id']
+        for product_id in self.product_ids[i % 4::4][:3]:
+            self.client.post('/store/carts/%s/items/' % cart_uuid,
+                             {'product_id': product_id, 'quantity': 1})
+        return 'post', '/store/orders/', {'cart_uuid': cart_uuid}, self.auth
+
+    def run(self, scenario):
+        latencies = []
+        queries = []
+        statuses = {}
+        for i in range(self.options['warmup'] + self.options['iterations']):
+            method, path, data, extra = scenario(i)
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                response = getattr(self.client, method)(path, data, format='json', **extra)
+                elapsed = time.perf_counter() - started
+            if i < self.options['warmup']:
+                continue
+            latencies.append(elapsed)
+            queries.append(len(context.captured_queries))
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        return {
+            'latency': summarize(latencies),
+            'queries': {'mean': round(sum(queries) / len(queries), 2), 'max': max(queries)},
+            'requests_per_second': round(len(latencies) / sum(latencies), 1),
+            'status_codes': statuses,
+        }
+
+    def compare(self, path, results):
+        with open(path) as file:
+            baseline = json.load(file)['scenarios']
+        regressions = []
+        for name, result in results['scenarios'].items():
+            if name not in baseline:
+                continue
+            before, after = baseline[name], result
+            p95_change = after['latency']['p95_ms'] / before['latency']['p95_ms'] - 1
+            queries_change = after['queries']['mean'] - before['queries']['mean']
+            regressed = p95_change > self.options['threshold'] or queries_change > 0
+            if regressed:
+                regressions.append(name)
+            self.stdout.write('%-18s p95 %8.2f -> %8.2f ms (%+.0f%%)  queries %.1f -> %.1f%s' % (
+                name, before['latency']['p95_ms'], after['latency']['p95_ms'],
+                p95_change * 100, before['queries']['mean'], after['queries']['mean'],
+                '  REGRESSION' if regressed else ''))
+
+        if regressions:
+            message = 'Regressed: %s' % ', '.join(regressions)
+            if self.options['fail_on_regression']:
+                raise CommandError(message)
+            self.stderr.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS('No regressions.'))
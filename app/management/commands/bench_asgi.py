@@ -0,0 +1,106 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+from app.bench import benchmark_database, summarize, write_results
+from app.models import Cart, CartItem, Collection, Product
+
+
+class Command(BaseCommand):
+    help = ('Compares concurrent-request throughput of the read-only catalog endpoints '
+            'under the WSGI (sync views) and ASGI (async views) paths, in process, '
+            'on a throwaway database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=300,
+                            help='Requests per endpoint and server')
+        parser.add_argument('--concurrency', type=int, default=16,
+                            help='WSGI threads / ASGI requests in flight')
+        parser.add_argument('--products', type=int, default=200)
+        parser.add_argument('--cache', action='store_true',
+                            help='Keep the catalog response cache on')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        overrides = {'DEBUG': False, 'ALLOWED_HOSTS': ['testserver']}
+        if not options['cache']:
+            overrides['CATALOG_CACHE_TIMEOUT'] = 0
+
+        with benchmark_database(), override_settings(**overrides):
+            urls = self.setup(options)
+            results = {}
+            for name, url in urls.items():
+                results[name] = {
+                    'wsgi': self.run_wsgi(url, options),
+                    'asgi': self.run_asgi(url, options),
+                }
+
+        for name, servers in results.items():
+            for server, result in servers.items():
+                self.stdout.write('%-16s %s  %8.1f req/s  p50 %s ms  p99 %s ms' % (
+                    name, server, result['requests_per_second'],
+                    result['latency']['p50_ms'], result['latency']['p99_ms']))
+        if options['output']:
+            write_results(options['output'], results)
+
+    def setup(self, options):
+        collections = [Collection.objects.create(title='Collection %d' % i) for i in range(10)]
+        Product.objects.bulk_create([
+            Product(title='Product %d' % i, slug='product-%d' % i,
+                    description='Benchmark product %d' % i, unit_price=i % 100 + 1,
+                    inventory=100, collection=collections[i % len(collections)])
+            for i in range(options['products'])
+        ])
+        products = list(Product.objects.order_by('id')[:5])
+        cart = Cart.objects.create()
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=1) for product in products
+        ])
+        return {
+            'product-list': '/store/products/?ordering=unit_price',
+            'product-detail': '/store/products/%d/' % products[0].id,
+            'collection-list': '/store/collections/',
+            'cart-detail': '/store/carts/%s/' % cart.cart_id,
+        }
+
+    def summarize_run(self, latencies, elapsed, statuses):
+        if set(statuses) != {200}:
+            self.stderr.write(self.style.WARNING('Unexpected statuses: %s' % sorted(set(statuses))))
+        return {
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'latency': summarize(latencies),
+        }
+
+    def run_wsgi(self, url, options):
+        def request(_):
+            started = time.perf_counter()
+            response = Client().get(url)
+            return time.perf_counter() - started, response.status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            outcomes = list(executor.map(request, range(options['requests'])))
+        elapsed = time.perf_counter() - started
+        return self.summarize_run([latency for latency, _ in outcomes], elapsed,
+                                  [status for _, status in outcomes])
+
+    def run_asgi(self, url, options):
+        async def run():
+            client = AsyncClient()
+            semaphore = asyncio.Semaphore(options['concurrency'])
+
+            async def request():
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await client.get(url)
+                    return time.perf_counter() - started, response.status_code
+
+            return await asyncio.gather(*[request() for _ in range(options['requests'])])
+
+        with override_settings(ROOT_URLCONF='storefront.asgi_urls'):
+            started = time.perf_counter()
+            outcomes = asyncio.run(run())
+            elapsed = time.perf_counter() - started
+        return self.summarize_run([latency for latency, _ in outcomes], elapsed,
+                                  [status for _, status in outcomes])
@@ -0,0 +1,116 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from app.bench import benchmark_database, summarize, write_results
+from app.models import Cart, CartItem, Collection, Customer, Order, OrderItem, Product
+from app.serializers import CreateOrderSerializer, OutOfStockError
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks concurrent checkouts of one hot product on a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=200)
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--stock', type=int, default=150,
+                            help='Starting inventory of the hot product')
+        parser.add_argument('--quantity', type=int, default=1,
+                            help='Units each buyer puts in their cart')
+        parser.add_argument('--retries', type=int, default=50,
+                            help='Retries of a checkout that hit a lock error')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            buyers = self.setup(options)
+            results = self.run(buyers, options)
+
+        for key, value in results.items():
+            self.stdout.write(f'{key}: {value}')
+        if options['output']:
+            write_results(options['output'], results)
+        if results['oversold_units']:
+            self.stderr.write(self.style.ERROR('Inventory was oversold!'))
+
+    def setup(self, options):
+        collection = Collection.objects.create(title='Benchmark')
+        self.product = Product.objects.create(
+            title='Hot product', unit_price=10, inventory=options['stock'],
+            collection=collection)
+
+        User = get_user_model()
+        User.objects.bulk_create([
+            User(username=f'buyer{i}', email=f'buyer{i}@example.com', password='!')
+            for i in range(options['buyers'])
+        ])
+        # Re-read for the ids (MySQL doesn't return them from bulk_create).
+        # bulk_create also skipped the signal that creates the customers.
+        users = list(User.objects.filter(username__startswith='buyer'))
+        Customer.objects.bulk_create([Customer(user=user) for user in users])
+        customer_ids = Customer.objects.order_by('id').values_list('id', flat=True)
+        Cart.objects.bulk_create([Cart() for _ in users])
+        carts = list(Cart.objects.order_by('id'))
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=self.product, quantity=options['quantity'])
+            for cart in carts
+        ])
+        return list(zip(customer_ids, [cart.cart_id for cart in carts]))
+
+    def checkout(self, buyer):
+        customer_id, cart_uuid = buyer
+        retries = 0
+        try:
+            started = time.perf_counter()
+            while True:
+                serializer = CreateOrderSerializer(
+                    data={'cart_uuid': cart_uuid}, context={'customer_id': customer_id})
+                serializer.is_valid(raise_exception=True)
+                try:
+                    serializer.save()
+                    outcome = 'ordered'
+                except OutOfStockError:
+                    outcome = 'out_of_stock'
+                except OperationalError:
+                    # Deadlock victim on MySQL, or SQLite failing to upgrade
+                    # a read transaction to a write one
+                    if retries == self.max_retries:
+                        raise
+                    retries += 1
+                    time.sleep(0.001 * retries)
+                    continue
+                return outcome, time.perf_counter() - started, retries
+        except Exception as error:
+            return 'error: %s' % error.__class__.__name__, None, retries
+        finally:
+            connection.close()
+
+    def run(self, buyers, options):
+        self.max_retries = options['retries']
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            outcomes = list(executor.map(self.checkout, buyers))
+        elapsed = time.perf_counter() - started
+
+        counts = {}
+        for outcome, _, _ in outcomes:
+            counts[outcome] = counts.get(outcome, 0) + 1
+        latencies = [latency for _, latency, _ in outcomes if latency is not None]
+
+        self.product.refresh_from_db()
+        sold = sum(OrderItem.objects.filter(
+            product=self.product).values_list('quantity', flat=True))
+        return {
+            'database': connection.vendor,
+            'buyers': options['buyers'],
+            'threads': options['threads'],
+            'outcomes': counts,
+            'retries': sum(retries for _, _, retries in outcomes),
+            'orders': Order.objects.count(),
+            'checkouts_per_second': round(len(latencies) / elapsed, 1),
+            'latency': summarize(latencies),
+            'units_sold': sold,
+            'remaining_inventory': self.product.inventory,
+            'oversold_units': max(0, sold - options['stock']),
+        }
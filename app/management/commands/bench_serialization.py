@@ -0,0 +1,61 @@
+import time
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from app.bench import benchmark_database, summarize, write_results
+from app.renderers import FastJSONRenderer, orjson
+from app.serializers import ProductSerializer
+from app.views import ProductViewSet
+
+
+class Command(BaseCommand):
+    help = ('Compares building a product list page with ProductSerializer and '
+            'JSONRenderer against the .values() fast path and FastJSONRenderer, '
+            'from the query to the rendered bytes, at several page sizes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stderr.write(self.style.WARNING(
+                'orjson is not installed, FastJSONRenderer falls back to JSONRenderer.'))
+        with benchmark_database():
+            call_command('generate_dataset', seed=options['seed'], products=max(options['sizes']),
+                         customers=0, orders=0, carts=0, reviews=0, verbosity=0)
+            view = ProductViewSet(request=None, format_kwarg=None, action=None)
+            queryset = view.get_queryset().order_by('title', 'id')
+            paths = {
+                'serializer': lambda size: JSONRenderer().render(
+                    ProductSerializer(queryset[:size], many=True).data),
+                'fast': lambda size: FastJSONRenderer().render(
+                    view.represent_values(view.get_values_queryset(queryset)[:size])),
+            }
+
+            results = {}
+            for size in options['sizes']:
+                outputs = {name: path(size) for name, path in paths.items()}
+                if outputs['serializer'] != outputs['fast']:
+                    raise CommandError('The paths render different bytes at size %d.' % size)
+                results[size] = {name: self.run(path, size, options['iterations'])
+                                 for name, path in paths.items()}
+                results[size]['speedup'] = round(
+                    results[size]['serializer']['p50_ms'] / results[size]['fast']['p50_ms'], 2)
+
+        for size, result in results.items():
+            self.stdout.write('%5d rows  serializer p50 %8.2f ms  fast p50 %8.2f ms  %5.2fx' % (
+                size, result['serializer']['p50_ms'], result['fast']['p50_ms'], result['speedup']))
+        if options['output']:
+            write_results(options['output'], results)
+
+    def run(self, path, size, iterations):
+        path(size)
+        durations = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            path(size)
+            durations.append(time.perf_counter() - started)
+        return summarize(durations)
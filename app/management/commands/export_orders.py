@@ -0,0 +1,33 @@
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from app.exports import FORMATS, export_lines
+from app.models import Order
+
+
+class Command(BaseCommand):
+    help = ('Exports orders with their line items as CSV or JSON lines, reading them '
+            'in chunks so memory stays flat however many orders match.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', help='Write to this file instead of stdout')
+        parser.add_argument('--since', type=date.fromisoformat,
+                            help='First day of orders, YYYY-MM-DD')
+        parser.add_argument('--until', type=date.fromisoformat,
+                            help='Last day of orders, YYYY-MM-DD')
+        parser.add_argument('--payment-status',
+                            choices=[status for status, _ in Order.PAYMENT_STATUS])
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if options['since'] and options['until'] and options['since'] > options['until']:
+            raise CommandError('--since is after --until.')
+        lines = export_lines(
+            options['format'], chunk_size=options['chunk_size'], since=options['since'],
+            until=options['until'], payment_status=options['payment_status'])
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as file:
+                file.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,292 @@
+import random
+import time
+from array import array
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from itertools import accumulate, islice
+from uuid import UUID
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, models, transaction
+from django.db.models import Max
+from django.utils import timezone
+from app.models import (STARS, Cart, CartItem, Collection, Customer, Order, OrderItem,
+                        Product, Review)
+
+ADJECTIVES = [
+    'Organic', 'Fresh', 'Frozen', 'Classic', 'Spicy', 'Sweet', 'Smoked', 'Roasted',
+    'Premium', 'Mini', 'Large', 'Wild', 'Golden', 'Crispy', 'Dried', 'Whole',
+    'Light', 'Dark', 'Natural', 'Sparkling', 'Creamy', 'Salted', 'Herbal', 'Vintage',
+]
+NOUNS = [
+    'Bread', 'Coffee', 'Tea', 'Cheese', 'Honey', 'Pasta', 'Rice', 'Salmon', 'Shrimp',
+    'Lettuce', 'Tomato', 'Apple', 'Mango', 'Chocolate', 'Cookies', 'Soap', 'Shampoo',
+    'Candle', 'Notebook', 'Pencil', 'Puzzle', 'Flowers', 'Vinegar', 'Pepper',
+    'Cinnamon', 'Yogurt', 'Juice', 'Crackers', 'Almonds', 'Sauce',
+]
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+    'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud '
+    'exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis aute irure '
+    'in reprehenderit voluptate velit esse cillum eu fugiat nulla pariatur'
+).split()
+
+
+class ZipfSampler:
+    """
+    Draws ids from first_id .. first_id + count - 1, where the k-th most
+    popular id is drawn with a weight of 1 / k ** exponent. The popularity
+    ranks are shuffled, so popular ids are spread over the range instead of
+    being the lowest ones.
+    """
+
+    def __init__(self, rng, first_id, count, exponent):
+        self.rng = rng
+        self.ids = list(range(first_id, first_id + count))
+        rng.shuffle(self.ids)
+        self.cum_weights = list(accumulate(
+            1 / rank ** exponent for rank in range(1, count + 1)))
+
+    def sample(self, k=1):
+        return self.rng.choices(self.ids, cum_weights=self.cum_weights, k=k)
+
+    def distinct(self, k):
+        # Up to k different ids; popular ones repeat, so fewer may come back
+        return list(dict.fromkeys(self.sample(k)))
+
+
+@contextmanager
+def explicit_timestamps(*fields):
+    """Let bulk_create keep the generated values of auto_now(_add) fields."""
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = ('Generates a deterministic synthetic dataset for performance testing: '
+            'collections, products, customers, orders, carts and reviews, with '
+            'Zipf-distributed product popularity. The same seed and options on the '
+            'same starting database produce the same rows.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--collections', type=int, default=50)
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--customers', type=int, default=10_000)
+        parser.add_argument('--orders', type=int, default=50_000)
+        parser.add_argument('--max-items-per-order', type=int, default=8)
+        parser.add_argument('--carts', type=int, default=5_000)
+        parser.add_argument('--reviews', type=int, default=20_000)
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent of product popularity')
+        parser.add_argument('--days', type=int, default=365,
+                            help='Spread orders, reviews and updates over this many days')
+        parser.add_argument('--until', type=date.fromisoformat,
+                            help='Date (YYYY-MM-DD) the generated timestamps end at, '
+                                 'defaults to today. Pass it to reproduce a dataset later.')
+        parser.add_argument('--batch-size', type=int, default=5_000)
+        parser.add_argument('--search-index', action='store_true',
+                            help='Index the products for search as they are loaded. '
+                                 'About 20 postings per product, so several times '
+                                 'slower than the products themselves.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        until = options['until'] or timezone.now().date()
+        self.now = datetime.combine(until, datetime.min.time(), tzinfo=timezone.utc)
+        if options['products'] and not options['collections']:
+            raise CommandError('Products need at least one collection.')
+        if (options['orders'] or options['carts'] or options['reviews']) \
+                and not options['products']:
+            raise CommandError('Orders, carts and reviews need products.')
+        if options['orders'] and not options['customers']:
+            raise CommandError('Orders need customers.')
+
+        User = get_user_model()
+        self.first_ids = {
+            model: (model.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+            for model in [Collection, Product, User, Customer, Order, Cart]
+        }
+
+        with explicit_timestamps(Product._meta.get_field('last_updated'),
+                                 Order._meta.get_field('placed_at'),
+                                 Cart._meta.get_field('created_at'),
+                                 Review._meta.get_field('date')):
+            self.load(Collection, self.generate_collections())
+            self.load(Product, self.generate_products(), search_index=options['search_index'])
+            self.load(User, self.generate_users())
+            self.load(Customer, self.generate_customers())
+            product_ids = ZipfSampler(
+                self.rng('popularity'), self.first_ids[Product],
+                options['products'], options['skew']) if options['products'] else None
+            self.load_orders(product_ids)
+            self.load_carts(product_ids)
+            self.load(Review, self.generate_reviews(product_ids))
+            self.count_ratings()
+
+        # Explicit ids leave PostgreSQL sequences behind
+        loaded = [Collection, Product, User, Customer, Order, OrderItem, Cart, CartItem, Review]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), loaded):
+                cursor.execute(sql)
+
+        if options['products'] and not options['search_index']:
+            self.stdout.write('Run rebuild_search_index to make the new products searchable.')
+        if options['orders']:
+            self.stdout.write('Run backfill_sales to add the new orders to the sales reports.')
+
+    def rng(self, stream):
+        # One stream per table, so changing one count leaves the other tables alone
+        return random.Random('%s:%s' % (self.options['seed'], stream))
+
+    def past(self, rng, days=None):
+        return self.now - timedelta(seconds=rng.randrange((days or self.options['days']) * 86400))
+
+    def words(self, rng, low, high):
+        return ' '.join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+    def load(self, model, rows, after_batch=None, label=None, **create_options):
+        label = label or model._meta.verbose_name_plural
+        count = 0
+        started = time.perf_counter()
+        while True:
+            batch = list(islice(rows, self.options['batch_size']))
+            if not batch:
+                break
+            with transaction.atomic():
+                model.objects.bulk_create(batch, **create_options)
+                if after_batch is not None:
+                    after_batch(batch)
+            count += len(batch)
+            if self.options['verbosity'] > 1:
+                self.stdout.write(f'{label}: {count}')
+        elapsed = time.perf_counter() - started
+        if self.options['verbosity']:
+            self.stdout.write(f'{label}: {count} rows in {elapsed:.1f}s '
+                              f'({round(count / max(elapsed, 1e-9))} rows/s)')
+
+    def generate_collections(self):
+        rng = self.rng('collections')
+        first_id = self.first_ids[Collection]
+        for i in range(self.options['collections']):
+            yield Collection(id=first_id + i, title='%s %s' % (
+                rng.choice(ADJECTIVES), rng.choice(NOUNS)))
+
+    def generate_products(self):
+        rng = self.rng('products')
+        # Collection sizes are skewed too
+        collection_ids = ZipfSampler(rng, self.first_ids[Collection],
+                                     self.options['collections'], 0.8)
+        first_id = self.first_ids[Product]
+        self.prices = array('l')
+        for i in range(self.options['products']):
+            cents = int(rng.lognormvariate(7, 1)) % 99_900 + 100
+            self.prices.append(cents)
+            yield Product(
+                id=first_id + i,
+                title='%s %s %d' % (rng.choice(ADJECTIVES), rng.choice(NOUNS), i),
+                slug='product-%d' % (first_id + i),
+                description=self.words(rng, 8, 30),
+                unit_price=Decimal(cents) / 100,
+                inventory=rng.randrange(500),
+                last_updated=self.past(rng),
+                collection_id=collection_ids.sample()[0])
+
+    def generate_users(self):
+        first_id = self.first_ids[get_user_model()]
+        for i in range(self.options['customers']):
+            user_id = first_id + i
+            yield get_user_model()(
+                id=user_id, username='user%d' % user_id,
+                email='user%d@example.com' % user_id, password='!',
+                first_name='User', last_name=str(user_id))
+
+    def generate_customers(self):
+        rng = self.rng('customers')
+        first_id = self.first_ids[Customer]
+        first_user_id = self.first_ids[get_user_model()]
+        for i in range(self.options['customers']):
+            yield Customer(
+                id=first_id + i, user_id=first_user_id + i,
+                phone='555%07d' % rng.randrange(10 ** 7),
+                membership=rng.choices('BSG', weights=[70, 20, 10])[0])
+
+    def load_orders(self, product_ids):
+        rng = self.rng('orders')
+        customer_ids = ZipfSampler(rng, self.first_ids[Customer],
+                                   self.options['customers'], 0.7) \
+            if self.options['customers'] else None
+        first_id = self.first_ids[Order]
+        first_product_id = self.first_ids[Product]
+        items = []
+
+        def orders():
+            for i in range(self.options['orders']):
+                order_id = first_id + i
+                for product_id in product_ids.distinct(
+                        rng.randint(1, self.options['max_items_per_order'])):
+                    items.append(OrderItem(
+                        order_id=order_id, product_id=product_id,
+                        quantity=rng.choice([1, 1, 1, 2, 2, 3, 5]),
+                        unit_price=Decimal(self.prices[product_id - first_product_id]) / 100))
+                yield Order(
+                    id=order_id, customer_id=customer_ids.sample()[0],
+                    placed_at=self.past(rng),
+                    payment_status=rng.choices('CPF', weights=[80, 15, 5])[0])
+
+        def order_items(orders):
+            OrderItem.objects.bulk_create(items, batch_size=self.options['batch_size'])
+            items.clear()
+        self.load(Order, orders(), after_batch=order_items, label='orders (with items)')
+
+    def load_carts(self, product_ids):
+        rng = self.rng('carts')
+        first_id = self.first_ids[Cart]
+        items = []
+
+        def carts():
+            for i in range(self.options['carts']):
+                cart_id = first_id + i
+                for product_id in product_ids.distinct(rng.randint(1, 5)):
+                    items.append(CartItem(cart_id=cart_id, product_id=product_id,
+                                          quantity=rng.randint(1, 3)))
+                yield Cart(id=cart_id, created_at=self.past(rng, days=30),
+                           cart_id=UUID(int=rng.getrandbits(128), version=4))
+
+        def cart_items(carts):
+            CartItem.objects.bulk_create(items, batch_size=self.options['batch_size'])
+            items.clear()
+        self.load(Cart, carts(), after_batch=cart_items, label='carts (with items)')
+
+    def generate_reviews(self, product_ids):
+        rng = self.rng('reviews')
+        self.star_counts = defaultdict(lambda: [0] * len(STARS))
+        for _ in range(self.options['reviews']):
+            product_id = product_ids.sample()[0]
+            rating = rng.choices(STARS, weights=[1, 1, 2, 4, 5])[0]
+            self.star_counts[product_id][rating - 1] += 1
+            yield Review(
+                product_id=product_id,
+                name='User %d' % rng.randrange(self.options['customers'] or 1000),
+                description=self.words(rng, 5, 40),
+                date=self.past(rng),
+                rating=rating)
+
+    def count_ratings(self):
+        # bulk_create() skips the signals that count each product's ratings.
+        # Updated through the plain QuerySet, as ProductQuerySet.update()
+        # would set last_updated to now instead of leaving it as generated.
+        products = [Product(id=product_id, **{'stars_%d' % n: count for n, count
+                                              in zip(STARS, star_counts)})
+                    for product_id, star_counts in self.star_counts.items()]
+        models.QuerySet(Product).bulk_update(products, ['stars_%d' % n for n in STARS],
+                                             batch_size=self.options['batch_size'])
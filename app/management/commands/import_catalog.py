@@ -0,0 +1,210 @@
+import csv
+import json
+import os
+import time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from app.caching import invalidate_collections, invalidate_products
+from app.models import Collection, Product, Promotion
+from app.search import index_products
+
+
+class Command(BaseCommand):
+    help = ('Imports collections, products or promotions from a CSV or JSONL file. '
+            'Rows are upserted in batches, each committed with a checkpoint, so an '
+            'interrupted import resumes where it stopped.')
+
+    update_fields = {
+        'collections': ['title', 'featured_product_id', 'last_updated'],
+        'products': ['slug', 'title', 'description', 'unit_price', 'inventory',
+                     'collection', 'last_updated'],
+        'promotions': ['description', 'discount'],
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['collections', 'products', 'promotions'])
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Defaults to the file extension')
+        parser.add_argument('--key', choices=['id', 'slug'], default='id',
+                            help='Match existing products by id or by slug. '
+                                 'Collections and promotions always match by id.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--checkpoint',
+                            help='Progress file, defaults to PATH.checkpoint')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore the checkpoint and import from the first row')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist.')
+        self.kind = options['kind']
+        self.key = options['key'] if self.kind == 'products' else 'id'
+        self.checkpoint_path = options['checkpoint'] or path + '.checkpoint'
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+
+        done = 0 if options['restart'] else self.load_checkpoint(path)
+        if done:
+            self.stdout.write(f'Resuming after row {done}.')
+        rows = islice(self.read_rows(path, file_format), done, None)
+
+        build = getattr(self, 'build_' + self.kind[:-1])
+        save = getattr(self, 'save_' + self.kind)
+        imported = 0
+        started = time.perf_counter()
+        while True:
+            batch = list(islice(rows, options['batch_size']))
+            if not batch:
+                break
+            objs = {}
+            for number, row in enumerate(batch, start=done + 1):
+                try:
+                    obj = build(row)
+                except KeyError as error:
+                    raise CommandError(f'Row {number}: missing {error}. '
+                                       f'Rows up to {done} were imported.')
+                except (TypeError, ValueError, InvalidOperation) as error:
+                    raise CommandError(f'Row {number}: invalid value ({error}). '
+                                       f'Rows up to {done} were imported.')
+                # A later row for the same key wins
+                objs[getattr(obj, self.key) or ('row', number)] = obj
+            with transaction.atomic():
+                save(list(objs.values()))
+            done += len(batch)
+            imported += len(batch)
+            self.save_checkpoint(path, done)
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{done} rows ({self.rate(imported, started)} rows/s)')
+
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} {self.kind} in {time.perf_counter() - started:.1f}s '
+            f'({self.rate(imported, started)} rows/s).'))
+
+    def rate(self, rows, started):
+        return round(rows / max(time.perf_counter() - started, 1e-9), 1)
+
+    def read_rows(self, path, file_format):
+        with open(path, newline='', encoding='utf-8') as file:
+            if file_format == 'csv':
+                yield from csv.DictReader(file)
+            else:
+                for line in file:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def file_fingerprint(self, path):
+        stat = os.stat(path)
+        return {'kind': self.kind, 'key': self.key,
+                'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def load_checkpoint(self, path):
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as file:
+            checkpoint = json.load(file)
+        if checkpoint['file'] != self.file_fingerprint(path):
+            raise CommandError(
+                f'{path} or the import options changed since {self.checkpoint_path} '
+                'was written. Use --restart to import from the first row.')
+        return checkpoint['rows']
+
+    def save_checkpoint(self, path, rows):
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'file': self.file_fingerprint(path), 'rows': rows}, file)
+        os.replace(temp_path, self.checkpoint_path)
+
+    # Rows come from CSV as strings and from JSONL as JSON values
+
+    def optional(self, row, field, convert=str):
+        value = row.get(field)
+        return None if value in (None, '') else convert(value)
+
+    def build_collection(self, row):
+        return Collection(
+            id=self.optional(row, 'id', int),
+            title=row['title'],
+            featured_product_id=self.optional(row, 'featured_product_id', int))
+
+    def build_promotion(self, row):
+        discount = float(row['discount'])
+        if not 0 <= discount <= 1:
+            raise ValueError(f'discount {discount} is not between 0 and 1')
+        return Promotion(
+            id=self.optional(row, 'id', int),
+            description=row['description'],
+            discount=discount)
+
+    def build_product(self, row):
+        product = Product(
+            id=self.optional(row, 'id', int),
+            slug=self.optional(row, 'slug') or '-',
+            title=row['title'],
+            description=self.optional(row, 'description'),
+            unit_price=Decimal(str(row['unit_price'])),
+            inventory=int(row['inventory']),
+            collection_id=int(row['collection_id']))
+        if self.key == 'id' and product.id is None:
+            raise KeyError('id')
+        if self.key == 'slug' and product.slug == '-':
+            raise KeyError('slug')
+
+        promotions = row.get('promotions')
+        if isinstance(promotions, str):
+            promotions = [value for value in promotions.split(';') if value]
+        product.imported_promotions = \
+            None if promotions is None else [int(value) for value in promotions]
+        return product
+
+    def upsert(self, model, objs, **options):
+        options.update(update_conflicts=True, update_fields=self.update_fields[self.kind])
+        if connection.features.supports_update_conflicts_with_target:
+            options['unique_fields'] = ['id']
+        return model.objects.bulk_create(objs, **options)
+
+    def save_collections(self, collections):
+        self.upsert(Collection, collections)
+        invalidate_collections()
+
+    def save_promotions(self, promotions):
+        self.upsert(Promotion, promotions)
+        # The upsert skips the signals that reprice the promoted products
+        product_ids = list(Product.promotions.through.objects.filter(
+            promotion_id__in=[promotion.id for promotion in promotions])
+            .values_list('product_id', flat=True).distinct())
+        if product_ids:
+            Product.objects.filter(pk__in=product_ids).reprice()
+            invalidate_products(product_ids)
+
+    def save_products(self, products):
+        if self.key == 'slug':
+            self.assign_ids_by_slug(products)
+        # Also recounts the collections and invalidates the product cache.
+        # The products are indexed below, once they all have ids.
+        self.upsert(Product, products, search_index=False)
+        if self.key == 'slug':
+            # MySQL doesn't return the ids of inserted rows
+            self.assign_ids_by_slug([product for product in products if product.id is None])
+
+        replaced = [product for product in products if product.imported_promotions is not None]
+        if replaced:
+            Through = Product.promotions.through
+            Through.objects.filter(product_id__in=[product.id for product in replaced]).delete()
+            Through.objects.bulk_create([
+                Through(product_id=product.id, promotion_id=promotion_id)
+                for product in replaced for promotion_id in set(product.imported_promotions)
+            ])
+            Product.objects.filter(pk__in=[product.id for product in replaced]).reprice()
+        index_products(products)
+
+    def assign_ids_by_slug(self, products):
+        # If existing products share a slug, the oldest one is updated
+        ids = dict(Product.objects.filter(slug__in=[product.slug for product in products])
+                   .order_by('-id').values_list('slug', 'id'))
+        for product in products:
+            product.id = ids.get(product.slug)
@@ -0,0 +1,59 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from app.models import Cart, CartItem
+
+
+class Command(BaseCommand):
+    help = ('Deletes carts created more than --days ago, with their items, oldest '
+            'first in batches. Each batch is its own short transaction, so the purge '
+            'never holds locks for long and can be run while the store is live.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30,
+                            help='Delete carts older than this many days')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the carts and items that would be deleted')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['batch_size'] < 1:
+            raise CommandError('--days must be 0 or more and --batch-size at least 1.')
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        expired = Cart.objects.filter(created_at__lt=cutoff)
+
+        if options['dry_run']:
+            carts = expired.count()
+            items = CartItem.objects.filter(cart__created_at__lt=cutoff).count()
+            self.stdout.write(self.style.SUCCESS(
+                f'Would delete {carts} carts and {items} items created before {cutoff:%Y-%m-%d %H:%M}.'))
+            return
+
+        carts = items = 0
+        last_created_at = None
+        while True:
+            # Oldest first off the created_at index. Each batch starts where the
+            # last one ended, so it doesn't rescan the rows already deleted.
+            remaining = expired if last_created_at is None \
+                else expired.filter(created_at__gte=last_created_at)
+            batch = list(remaining.order_by('created_at', 'id')
+                         .values_list('id', 'cart_id', 'created_at')[:options['batch_size']])
+            if not batch:
+                break
+            with transaction.atomic():
+                deleted_carts, deleted_items = Cart.objects.delete_batch(
+                    [(pk, cart_id) for pk, cart_id, _ in batch])
+            carts += deleted_carts
+            items += deleted_items
+            last_created_at = batch[-1][2]
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{carts} carts and {items} items deleted')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {carts} carts and {items} items created before {cutoff:%Y-%m-%d %H:%M}.'))
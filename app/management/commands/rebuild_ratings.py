@@ -0,0 +1,47 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from app.models import STARS, Product, Review
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the review rating counts of every product from its reviews, '
+            'in batches of products, and repairs the ones that drifted')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the products that drifted')
+
+    def handle(self, *args, **options):
+        fields = ['stars_%d' % n for n in STARS]
+        products = drifted = 0
+        last_id = 0
+        while True:
+            stored = {product_id: list(counts) for product_id, *counts in
+                      Product.objects.filter(pk__gt=last_id).order_by('pk')
+                      .values_list('pk', *fields)[:options['batch_size']]}
+            if not stored:
+                break
+            last_id = max(stored)
+            actual = defaultdict(lambda: [0] * len(STARS))
+            for product_id, rating, count in Review.objects \
+                    .filter(product_id__in=stored, rating__isnull=False) \
+                    .order_by().values_list('product_id', 'rating').annotate(count=Count('id')):
+                actual[product_id][rating - 1] = count
+            changed = [product_id for product_id, counts in stored.items()
+                       if counts != actual[product_id]]
+            for product_id in changed:
+                self.stdout.write(
+                    f'Product {product_id}: stored {stored[product_id]}, actual {actual[product_id]}')
+            if changed and not options['dry_run']:
+                # Recounted in a single UPDATE, so reviews written since the
+                # report above are still counted.
+                Product.objects.recount_ratings(changed)
+            products += len(stored)
+            drifted += len(changed)
+
+        verb = 'Found' if options['dry_run'] else 'Repaired'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {drifted} drifted products out of {products}.'))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from app.models import Product
+from app.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product search index from the product table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        if backend is None:
+            raise CommandError('PRODUCT_SEARCH_BACKEND is not configured.')
+
+        batch_size = options['batch_size']
+        queryset = Product.objects.only('id', 'title', 'description').order_by('id')
+        last_id = 0
+        indexed = 0
+        while True:
+            products = list(queryset.filter(id__gt=last_id)[:batch_size])
+            if not products:
+                break
+            with transaction.atomic():
+                backend.index(products)
+            last_id = products[-1].id
+            indexed += len(products)
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} products.'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from app.models import Collection
+
+
+class Command(BaseCommand):
+    help = 'Repairs Collection.product_count where it drifted from the product table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the collections that drifted')
+
+    def handle(self, *args, **options):
+        drifted = [
+            (collection_id, stored, actual) for collection_id, stored, actual in
+            Collection.objects.annotate(actual=Count('product'))
+            .values_list('id', 'product_count', 'actual')
+            if stored != actual
+        ]
+        for collection_id, stored, actual in drifted:
+            self.stdout.write(
+                f'Collection {collection_id}: stored {stored}, actual {actual}')
+        if drifted and not options['dry_run']:
+            # Recounted in a single UPDATE, so products added since the
+            # report above are still counted.
+            Collection.objects.recount_products(
+                [collection_id for collection_id, _, _ in drifted])
+
+        verb = 'Found' if options['dry_run'] else 'Repaired'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {len(drifted)} drifted collections.'))
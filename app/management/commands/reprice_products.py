@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from app.caching import invalidate_products
+from app.models import Product
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the effective price of every product from its unit price and '
+            'promotions, in batches of products. Needed after promotions are changed '
+            'with QuerySet.update(), which skips the signals that reprice them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        products = 0
+        last_id = 0
+        while True:
+            ids = list(Product.objects.filter(pk__gt=last_id).order_by('pk')
+                       .values_list('pk', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            last_id = ids[-1]
+            Product.objects.filter(pk__in=ids).reprice()
+            invalidate_products(ids)
+            products += len(ids)
+
+        self.stdout.write(self.style.SUCCESS(f'Repriced {products} products.'))
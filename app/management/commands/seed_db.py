@@ -1,6 +1,5 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from django.db import connection
-from pathlib import Path
 import os
 
 
@@ -10,8 +9,6 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         print('Populating the database...')
         current_dir = os.path.dirname(__file__)
-        file_path = os.path.join(current_dir, 'seed.sql')
-        sql = Path(file_path).read_text()
-
-        with connection.cursor() as cursor:
-            cursor.execute(sql)
+        for kind in ['collections', 'products']:
+            file_path = os.path.join(current_dir, f'seed_{kind}.csv')
+            call_command('import_catalog', kind, file_path, restart=True)
@@ -0,0 +1,56 @@
+import csv
+import json
+import os
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+from app.models import Order
+
+
+class Command(BaseCommand):
+    help = ('Applies payment status changes from a CSV or JSONL file with order_id and '
+            'payment_status columns. Allowed transitions are P to C and P to F. The file '
+            'is validated first, then applied in batches of one transaction each.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist.')
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        statuses = {status for status, _ in Order.PAYMENT_STATUS}
+
+        # Read it all first, so a bad row doesn't leave the file half applied
+        changes = list(self.read_changes(path, file_format, statuses))
+        totals = Counter()
+        for start in range(0, len(changes), options['batch_size']):
+            batch = changes[start:start + options['batch_size']]
+            for order_id, outcome in Order.objects.set_payment_statuses(batch):
+                totals[outcome] += 1
+                if outcome != 'updated' and options['verbosity'] > 0:
+                    self.stdout.write(f'Order {order_id}: {outcome}')
+
+        self.stdout.write(self.style.SUCCESS(
+            'Updated %d orders. %s.' % (totals.pop('updated', 0), ', '.join(
+                f'{count} {outcome}' for outcome, count in sorted(totals.items())) or 'No errors')))
+
+    def read_changes(self, path, file_format, statuses):
+        with open(path, newline='', encoding='utf-8') as file:
+            if file_format == 'csv':
+                rows = csv.DictReader(file)
+            else:
+                rows = (json.loads(line) for line in file if line.strip())
+            for number, row in enumerate(rows, start=1):
+                try:
+                    order_id, status = int(row['order_id']), row['payment_status']
+                except KeyError as error:
+                    raise CommandError(f'Row {number}: missing {error}.')
+                except (TypeError, ValueError) as error:
+                    raise CommandError(f'Row {number}: invalid order_id ({error}).')
+                if status not in statuses:
+                    raise CommandError(f'Row {number}: invalid payment_status {status!r}.')
+                yield order_id, status
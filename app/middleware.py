@@ -0,0 +1,218 @@
+"""
+Per-request instrumentation.
+
+RequestMetricsMiddleware times every request routed to a view and records:
+
+    total     wall time through the rest of the middleware stack
+    db        time spent executing SQL, and the number of queries
+    serialize time spent turning objects into response data, in the
+              serializers' to_representation() and the list fast path
+              (app/fastlist.py). Includes any queries that triggers.
+    render    time spent rendering a DRF/template response to bytes
+
+They are sent back in a Server-Timing header. They are also added to
+rolling per-route histograms (GET product-list, POST cart-items-list, ...).
+These cover the last REQUEST_METRICS_WINDOW minutes and are served to staff
+by /store/stats/. The histograms live in process memory, so each worker
+reports its own traffic.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import connections
+
+# Upper bounds of the latency buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+
+
+class RouteStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.db_ms = 0.0
+        self.serialize_ms = 0.0
+        self.render_ms = 0.0
+        self.queries = 0
+        self.max_queries = 0
+        self.histogram = [0] * len(BUCKETS)
+
+    def add(self, total_ms, db_ms, serialize_ms, render_ms, queries, error):
+        self.count += 1
+        self.errors += error
+        self.total_ms += total_ms
+        self.max_ms = max(self.max_ms, total_ms)
+        self.db_ms += db_ms
+        self.serialize_ms += serialize_ms
+        self.render_ms += render_ms
+        self.queries += queries
+        self.max_queries = max(self.max_queries, queries)
+        self.histogram[bisect_left(BUCKETS, total_ms)] += 1
+
+    def merge(self, other):
+        for name in ('count', 'errors', 'total_ms', 'db_ms', 'serialize_ms', 'render_ms',
+                     'queries'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_ms = max(self.max_ms, other.max_ms)
+        self.max_queries = max(self.max_queries, other.max_queries)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the percentile, capped by the max
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.histogram):
+            seen += count
+            if seen >= rank:
+                return min(bound, round(self.max_ms, 3))
+        return round(self.max_ms, 3)
+
+    def as_dict(self):
+        def mean(total):
+            return round(total / self.count, 3)
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_ms': {
+                'mean': mean(self.total_ms),
+                'p50': self.percentile(0.50),
+                'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99),
+                'max': round(self.max_ms, 3),
+            },
+            'db_ms': {'mean': mean(self.db_ms)},
+            'serialize_ms': {'mean': mean(self.serialize_ms)},
+            'render_ms': {'mean': mean(self.render_ms)},
+            'queries': {'mean': mean(self.queries), 'max': self.max_queries},
+            'histogram': {
+                ('<=%g' % bound if bound != float('inf') else '>%g' % BUCKETS[-2]): count
+                for bound, count in zip(BUCKETS, self.histogram)
+            },
+        }
+
+
+class RequestMetrics:
+    """Per-route stats in one slot per minute, pruned to the window."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = {}
+
+    def get_window(self):
+        return getattr(settings, 'REQUEST_METRICS_WINDOW', 15)
+
+    def record(self, route, *values):
+        minute = int(time.time() // 60)
+        with self.lock:
+            slot = self.slots.get(minute)
+            if slot is None:
+                oldest = minute - self.get_window()
+                for old in [old for old in self.slots if old <= oldest]:
+                    del self.slots[old]
+                slot = self.slots[minute] = {}
+            stats = slot.get(route)
+            if stats is None:
+                stats = slot[route] = RouteStats()
+            stats.add(*values)
+
+    def snapshot(self):
+        oldest = int(time.time() // 60) - self.get_window()
+        merged = {}
+        with self.lock:
+            for minute, slot in self.slots.items():
+                if minute <= oldest:
+                    continue
+                for route, stats in slot.items():
+                    merged.setdefault(route, RouteStats()).merge(stats)
+        return {route: stats.as_dict() for route, stats in sorted(merged.items())}
+
+    def reset(self):
+        with self.lock:
+            self.slots.clear()
+
+
+request_metrics = RequestMetrics()
+
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+
+
+@contextmanager
+def serialize_timer(request):
+    """
+    Add the time spent in the block to the request's serialize time. Blocks
+    nested in another one, such as a nested serializer, count once.
+    """
+    # A DRF Request wraps the HttpRequest the middleware sees
+    request = getattr(request, '_request', request)
+    if getattr(request, '_serializing', True):
+        # Nested, or not a request the middleware is timing
+        yield
+        return
+    request._serializing = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        request._serialize_seconds += time.perf_counter() - started
+        request._serializing = False
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        queries = QueryTimer()
+        request._serialize_seconds = 0.0
+        request._serializing = False
+        request._render_seconds = 0.0
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(queries))
+            response = self.get_response(request)
+        total = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            # Static files and unresolved URLs
+            return response
+        serialize = request._serialize_seconds
+        render = request._render_seconds
+        if getattr(settings, 'SERVER_TIMING_HEADER', True):
+            response['Server-Timing'] = ', '.join([
+                'db;dur=%.2f;desc="%d queries"' % (queries.seconds * 1000, queries.count),
+                'serialize;dur=%.2f' % (serialize * 1000),
+                'render;dur=%.2f' % (render * 1000),
+                'total;dur=%.2f' % (total * 1000),
+            ])
+        request_metrics.record(
+            '%s %s' % (request.method, match.view_name or match.route),
+            total * 1000, queries.seconds * 1000, serialize * 1000, render * 1000,
+            queries.count,
+            response.status_code >= 500)
+        return response
+
+    def process_template_response(self, request, response):
+        # Called just before a DRF (or template) response is rendered
+        started = time.perf_counter()
+
+        def rendered(response):
+            request._render_seconds += time.perf_counter() - started
+        response.add_post_render_callback(rendered)
+        return response
@@ -0,0 +1,25 @@
+# Generated by Django 4.1.13 on 2026-10-18 05:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_alter_customer_options_alter_product_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['title', 'id'], name='app_product_title_ff2b8c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['unit_price', 'id'], name='app_product_unit_pr_7dda68_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['last_updated', 'id'], name='app_product_last_up_b4d751_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.1.13 on 2026-10-18 05:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.PositiveIntegerField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.product')),
+            ],
+            options={
+                'unique_together': {('term', 'product')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.13 on 2026-10-18 05:43
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_products(apps, schema_editor):
+    Collection = apps.get_model('app', 'Collection')
+    Product = apps.get_model('app', 'Product')
+    counts = Product.objects.filter(collection_id=OuterRef('pk')) \
+        .order_by().values('collection_id') \
+        .annotate(count=Count('id')).values('count')
+    Collection.objects.update(product_count=Coalesce(Subquery(counts), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_productsearchterm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='product_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_products, migrations.RunPython.noop),
+    ]
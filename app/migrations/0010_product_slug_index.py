@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2026-10-18 05:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_collection_last_updated'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='slug',
+            field=models.CharField(db_index=True, default='-', max_length=255),
+        ),
+    ]
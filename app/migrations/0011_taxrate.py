@@ -0,0 +1,33 @@
+# Generated by Django 4.1.13 on 2026-10-18 06:12
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_product_slug_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaxRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('region', models.CharField(blank=True, default='', max_length=10)),
+                ('rate', models.DecimalField(decimal_places=4, help_text='A fraction, 0.1000 for 10%', max_digits=5, validators=[django.core.validators.MinValueValidator(0)])),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('collection', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='app.collection')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='taxrate',
+            constraint=models.UniqueConstraint(fields=('collection', 'region'), name='unique_collection_tax_rate'),
+        ),
+        migrations.AddConstraint(
+            model_name='taxrate',
+            constraint=models.UniqueConstraint(condition=models.Q(('collection', None)), fields=('region',), name='unique_region_tax_rate'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2026-10-18 06:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_taxrate'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.1.13 on 2026-10-18 06:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_review_rating'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='placed_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('collection', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='app.collection')),
+                ('product', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='app.product')),
+            ],
+            options={
+                'verbose_name_plural': 'daily sales',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dailysales',
+            index=models.Index(fields=['collection', 'day'], name='app_dailysa_collect_a05ba1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dailysales',
+            index=models.Index(fields=['product', 'day'], name='app_dailysa_product_54e3ca_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailysales',
+            constraint=models.UniqueConstraint(fields=('day', 'product', 'collection'), name='unique_daily_sales'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.13 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.db.models import F, Max, OuterRef, Subquery
+from app import pricing
+
+
+def price_products(apps, schema_editor):
+    Product = apps.get_model('app', 'Product')
+    best = Product.promotions.through.objects.filter(product_id=OuterRef('pk')) \
+        .order_by().values('product_id') \
+        .annotate(best=Max('promotion__discount')).values('best')
+    Product.objects.update(
+        effective_price=pricing.effective_price(F('unit_price'), Subquery(best)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_dailysales'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=6),
+            preserve_default=False,
+        ),
+        migrations.RunPython(price_products, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.13 on 2026-10-18 07:10
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_product_effective_price'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='promotion',
+            name='discount',
+            field=models.FloatField(help_text='A fraction, 0.1 for 10%', validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(1)]),
+        ),
+    ]
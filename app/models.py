@@ -1,40 +1,295 @@
+from collections import Counter, defaultdict
+from datetime import datetime, time, timedelta
 from django.conf import settings
 from django.contrib import admin
-from django.core.validators import MinValueValidator
-from django.db import models
+from django.core.cache import cache
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, Count, F, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
 from uuid import uuid4
+from . import pricing
+from .caching import invalidate_collections, invalidate_products
 
 # Create your models here.
 
+# Review ratings run from 1 to 5 stars
+STARS = range(1, 6)
+
 
 class Promotion(models.Model):
     description = models.CharField(max_length=255)
-    discount = models.FloatField()
+    discount = models.FloatField(
+        validators=[MinValueValidator(0), MaxValueValidator(1)],
+        help_text='A fraction, 0.1 for 10%')
+
+
+class CollectionManager(models.Manager):
+    def adjust_product_counts(self, deltas):
+        # deltas maps collection id to the change in its number of products
+        changed = [collection_id for collection_id, delta in deltas.items() if delta]
+        for collection_id in changed:
+            self.filter(pk=collection_id).update(
+                product_count=F('product_count') + deltas[collection_id],
+                last_updated=timezone.now())
+        if changed:
+            invalidate_collections(changed)
+
+    def recount_products(self, collection_ids=None):
+        counts = Product.objects.filter(collection_id=OuterRef('pk')) \
+            .order_by().values('collection_id') \
+            .annotate(count=Count('id')).values('count')
+        queryset = self.all()
+        if collection_ids is not None:
+            queryset = queryset.filter(pk__in=collection_ids)
+        invalidate_collections(collection_ids)
+        return queryset.update(
+            product_count=Coalesce(Subquery(counts), Value(0)),
+            last_updated=timezone.now())
 
 
 class Collection(models.Model):
     title = models.CharField(max_length=255)
     featured_product_id = models.IntegerField(null=True)
+    # Denormalized, kept in step by ProductQuerySet and the Product signals.
+    # `manage.py reconcile_product_counts` repairs any drift.
+    product_count = models.IntegerField(default=0)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    objects = CollectionManager()
 
     def __str__(self):
         return self.title
 
 
+class ProductQuerySet(models.QuerySet):
+    # bulk_create() and update() skip the model signals, so they keep
+    # Collection.product_count, the search index and the catalog cache in
+    # step themselves.
+
+    def bulk_create(self, objs, *args, search_index=True, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            if obj.effective_price is None:
+                # New products have no promotions yet
+                obj.effective_price = obj.unit_price
+        with transaction.atomic(using=self.db, savepoint=False):
+            collection_ids = set()
+            if kwargs.get('update_conflicts'):
+                # An upsert can move existing products out of their collections
+                collection_ids.update(self.filter(
+                    pk__in=[obj.pk for obj in objs if obj.pk is not None]
+                ).order_by().values_list('collection_id', flat=True).distinct())
+            objs = super().bulk_create(objs, *args, **kwargs)
+            collection_ids.update(obj.collection_id for obj in objs)
+            if kwargs.get('ignore_conflicts') or kwargs.get('update_conflicts'):
+                # Some rows may have been updated or skipped instead of inserted.
+                Collection.objects.recount_products(collection_ids)
+                if kwargs.get('update_conflicts'):
+                    self.filter(pk__in=[obj.pk for obj in objs if obj.pk is not None]).reprice()
+                if search_index:
+                    # Index what was stored, not the objs that were skipped
+                    self.reindex([obj.pk for obj in objs if obj.pk is not None])
+                invalidate_products()
+            else:
+                Collection.objects.adjust_product_counts(
+                    Counter(obj.collection_id for obj in objs))
+                if search_index:
+                    from .search import index_products
+                    # MySQL doesn't return the ids of inserted rows, those
+                    # products are left to the caller
+                    index_products([obj for obj in objs if obj.pk is not None])
+                invalidate_products([])
+        return objs
+
+    def decrement_inventory(self, quantities):
+        # quantities maps product id to units taken, applied in one UPDATE.
+        # Unlike update() this knows which products changed.
+        rows = models.QuerySet.update(
+            self.filter(pk__in=quantities),
+            inventory=Case(*[
+                When(pk=product_id, then=F('inventory') - quantity)
+                for product_id, quantity in quantities.items()
+            ], default=F('inventory')),
+            last_updated=timezone.now())
+        invalidate_products(quantities)
+        return rows
+
+    def adjust_ratings(self, deltas):
+        # deltas maps product id to {stars: change in the number of reviews
+        # with that many stars}
+        changed = []
+        for product_id, stars in deltas.items():
+            counts = {'stars_%d' % n: F('stars_%d' % n) + delta
+                      for n, delta in stars.items() if delta}
+            if counts:
+                models.QuerySet.update(self.filter(pk=product_id),
+                                       last_updated=timezone.now(), **counts)
+                changed.append(product_id)
+        if changed:
+            invalidate_products(changed)
+
+    def recount_ratings(self, product_ids=None):
+        def count(stars):
+            return Coalesce(Subquery(
+                Review.objects.filter(product_id=OuterRef('pk'), rating=stars)
+                .order_by().values('product_id')
+                .annotate(count=Count('id')).values('count')), Value(0))
+        queryset = self.all()
+        if product_ids is not None:
+            queryset = queryset.filter(pk__in=product_ids)
+        invalidate_products(product_ids)
+        return models.QuerySet.update(
+            queryset, last_updated=timezone.now(),
+            **{'stars_%d' % n: count(n) for n in STARS})
+
+    def reprice(self):
+        # Recomputes effective_price from unit_price and the best promotion,
+        # in one UPDATE. Callers invalidate the products.
+        best = self.model.promotions.through.objects.filter(product_id=OuterRef('pk')) \
+            .order_by().values('product_id') \
+            .annotate(best=Max('promotion__discount')).values('best')
+        return models.QuerySet.update(
+            self, effective_price=pricing.effective_price(F('unit_price'), Subquery(best)),
+            last_updated=timezone.now())
+
+    def reindex(self, product_ids):
+        # Rebuilds the search postings of the given products, in batches
+        from .search import index_products
+        products = self.model.objects.db_manager(self.db).only('id', 'title', 'description')
+        batch_size = connections[self.db].ops.bulk_batch_size(['pk'], product_ids) or 1
+        for start in range(0, len(product_ids), batch_size):
+            index_products(products.filter(pk__in=product_ids[start:start + batch_size]))
+
+    def update(self, **kwargs):
+        invalidate_products()
+        # Like auto_now, so ETags built from last_updated see the change
+        kwargs.setdefault('last_updated', timezone.now())
+        reprice = 'unit_price' in kwargs and 'effective_price' not in kwargs
+        reindex = 'title' in kwargs or 'description' in kwargs
+        new_collection = kwargs.get('collection', kwargs.get('collection_id'))
+        # A Case (from bulk_update), F or Subquery: which collections the
+        # products move to is only known after the update
+        recount = hasattr(new_collection, 'resolve_expression')
+        product_ids = None
+        if reprice or reindex or recount:
+            # Taken first, as the update can change which rows match
+            product_ids = list(self.values_list('pk', flat=True))
+        if new_collection is None and product_ids is None:
+            return super().update(**kwargs)
+
+        new_collection_id = getattr(new_collection, 'pk', new_collection)
+        products = self.model.objects.db_manager(self.db)
+        batch_size = connections[self.db].ops.bulk_batch_size(['pk'], product_ids or []) or 1
+        batches = [product_ids[start:start + batch_size]
+                   for start in range(0, len(product_ids or []), batch_size)]
+        with transaction.atomic(using=self.db, savepoint=False):
+            deltas = Counter()
+            collection_ids = set()
+            if recount:
+                collection_ids.update(self.order_by().values_list(
+                    'collection_id', flat=True).distinct())
+            elif new_collection is not None:
+                moved = self.order_by().values_list('collection_id') \
+                    .annotate(count=Count('id'))
+                for collection_id, count in moved:
+                    deltas[collection_id] -= count
+                    deltas[new_collection_id] += count
+            rows = super().update(**kwargs)
+            Collection.objects.adjust_product_counts(deltas)
+            if recount and product_ids:
+                for batch in batches:
+                    collection_ids.update(products.filter(pk__in=batch).order_by()
+                                          .values_list('collection_id', flat=True).distinct())
+                Collection.objects.recount_products(collection_ids)
+            if reprice:
+                for batch in batches:
+                    products.filter(pk__in=batch).reprice()
+            if reindex and product_ids:
+                self.reindex(product_ids)
+        return rows
+
+
 class Product(models.Model):
     title = models.CharField(max_length=255)
     description = models.TextField(null=True, blank=True)
     unit_price = models.DecimalField(max_digits=6, decimal_places=2)
+    # unit_price less the best promotion's discount. Denormalized, see
+    # app/pricing.py for what keeps it in step.
+    effective_price = models.DecimalField(max_digits=6, decimal_places=2, editable=False)
     inventory = models.IntegerField()
     last_updated = models.DateTimeField(auto_now=True)
     collection = models.ForeignKey(Collection, on_delete=models.PROTECT)
     promotions = models.ManyToManyField(Promotion)
-    slug = models.CharField(max_length=255, default='-')
+    slug = models.CharField(max_length=255, default='-', db_index=True)
+    # Number of reviews with 1 to 5 stars. Denormalized, kept in step by
+    # the Review signals, `manage.py rebuild_ratings` recomputes them.
+    stars_1 = models.PositiveIntegerField(default=0)
+    stars_2 = models.PositiveIntegerField(default=0)
+    stars_3 = models.PositiveIntegerField(default=0)
+    stars_4 = models.PositiveIntegerField(default=0)
+    stars_5 = models.PositiveIntegerField(default=0)
+
+    objects = ProductQuerySet.as_manager()
 
     def __str__(self):
         return self.title
 
+    @property
+    def star_counts(self):
+        return [getattr(self, 'stars_%d' % n) for n in STARS]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored collection so a save can tell it was moved.
+        instance._loaded_collection_id = instance.__dict__.get('collection_id')
+        return instance
+
     class Meta:
         ordering = ['title']
+        # Keyset pagination seeks on (ordering field, id), see app/pagination.py
+        indexes = [
+            models.Index(fields=['title', 'id']),
+            models.Index(fields=['unit_price', 'id']),
+            models.Index(fields=['last_updated', 'id']),
+        ]
+
+
+class ProductSearchTerm(models.Model):
+    # Inverted index for product search, maintained by app.search
+    term = models.CharField(max_length=64)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    weight = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = [['term', 'product']]
+
+
+class TaxRate(models.Model):
+    # Applies to a collection, a region, both or neither (the default).
+    # app.taxes picks the most specific rate for each product.
+    collection = models.ForeignKey(
+        Collection, on_delete=models.CASCADE, null=True, blank=True)
+    region = models.CharField(max_length=10, blank=True, default='')
+    rate = models.DecimalField(
+        max_digits=5, decimal_places=4, validators=[MinValueValidator(0)],
+        help_text='A fraction, 0.1000 for 10%')
+    last_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s%% (%s, %s)' % (self.rate * 100, self.collection_id or 'any collection',
+                                  self.region or 'any region')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['collection', 'region'],
+                                    name='unique_collection_tax_rate'),
+            # NULLs are distinct in a unique index
+            models.UniqueConstraint(fields=['region'], condition=models.Q(collection=None),
+                                    name='unique_region_tax_rate'),
+        ]
 
 
 class Customer(models.Model):
@@ -68,6 +323,51 @@ class Customer(models.Model):
         ordering = ['user__first_name', 'user__last_name']
 
 
+class OrderManager(models.Manager):
+    def set_payment_statuses(self, changes):
+        """
+        Apply a list of (order_id, payment_status) changes in one transaction.
+        The orders are locked and read, then each status gets one UPDATE, in
+        batches of ids. Returns (order_id, outcome) pairs in the same order as
+        the changes: updated, unchanged, not_found, invalid_transition, or
+        duplicate for a repeated order id.
+        """
+        ids = list(dict.fromkeys(order_id for order_id, _ in changes))
+        batch_size = connections[self.db].ops.bulk_batch_size(['id'], ids) or 1
+        with transaction.atomic(using=self.db):
+            stored = {}
+            for start in range(0, len(ids), batch_size):
+                stored.update(self.select_for_update().order_by()
+                              .filter(pk__in=ids[start:start + batch_size])
+                              .values_list('id', 'payment_status'))
+
+            outcomes, seen, updates = [], set(), defaultdict(list)
+            for order_id, status in changes:
+                current = stored.get(order_id)
+                if order_id in seen:
+                    outcome = 'duplicate'
+                elif current is None:
+                    outcome = 'not_found'
+                elif current == status:
+                    outcome = 'unchanged'
+                elif status not in Order.PAYMENT_TRANSITIONS.get(current, ()):
+                    outcome = 'invalid_transition'
+                else:
+                    outcome = 'updated'
+                    updates[status].append(order_id)
+                seen.add(order_id)
+                outcomes.append((order_id, outcome))
+
+            for status, order_ids in updates.items():
+                for start in range(0, len(order_ids), batch_size):
+                    batch = order_ids[start:start + batch_size]
+                    self.filter(pk__in=batch).update(payment_status=status)
+                    # update() skips the signal that rolls up completed orders
+                    if status == Order.PS_COMPLETE:
+                        DailySales.objects.add_orders(batch)
+        return outcomes
+
+
 class Order(models.Model):
     PS_PENDING = 'P'
     PS_COMPLETE = 'C'
@@ -77,11 +377,26 @@ class Order(models.Model):
         (PS_COMPLETE, 'Complete'),
         (PS_FAILED, 'Failed'),
     ]
-    placed_at = models.DateTimeField(auto_now_add=True)
+    # Allowed by OrderManager.set_payment_statuses
+    PAYMENT_TRANSITIONS = {
+        PS_PENDING: {PS_COMPLETE, PS_FAILED},
+    }
+    # Indexed for backfill_sales
+    placed_at = models.DateTimeField(auto_now_add=True, db_index=True)
     payment_status = models.CharField(
         max_length=1, choices=PAYMENT_STATUS, default=PS_PENDING)
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
 
+    objects = OrderManager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored status so a save can tell the order completed
+        if 'payment_status' in instance.__dict__:
+            instance._loaded_payment_status = instance.payment_status
+        return instance
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.PROTECT)
@@ -90,16 +405,251 @@ class OrderItem(models.Model):
     unit_price = models.DecimalField(max_digits=6, decimal_places=2)
 
 
+class DailySalesManager(models.Manager):
+    revenue_field = models.DecimalField(max_digits=12, decimal_places=2)
+
+    def get_sales(self, items):
+        # (day, product_id, collection_id, units, revenue) rows for OrderItems
+        return items.order_by().values_list(
+            TruncDate('order__placed_at'), 'product_id', 'product__collection_id'
+        ).annotate(units=Sum('quantity'),
+                   revenue=Sum(F('quantity') * F('unit_price'), output_field=self.revenue_field))
+
+    def add_orders(self, order_ids, sign=1):
+        """
+        Add the sales of completed orders to the rollup, or take them back
+        out with sign=-1. They count on the day each order was placed, under
+        the collection its products are in now.
+        """
+        self.add([(day, product_id, collection_id, sign * units, sign * revenue)
+                  for day, product_id, collection_id, units, revenue
+                  in self.get_sales(OrderItem.objects.filter(order_id__in=order_ids))])
+
+    def add(self, rows):
+        """
+        Add units and revenue to (day, product_id, collection_id) rows,
+        creating the ones that don't exist yet. The rows are upserted and
+        incremented in one statement, so concurrent orders can't lose an
+        increment.
+        """
+        if not rows:
+            return
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        insert = 'INSERT INTO %s (day, product_id, collection_id, units, revenue) VALUES %s ' % (
+            table, ', '.join(['(%s, %s, %s, %s, %s)'] * len(rows)))
+        params = [connection.ops.adapt_datefield_value(value) if i == 0 else value
+                  for row in rows for i, value in enumerate(row)]
+
+        if connection.vendor == 'mysql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    insert + 'ON DUPLICATE KEY UPDATE '
+                    'units = units + VALUES(units), revenue = revenue + VALUES(revenue)',
+                    params)
+            return
+
+        if connection.features.supports_update_conflicts_with_target:
+            # SQLite >= 3.24 and PostgreSQL
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    insert + 'ON CONFLICT (day, product_id, collection_id) DO UPDATE '
+                    'SET units = {0}.units + excluded.units, '
+                    'revenue = {0}.revenue + excluded.revenue'.format(table),
+                    params)
+            return
+
+        # Other backends: increment in place, insert if there was nothing to
+        # increment, and increment again if a concurrent insert won the race.
+        for day, product_id, collection_id, units, revenue in rows:
+            sales = self.filter(day=day, product_id=product_id, collection_id=collection_id)
+            changes = {'units': F('units') + units, 'revenue': F('revenue') + revenue}
+            if sales.update(**changes):
+                continue
+            try:
+                with transaction.atomic(using=self.db):
+                    self.create(day=day, product_id=product_id, collection_id=collection_id,
+                                units=units, revenue=revenue)
+            except IntegrityError:
+                sales.update(**changes)
+
+    def rebuild_day(self, day):
+        """Recompute one day of the rollup from the completed orders."""
+        start = timezone.make_aware(datetime.combine(day, time.min))
+        items = OrderItem.objects.filter(
+            order__payment_status=Order.PS_COMPLETE,
+            order__placed_at__gte=start, order__placed_at__lt=start + timedelta(days=1))
+        with transaction.atomic(using=self.db):
+            self.filter(day=day).delete()
+            return len(self.bulk_create([
+                self.model(day=day, product_id=product_id, collection_id=collection_id,
+                           units=units, revenue=revenue)
+                for _, product_id, collection_id, units, revenue in self.get_sales(items)]))
+
+
+class DailySales(models.Model):
+    """
+    Units sold and revenue per day, product and collection, from completed
+    orders. Kept in step by the Order signals, `manage.py backfill_sales`
+    rebuilds it from the orders.
+    """
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_index=False)
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE, db_index=False)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    objects = DailySalesManager()
+
+    class Meta:
+        verbose_name_plural = 'daily sales'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product', 'collection'],
+                                    name='unique_daily_sales'),
+        ]
+        # Reports filter by a day range, optionally within a collection or product
+        indexes = [
+            models.Index(fields=['collection', 'day']),
+            models.Index(fields=['product', 'day']),
+        ]
+
+
 class Address(models.Model):
     street = models.CharField(max_length=255)
     city = models.CharField(max_length=255)
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
 
 
+class CartManager(models.Manager):
+    # Carts are addressed by UUID in the API but items reference the integer
+    # pk, so the mapping is cached across requests. It never changes for a
+    # cart, and the post_delete signal evicts it.
+    pk_cache_timeout = 60
+
+    def pk_cache_key(self, cart_id):
+        return 'cart-pk:%s' % cart_id
+
+    def get_pk(self, cart_id):
+        key = self.pk_cache_key(cart_id)
+        pk = cache.get(key)
+        if pk is None:
+            pk = self.filter(cart_id=cart_id).values_list('id', flat=True).first()
+            if pk is not None:
+                cache.set(key, pk, self.pk_cache_timeout)
+        return pk
+
+    def forget_pk(self, cart_id):
+        cache.delete(self.pk_cache_key(cart_id))
+
+    def delete_batch(self, carts):
+        """
+        Delete carts and their items, given (pk, cart_id) pairs. This is two
+        DELETEs by primary key, without loading the carts or sending a
+        post_delete per cart. Returns the number of carts and items deleted.
+        """
+        pks = [pk for pk, _ in carts]
+        items, _ = CartItem.objects.using(self.db).filter(cart_id__in=pks).delete()
+        deleted = self.filter(pk__in=pks)._raw_delete(self.db)
+        keys = [self.pk_cache_key(cart_id) for _, cart_id in carts]
+        transaction.on_commit(lambda: cache.delete_many(keys), using=self.db)
+        return deleted, items
+
+
 class Cart(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Indexed for purge_carts
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     cart_id = models.UUIDField(unique=True, default=uuid4, editable=False)
 
+    objects = CartManager()
+
+
+class QuantityLimitError(Exception):
+    pass
+
+
+class CartItemManager(models.Manager):
+    # The largest PositiveSmallIntegerField value on every database
+    max_quantity = 32767
+
+    def add_quantity(self, cart_id, product_id, quantity):
+        """
+        Add `quantity` of a product to a cart as one atomic statement,
+        creating the item or incrementing the existing one. Concurrent adds
+        of the same product can't lose an increment. Returns the item, or
+        None if the product doesn't exist. Raises QuantityLimitError, and
+        leaves the item as it was, if it would hold more than max_quantity.
+        """
+        if quantity > self.max_quantity:
+            raise QuantityLimitError
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        product_table = connection.ops.quote_name(Product._meta.db_table)
+        # INSERT ... SELECT FROM product doubles as the product existence check
+        insert = (
+            'INSERT INTO %s (cart_id, product_id, quantity) '
+            'SELECT %%s, %s.id, %%s FROM %s WHERE %s.id = %%s '
+            % (table, product_table, product_table, product_table))
+        limit = self.max_quantity - quantity
+
+        if connection.vendor == 'mysql':
+            with connection.cursor() as cursor:
+                # Qualified, as the UPDATE also sees the product columns. id
+                # is assigned first, so both conditions see the stored
+                # quantity. Over the limit, LAST_INSERT_ID() is set to 0.
+                cursor.execute(
+                    insert + 'ON DUPLICATE KEY UPDATE '
+                    '{0}.id = IF({0}.quantity <= %s, LAST_INSERT_ID({0}.id), '
+                    '{0}.id + LAST_INSERT_ID(0)), '
+                    '{0}.quantity = IF({0}.quantity <= %s, {0}.quantity + %s, {0}.quantity)'
+                    .format(table),
+                    [cart_id, quantity, product_id, limit, limit, quantity])
+                if not cursor.rowcount:
+                    return None
+                item_id = cursor.lastrowid
+            if not item_id:
+                raise QuantityLimitError
+            return self.get(pk=item_id)
+
+        if connection.features.can_return_columns_from_insert:
+            # SQLite >= 3.35 and PostgreSQL
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    insert + 'ON CONFLICT (cart_id, product_id) DO UPDATE '
+                    'SET quantity = {0}.quantity + excluded.quantity '
+                    'WHERE {0}.quantity <= %s '
+                    'RETURNING id, quantity'.format(table),
+                    [cart_id, quantity, product_id, limit])
+                row = cursor.fetchone()
+            if row is None:
+                # Either there is no such product, or the item is full
+                if Product.objects.db_manager(self.db).filter(pk=product_id).exists():
+                    raise QuantityLimitError
+                return None
+            return self.model(id=row[0], cart_id=cart_id,
+                              product_id=product_id, quantity=row[1])
+
+        # Other backends: increment in place, insert if there was nothing to
+        # increment, and increment again if a concurrent insert won the race.
+        items = self.filter(cart_id=cart_id, product_id=product_id)
+
+        def increment():
+            if items.filter(quantity__lte=limit).update(quantity=F('quantity') + quantity):
+                return True
+            if items.exists():
+                raise QuantityLimitError
+            return False
+
+        if not increment():
+            if not Product.objects.filter(pk=product_id).exists():
+                return None
+            try:
+                with transaction.atomic(using=self.db):
+                    return self.create(
+                        cart_id=cart_id, product_id=product_id, quantity=quantity)
+            except IntegrityError:
+                increment()
+        return items.get()
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
@@ -108,6 +658,8 @@ class CartItem(models.Model):
         validators=[MinValueValidator(1)]
     )
 
+    objects = CartItemManager()
+
     class Meta:
         unique_together = [['cart', 'product']]
 
@@ -117,3 +669,14 @@ class Review(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
     date = models.DateTimeField(auto_now=True)
+    # Null for reviews written before ratings existed
+    rating = models.PositiveSmallIntegerField(
+        null=True, validators=[MinValueValidator(min(STARS)), MaxValueValidator(max(STARS))])
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored rating so a save can adjust the product's counts
+        if 'product_id' in instance.__dict__ and 'rating' in instance.__dict__:
+            instance._loaded_rating = (instance.product_id, instance.rating)
+        return instance
@@ -0,0 +1,187 @@
+"""
+Keyset (seek) pagination.
+
+PageNumberPagination runs a COUNT(*) and an OFFSET scan on every page, so
+deep pages get slower the further you go. KeysetPagination remembers the
+ordering values of the last row it returned and asks for the rows after
+them instead, so page N costs the same as page 1 as long as there is an
+index on the ordering columns (see Product.Meta.indexes).
+"""
+import datetime
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def _encode_value(value):
+    # DjangoJSONEncoder truncates datetimes to milliseconds, which would make
+    # the cursor skip rows updated within the same millisecond.
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _reverse_ordering(ordering):
+    return [name[1:] if name.startswith('-') else '-' + name for name in ordering]
+
+
+class KeysetPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    # Used when the queryset has neither an explicit nor a Meta ordering.
+    default_ordering = ['id']
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(queryset)
+
+        values, reverse = self.decode_cursor(request)
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self.get_seek_filter(ordering, values))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        # Coming back from a later page always leaves a next page behind us,
+        # and moving forward from a cursor always leaves a previous page.
+        has_next = values is not None if reverse else has_more
+        has_previous = has_more if reverse else values is not None
+
+        self.next_position = self.get_position(results[-1]) if has_next and results else None
+        self.previous_position = self.get_position(results[0]) if has_previous and results else None
+        return results
+
+    def get_ordering(self, queryset):
+        query = queryset.query
+        if query.order_by:
+            ordering = list(query.order_by)
+        elif query.default_ordering and query.get_meta().ordering:
+            ordering = list(query.get_meta().ordering)
+        else:
+            ordering = list(self.default_ordering)
+
+        for name in ordering:
+            if not isinstance(name, str) or '__' in name or name.lstrip('-') == '?':
+                raise NotFound(
+                    'Keyset pagination does not support ordering by %s.' % name)
+
+        # A unique tiebreaker keeps the ordering total, otherwise rows sharing
+        # the same title or price could be skipped or repeated across pages.
+        if not {'id', '-id', 'pk', '-pk'} & set(ordering):
+            ordering.append('-id' if ordering[-1].startswith('-') else 'id')
+        return ordering
+
+    def get_seek_filter(self, ordering, values):
+        # (a, b, id) > (x, y, z) expanded as
+        # a > x OR (a = x AND b > y) OR (a = x AND b = y AND id > z),
+        # with a leading a >= x so the database can start a range scan.
+        conditions = Q()
+        equal = Q()
+        for name, value in zip(ordering, values):
+            field = name.lstrip('-')
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            conditions |= equal & Q(**{'%s__%s' % (field, lookup): value})
+            equal &= Q(**{field: value})
+
+        first = ordering[0]
+        lookup = 'lte' if first.startswith('-') else 'gte'
+        return Q(**{'%s__%s' % (first.lstrip('-'), lookup): values[0]}) & conditions
+
+    def get_position(self, instance):
+        if isinstance(instance, dict):
+            # A row of a .values() queryset
+            return [instance[name.lstrip('-')] for name in self.ordering]
+        return [getattr(instance, name.lstrip('-')) for name in self.ordering]
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            values, reverse = cursor['v'], bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            # The ordering changed since the cursor was issued.
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    def encode_cursor(self, position, reverse):
+        cursor = {'v': position}
+        if reverse:
+            cursor['r'] = 1
+        encoded = json.dumps(cursor, default=_encode_value, separators=(',', ':'))
+        return replace_query_param(
+            self.base_url, self.cursor_query_param,
+            urlsafe_b64encode(encoded.encode('utf-8')).decode('ascii'))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position, reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class KeysetOrPageNumberPagination(PageNumberPagination):
+    """
+    Page number pagination unless the client opts into keyset pagination by
+    sending a cursor parameter. An empty ?cursor= starts from the first page.
+    """
+    keyset_pagination_class = KeysetPagination
+    keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_pagination_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_pagination_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def to_html(self):
+        if self.keyset is not None:
+            # The page number template needs page_links, which keyset mode
+            # does not have.
+            return ''
+        return super().to_html()
@@ -0,0 +1,58 @@
+"""
+Promotion pricing.
+
+A product's effective price is its unit price less the best (largest)
+discount among its promotions. Promotion.discount is a fraction, 0.1 for
+10%, which the admin and import_catalog only accept between 0 and 1. It is
+applied in whole basis points, still clamped to between 0 and 100% for rows
+written without validation, and the price is rounded to cents with halves
+away from zero. The SQL in
+effective_price() computes the same thing in cents and basis points, so
+MySQL and SQLite agree with discounted() to the cent.
+
+Product.effective_price stores the result. Serializers and checkout read
+it with the product row. It is kept in step by:
+
+  - the Product pre_save signal. A new product has no promotions yet. An
+    existing one looks its best discount up on every save that writes the
+    price, so an instance loaded before a promotion change can't write
+    the old price back
+  - ProductQuerySet.update() and bulk_create(), for the rows they reprice
+  - the Promotion and m2m_changed signals. A promotion change reprices
+    the linked products in one UPDATE, see ProductQuerySet.reprice()
+  - import_catalog, after it upserts promotions or replaces promotion links
+
+Each of those invalidates the cached product responses. Promotion.objects
+.update() skips the signals, `manage.py reprice_products` catches up.
+"""
+from decimal import ROUND_HALF_UP, Decimal
+from django.db.models import DecimalField, ExpressionWrapper, FloatField, IntegerField, Value
+from django.db.models.functions import Cast, Coalesce, Greatest, Least, Round
+
+CENT = Decimal('0.01')
+BASIS_POINTS = 10000
+
+
+def basis_points(discount):
+    if discount is None:
+        return 0
+    points = int((Decimal(discount) * BASIS_POINTS).quantize(1, ROUND_HALF_UP))
+    return min(max(points, 0), BASIS_POINTS)
+
+
+def discounted(price, discount):
+    """price less a discount, rounded to cents."""
+    return (price * (BASIS_POINTS - basis_points(discount)) / BASIS_POINTS) \
+        .quantize(CENT, ROUND_HALF_UP)
+
+
+def effective_price(unit_price, best_discount):
+    """discounted() in SQL, for expressions giving the price and the discount."""
+    points = Greatest(Least(
+        Cast(Round(Coalesce(best_discount, Value(0.0), output_field=FloatField()) * BASIS_POINTS),
+             IntegerField()),
+        Value(BASIS_POINTS)), Value(0))
+    cents = Round(unit_price * 100)
+    return ExpressionWrapper(
+        Round(cents * (BASIS_POINTS - points) / BASIS_POINTS) / 100,
+        output_field=DecimalField(max_digits=6, decimal_places=2))
@@ -0,0 +1,35 @@
+"""
+JSON rendering through orjson.
+
+JSONRenderer runs the stdlib encoder, which calls back into Python for every
+Decimal, datetime and other non-JSON value. FastJSONRenderer hands the data
+to orjson instead and produces the same bytes: compact separators, non-ASCII
+left as UTF-8, U+2028/U+2029 escaped. Datetimes still go through DRF's
+encoder, which formats them differently from orjson. Indented output (the
+browsable API, ?indent=) and values orjson can't encode (ints over 64 bits,
+non-string keys) fall back to JSONRenderer, as does everything when orjson
+isn't installed.
+
+The one difference: a float NaN or infinity comes out as null, where
+JSONRenderer raises. Serializer output doesn't contain those.
+"""
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.ensure_ascii or not self.compact \
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default,
+                               option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # JSON allows these two, JavaScript string literals don't
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
@@ -0,0 +1,140 @@
+"""
+Product search backed by an inverted index.
+
+SearchFilter turns ?search= into icontains on title and description, which
+scans the whole product table. InvertedIndexBackend keeps one
+ProductSearchTerm row per (token, product), kept in sync by the Product
+signals and ProductQuerySet's bulk writes. A search becomes a prefix range
+scan on the term index plus a GROUP BY over the matching postings.
+
+The backend is chosen with the PRODUCT_SEARCH_BACKEND setting. Setting it to
+None falls back to the plain SearchFilter.
+"""
+import re
+from collections import Counter
+from functools import lru_cache, reduce
+from operator import or_
+from django.conf import settings
+from django.db.models import Case, IntegerField, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.utils.module_loading import import_string
+from rest_framework.filters import SearchFilter
+from .models import ProductSearchTerm
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    if not text:
+        return []
+    max_length = ProductSearchTerm._meta.get_field('term').max_length
+    return [token[:max_length] for token in TOKEN_RE.findall(text.lower())]
+
+
+def prefix_match(token):
+    # A range rather than startswith: SQLite's LIKE and MySQL's LIKE BINARY
+    # can't use the (term, product) index. Terms are stored lowercased.
+    return Q(term__gte=token, term__lt=token + '\uffff')
+
+
+class BaseSearchBackend:
+    def index(self, products):
+        raise NotImplementedError('`index()` must be implemented.')
+
+    def remove(self, product_ids):
+        raise NotImplementedError('`remove()` must be implemented.')
+
+    def search(self, queryset, terms):
+        """
+        Return `queryset` narrowed to the products matching every term and
+        annotated with `search_rank`, or None to fall back to SearchFilter.
+        """
+        raise NotImplementedError('`search()` must be implemented.')
+
+
+class InvertedIndexBackend(BaseSearchBackend):
+    # A title hit ranks higher than the same word in the description.
+    field_weights = {'title': 3, 'description': 1}
+
+    def get_postings(self, product):
+        weights = Counter()
+        for field, weight in self.field_weights.items():
+            for token in tokenize(getattr(product, field)):
+                weights[token] += weight
+        return [
+            ProductSearchTerm(term=term, product_id=product.id, weight=weight)
+            for term, weight in weights.items()
+        ]
+
+    def index(self, products):
+        products = list(products)
+        postings = []
+        for product in products:
+            postings.extend(self.get_postings(product))
+        self.remove([product.id for product in products])
+        ProductSearchTerm.objects.bulk_create(postings, batch_size=1000)
+
+    def remove(self, product_ids):
+        ProductSearchTerm.objects.filter(product_id__in=product_ids).delete()
+
+    def search(self, queryset, terms):
+        tokens = []
+        for term in terms:
+            tokens.extend(tokenize(term))
+        tokens = list(dict.fromkeys(tokens))
+        if not tokens:
+            return None
+
+        # Every token has to prefix-match at least one term of a product,
+        # the rank is the summed weight of all the postings that matched.
+        matched = {
+            'matched_%d' % i: Max(Case(
+                When(prefix_match(token), then=Value(1)),
+                default=Value(0), output_field=IntegerField()))
+            for i, token in enumerate(tokens)
+        }
+        matches = ProductSearchTerm.objects \
+            .filter(reduce(or_, [prefix_match(token) for token in tokens])) \
+            .values('product_id') \
+            .annotate(rank=Sum('weight'), **matched) \
+            .filter(**{name: 1 for name in matched})
+
+        return queryset \
+            .filter(pk__in=matches.values('product_id')) \
+            .annotate(search_rank=Subquery(
+                matches.filter(product_id=OuterRef('pk')).values('rank')[:1])) \
+            .order_by('-search_rank', 'pk')
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_search_backend():
+    path = getattr(settings, 'PRODUCT_SEARCH_BACKEND', None)
+    if not path:
+        return None
+    return _load_backend(path)
+
+
+def index_products(products):
+    backend = get_search_backend()
+    if backend is not None:
+        backend.index(products)
+
+
+def remove_products(product_ids):
+    backend = get_search_backend()
+    if backend is not None:
+        backend.remove(product_ids)
+
+
+class ProductSearchFilter(SearchFilter):
+    def filter_queryset(self, request, queryset, view):
+        backend = get_search_backend()
+        terms = self.get_search_terms(request)
+        if backend is not None and terms:
+            results = backend.search(queryset, terms)
+            if results is not None:
+                return results
+        return super().filter_queryset(request, queryset, view)
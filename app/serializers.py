@@ -1,12 +1,32 @@
-from decimal import Decimal
+from datetime import timedelta
 from django.db import transaction
-from .models import Product, Collection, Review, Cart, CartItem, Customer, Order, OrderItem
+from django.utils import timezone
+from .models import (Product, Collection, Review, Cart, CartItem, Customer, Order, OrderItem,
+                     QuantityLimitError)
 from rest_framework import serializers
+from . import taxes
+from .middleware import serialize_timer
 import sys
 import pprint
 
 
-class CollectionSerializer(serializers.ModelSerializer):
+class OutOfStockError(Exception):
+    # Raised by CreateOrderSerializer.save. Not a ValidationError, because
+    # that would turn the numbers in `lines` into strings.
+    def __init__(self, lines):
+        super().__init__('Some products are out of stock.')
+        self.lines = lines
+
+
+class TimedRepresentationMixin:
+    # For the serializers views respond with. Nested ones are timed with
+    # their parent. See app/middleware.py.
+    def to_representation(self, instance):
+        with serialize_timer(self.context.get('request')):
+            return super().to_representation(instance)
+
+
+class CollectionSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = Collection
         fields = ['id', 'title', 'product_count']
@@ -14,39 +34,81 @@ class CollectionSerializer(serializers.ModelSerializer):
     product_count = serializers.IntegerField(read_only=True)
 
 
-class ProductSerializer(serializers.ModelSerializer):
+def represent_rating(star_counts):
+    # star_counts is the number of 1 to 5 star reviews
+    count = sum(star_counts)
+    total = sum(stars * n for stars, n in enumerate(star_counts, start=1))
+    return {
+        'count': count,
+        'average': round(total / count, 2) if count else None,
+        'histogram': {str(stars): n for stars, n in enumerate(star_counts, start=1)},
+    }
+
+
+class ProductSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = ['id', 'title', 'description',
-                  'inventory', 'price', 'price_with_tax', 'collection']
+                  'inventory', 'price', 'effective_price', 'price_with_tax', 'collection',
+                  'rating']
     price = serializers.DecimalField(
         max_digits=6, decimal_places=2, source='unit_price')
     price_with_tax = serializers.SerializerMethodField('calculate_tax')
     collection = serializers.PrimaryKeyRelatedField(
         queryset=Collection.objects.all()
     )
+    rating = serializers.SerializerMethodField()
+
+    def get_rating(self, product: Product):
+        return represent_rating(product.star_counts)
 
     def calculate_tax(self, product: Product):
-        return round(product.unit_price * Decimal(1.1), 2)
+        # ProductViewSet annotates it, see app/taxes.py
+        if hasattr(product, 'price_with_tax'):
+            return product.price_with_tax
+        region = taxes.get_region(self.context.get('request'))
+        return taxes.add_tax(product.effective_price, taxes.get_rate(product.collection_id, region))
+
+    # The list fast path, see app/fastlist.py
+    values_fields = ['id', 'title', 'description', 'inventory', 'unit_price',
+                     'effective_price', 'price_with_tax', 'collection_id',
+                     'stars_1', 'stars_2', 'stars_3', 'stars_4', 'stars_5']
+
+    @staticmethod
+    def represent_values(rows):
+        return [{
+            'id': row['id'],
+            'title': row['title'],
+            'description': row['description'],
+            'inventory': row['inventory'],
+            'price': float(row['unit_price']),
+            'effective_price': float(row['effective_price']),
+            'price_with_tax': float(row['price_with_tax']),
+            'collection': row['collection_id'],
+            'rating': represent_rating([row['stars_1'], row['stars_2'], row['stars_3'],
+                                        row['stars_4'], row['stars_5']]),
+        } for row in rows]
 
 
 class SimpleProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
-        fields = ['id', 'title', 'unit_price']
+        fields = ['id', 'title', 'unit_price', 'effective_price']
 
 
-class ReviewSerializer(serializers.ModelSerializer):
+class ReviewSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = Review
-        fields = ['id', 'name', 'description', 'date']
+        fields = ['id', 'name', 'description', 'date', 'rating']
+        # Null only for reviews written before ratings existed
+        extra_kwargs = {'rating': {'required': True, 'allow_null': False}}
 
     def create(self, validated_data):
         product_id = self.context['product_id']
         return Review.objects.create(product_id=product_id, **validated_data)
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = CartItem
         fields = ['id', 'product', 'quantity', 'total_price']
@@ -55,10 +117,10 @@ class CartItemSerializer(serializers.ModelSerializer):
     total_price = serializers.SerializerMethodField('calculate_total_price')
 
     def calculate_total_price(self, cartitem: CartItem):
-        return cartitem.product.unit_price * cartitem.quantity
+        return cartitem.product.effective_price * cartitem.quantity
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Cart
@@ -71,32 +133,26 @@ class CartSerializer(serializers.ModelSerializer):
     total_price = serializers.SerializerMethodField('calculate_total_price')
 
     def calculate_total_price(self, cart: Cart):
-        return sum([item.quantity * item.product.unit_price for item in cart.cartitem_set.all()])
+        return sum([item.quantity * item.product.effective_price for item in cart.cartitem_set.all()])
 
 
-class AddCartItemSerializer(serializers.ModelSerializer):
+class AddCartItemSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     product_id = serializers.IntegerField()
 
-    def validate_product_id(self, value):
-        if not Product.objects.filter(pk=value).exists():
-            raise serializers.ValidationError(
-                'No product with given ID was found.')
-        return value
-
     def save(self):
         cart_id = self.context['cart_id']
         product_id = self.validated_data['product_id']
         quantity = self.validated_data['quantity']
 
+        # A single upsert, which also checks that the product exists
         try:
-            cart_item = CartItem.objects.get(
-                cart_id=cart_id, product_id=product_id)
-            cart_item.quantity += quantity
-            cart_item.save()
-            self.instance = cart_item
-        except CartItem.DoesNotExist:
-            self.instance = CartItem.objects.create(
-                cart_id=cart_id, **self.validated_data)
+            self.instance = CartItem.objects.add_quantity(cart_id, product_id, quantity)
+        except QuantityLimitError:
+            raise serializers.ValidationError({'quantity': [
+                'A cart can hold at most %d of a product.' % CartItem.objects.max_quantity]})
+        if self.instance is None:
+            raise serializers.ValidationError(
+                {'product_id': ['No product with given ID was found.']})
         return self.instance
 
     class Meta:
@@ -104,13 +160,96 @@ class AddCartItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product_id', 'quantity']
 
 
-class UpdateCartItemSerializer(serializers.ModelSerializer):
+class BulkCartItemSerializer(serializers.ListSerializer):
+    def validate(self, operations):
+        product_ids = {op['product_id'] for op in operations if op['op'] != 'remove'}
+        found = set(Product.objects.filter(
+            pk__in=product_ids).order_by().values_list('id', flat=True))
+        missing = sorted(product_ids - found)
+        if missing:
+            raise serializers.ValidationError(
+                'No products with the given IDs were found: %s' % missing)
+        return operations
+
+    def save(self):
+        cart_id = self.context['cart_id']
+        with transaction.atomic():
+            # Bulk syncs of the same cart apply one after the other
+            list(Cart.objects.select_for_update().filter(pk=cart_id).values_list('id'))
+            items = {item.product_id: item
+                     for item in CartItem.objects.filter(cart_id=cart_id)}
+            quantities = {product_id: item.quantity for product_id, item in items.items()}
+
+            for op in self.validated_data:
+                product_id = op['product_id']
+                if op['op'] == 'add':
+                    quantities[product_id] = quantities.get(product_id, 0) + op['quantity']
+                elif op['op'] == 'set':
+                    quantities[product_id] = op['quantity']
+                else:
+                    quantities[product_id] = 0
+            over = sorted(product_id for product_id, quantity in quantities.items()
+                          if quantity > CartItem.objects.max_quantity)
+            if over:
+                raise serializers.ValidationError(
+                    'A cart can hold at most %d of a product: %s'
+                    % (CartItem.objects.max_quantity, over))
+
+            deleted, changed, created = [], [], []
+            for product_id, quantity in quantities.items():
+                item = items.get(product_id)
+                if item is None:
+                    if quantity:
+                        created.append(CartItem(
+                            cart_id=cart_id, product_id=product_id, quantity=quantity))
+                elif not quantity:
+                    deleted.append(item.id)
+                elif quantity != item.quantity:
+                    item.quantity = quantity
+                    changed.append(item)
+
+            if deleted:
+                CartItem.objects.filter(pk__in=deleted).delete()
+            if changed:
+                CartItem.objects.bulk_update(changed, ['quantity'])
+            if created:
+                CartItem.objects.bulk_create(created)
+
+        return CartItem.objects.select_related('product').filter(cart_id=cart_id)
+
+
+class CartItemOperationSerializer(serializers.Serializer):
+    OP_ADD = 'add'
+    OP_SET = 'set'
+    OP_REMOVE = 'remove'
+
+    op = serializers.ChoiceField(
+        choices=[OP_ADD, OP_SET, OP_REMOVE], default=OP_ADD)
+    product_id = serializers.IntegerField()
+    # set to 0 removes the item
+    quantity = serializers.IntegerField(min_value=0, max_value=32767, required=False)
+
+    def validate(self, attrs):
+        if attrs['op'] == self.OP_REMOVE:
+            return attrs
+        if 'quantity' not in attrs:
+            raise serializers.ValidationError({'quantity': 'This field is required.'})
+        if attrs['op'] == self.OP_ADD and attrs['quantity'] < 1:
+            raise serializers.ValidationError(
+                {'quantity': 'Ensure this value is greater than or equal to 1.'})
+        return attrs
+
+    class Meta:
+        list_serializer_class = BulkCartItemSerializer
+
+
+class UpdateCartItemSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = CartItem
         fields = ['quantity']
 
 
-class CustomerSerializer(serializers.ModelSerializer):
+class CustomerSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     user_id = serializers.IntegerField(read_only=True)
 
     class Meta:
@@ -124,7 +263,11 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'quantity', 'unit_price']
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class ExpandedOrderItemSerializer(OrderItemSerializer):
+    product = SimpleProductSerializer()
+
+
+class OrderSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ['id', 'customer', 'placed_at', 'payment_status', 'items']
@@ -132,18 +275,30 @@ class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, source='orderitem_set')
 
 
-class UpdateOrderSerializer(serializers.ModelSerializer):
+class ExpandedOrderSerializer(OrderSerializer):
+    # ?expand=product
+    items = ExpandedOrderItemSerializer(many=True, source='orderitem_set')
+
+
+class UpdateOrderSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ['payment_status']
 
 
+class PaymentStatusChangeSerializer(serializers.Serializer):
+    # One entry of a bulk payment status change
+    order_id = serializers.IntegerField()
+    payment_status = serializers.ChoiceField(choices=Order.PAYMENT_STATUS)
+
+    max_batch = 10000
+
+
 class CreateOrderSerializer(serializers.Serializer):
     cart_uuid = serializers.UUIDField()
 
     def validate_cart_uuid(self, cart_uuid):
-        db_cart_id = Cart.objects.filter(
-            cart_id=cart_uuid).values_list('id', flat=True).first()
+        db_cart_id = Cart.objects.get_pk(cart_uuid)
         if db_cart_id is None:
             raise serializers.ValidationError(
                 'No cart with the given id was found.')
@@ -154,26 +309,83 @@ class CreateOrderSerializer(serializers.Serializer):
     def save(self, **kwargs):
         db_cart_id = self.validated_data['cart_uuid']
         with transaction.atomic():
-            customer = Customer.objects.get(
-                user_id=self.context['customer_id'])
-            order = Order.objects.create(customer=customer)
-
-            # db_cart_id = Cart.objects.filter(
-            #     cart_id=self.validated_data['cart_uuid']).values_list('id', flat=True).first()
-
-            cart_items = CartItem.objects.select_related('product').filter(
-                cart_id=db_cart_id)
-
+            requested = dict(CartItem.objects.filter(
+                cart_id=db_cart_id).values_list('product_id', 'quantity'))
+
+            # Lock the products in id order so two checkouts sharing products
+            # can't deadlock, then check stock against the locked rows.
+            products = Product.objects.select_for_update() \
+                .filter(pk__in=requested).order_by('pk') \
+                .values_list('id', 'inventory', 'effective_price')
+            unit_prices = {}
+            out_of_stock = []
+            for product_id, inventory, effective_price in products:
+                # Charged with the promotion, if any
+                unit_prices[product_id] = effective_price
+                if inventory < requested[product_id]:
+                    out_of_stock.append({
+                        'product_id': product_id,
+                        'requested': requested[product_id],
+                        'available': max(inventory, 0),
+                    })
+            if out_of_stock:
+                raise OutOfStockError(out_of_stock)
+
+            order = Order.objects.create(customer_id=self.context['customer_id'])
             order_items = [
                 OrderItem(
                     order=order,
-                    product=item.product,
-                    unit_price=item.product.unit_price,
-                    quantity=item.quantity
-                ) for item in cart_items
+                    product_id=product_id,
+                    unit_price=unit_prices[product_id],
+                    quantity=quantity
+                ) for product_id, quantity in requested.items()
             ]
             OrderItem.objects.bulk_create(order_items)
+            Product.objects.decrement_inventory(requested)
 
             Cart.objects.filter(pk=db_cart_id).delete()
 
             return order
+
+
+class SalesReportQuerySerializer(serializers.Serializer):
+    # Query parameters of the sales reports. The range covers default_days
+    # up to today unless given.
+    since = serializers.DateField(required=False)
+    until = serializers.DateField(required=False)
+    collection_id = serializers.IntegerField(required=False)
+    product_id = serializers.IntegerField(required=False)
+
+    default_days = 30
+
+    def validate(self, attrs):
+        until = attrs.get('until') or timezone.localdate()
+        since = attrs.get('since') or until - timedelta(days=self.default_days - 1)
+        if since > until:
+            raise serializers.ValidationError({'since': 'Must not be after until.'})
+        return {**attrs, 'since': since, 'until': until}
+
+
+class SalesSeriesQuerySerializer(SalesReportQuerySerializer):
+    group_by = serializers.ChoiceField(choices=['day', 'collection'], default='day')
+
+
+class TopProductsQuerySerializer(SalesReportQuerySerializer):
+    default_days = 7
+
+    by = serializers.ChoiceField(choices=['revenue', 'units'], default='revenue')
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=10)
+
+
+class OrderExportQuerySerializer(serializers.Serializer):
+    # Query parameters of the order export, see app/exports.py
+    since = serializers.DateField(required=False)
+    until = serializers.DateField(required=False)
+    payment_status = serializers.ChoiceField(choices=Order.PAYMENT_STATUS, required=False)
+    # Not ?format=, which DRF reads to pick a renderer
+    output = serializers.ChoiceField(choices=['csv', 'jsonl'], default='csv')
+
+    def validate(self, attrs):
+        if 'since' in attrs and 'until' in attrs and attrs['since'] > attrs['until']:
+            raise serializers.ValidationError({'since': 'Must not be after until.'})
+        return attrs
@@ -1,10 +1,240 @@
+from collections import Counter, defaultdict
+from decimal import Decimal
 from django.conf import settings
 from django.dispatch import receiver
-from django.db.models.signals import post_save
-from .models import Customer
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from .caching import invalidate_collections, invalidate_products
+from django.db import models, transaction
+from django.db.models import Max
+from django.utils import timezone
+from .models import Cart, Collection, Customer, DailySales, Order, Product, Promotion, Review, TaxRate
+from .pricing import discounted
+from .search import index_products, remove_products
+from .taxes import invalidate_rates
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_customer_for_new_user(sender, **kwargs):
     if kwargs['created']:
         Customer.objects.create(user=kwargs['instance'])
+
+
+def _saves_collection(update_fields):
+    return update_fields is None or bool({'collection', 'collection_id'} & set(update_fields))
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_collection(sender, instance, update_fields=None, **kwargs):
+    # Products built by hand rather than loaded from the db don't know which
+    # collection they were stored under.
+    if instance.pk is None or hasattr(instance, '_loaded_collection_id'):
+        return
+    if not _saves_collection(update_fields):
+        return
+    instance._loaded_collection_id = Product.objects.filter(
+        pk=instance.pk).values_list('collection_id', flat=True).first()
+
+
+@receiver(post_save, sender=Product)
+def update_collection_product_count(sender, instance, created, update_fields=None, **kwargs):
+    if not _saves_collection(update_fields):
+        return
+    if created:
+        Collection.objects.adjust_product_counts({instance.collection_id: 1})
+    else:
+        old_collection_id = getattr(instance, '_loaded_collection_id', None)
+        if old_collection_id is not None and old_collection_id != instance.collection_id:
+            Collection.objects.adjust_product_counts(
+                {old_collection_id: -1, instance.collection_id: 1})
+    instance._loaded_collection_id = instance.collection_id
+
+
+@receiver(post_delete, sender=Product)
+def decrement_collection_product_count(sender, instance, **kwargs):
+    Collection.objects.adjust_product_counts({instance.collection_id: -1})
+
+
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, instance, **kwargs):
+    index_products([instance])
+
+
+@receiver(post_delete, sender=Product)
+def remove_deleted_product(sender, instance, **kwargs):
+    remove_products([instance.id])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_cached_product(sender, instance, **kwargs):
+    invalidate_products([instance.id])
+
+
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+def invalidate_cached_collection(sender, instance, **kwargs):
+    invalidate_collections([instance.id])
+
+
+def _saves_price(update_fields):
+    return update_fields is None or bool({'unit_price', 'effective_price'} & set(update_fields))
+
+
+@receiver(pre_save, sender=Product)
+def price_product(sender, instance, update_fields=None, **kwargs):
+    if not _saves_price(update_fields):
+        return
+    if instance.pk is None:
+        # No promotions until it is saved
+        instance.effective_price = instance.unit_price
+        return
+    # Even if unit_price didn't change: the instance may have been loaded
+    # before a promotion change repriced its row.
+    best = Product.promotions.through.objects.filter(product_id=instance.pk) \
+        .aggregate(best=Max('promotion__discount'))['best']
+    instance.effective_price = discounted(Decimal(instance.unit_price), best)
+
+
+@receiver(post_save, sender=Product)
+def store_effective_price(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'unit_price' in update_fields \
+            and 'effective_price' not in update_fields:
+        models.QuerySet.update(Product.objects.filter(pk=instance.pk),
+                               effective_price=instance.effective_price)
+
+
+def _promoted_product_ids(promotion):
+    return list(Product.promotions.through.objects.filter(
+        promotion_id=promotion.id).values_list('product_id', flat=True))
+
+
+def _reprice_products(product_ids):
+    if product_ids:
+        Product.objects.filter(pk__in=product_ids).reprice()
+        invalidate_products(product_ids)
+
+
+@receiver(post_save, sender=Promotion)
+def reprice_promoted_products(sender, instance, created, **kwargs):
+    if not created:
+        _reprice_products(_promoted_product_ids(instance))
+
+
+@receiver(pre_delete, sender=Promotion)
+def remember_promoted_products(sender, instance, **kwargs):
+    # Deleting the promotion cascades to its links
+    instance._promoted_product_ids = _promoted_product_ids(instance)
+
+
+@receiver(post_delete, sender=Promotion)
+def reprice_unpromoted_products(sender, instance, **kwargs):
+    _reprice_products(getattr(instance, '_promoted_product_ids', []))
+
+
+@receiver(m2m_changed, sender=Product.promotions.through)
+def reprice_product_promotions(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            _reprice_products([instance.id])
+            # So a later save() of this instance keeps the new price
+            instance.refresh_from_db(fields=['effective_price', 'last_updated'])
+    elif action in ('post_add', 'post_remove'):
+        _reprice_products(pk_set)
+    elif action == 'pre_clear':
+        instance._promoted_product_ids = _promoted_product_ids(instance)
+    elif action == 'post_clear':
+        _reprice_products(getattr(instance, '_promoted_product_ids', []))
+
+
+def _saves_rating(update_fields):
+    return update_fields is None or bool({'product', 'product_id', 'rating'} & set(update_fields))
+
+
+@receiver(pre_save, sender=Review)
+def remember_review_rating(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or hasattr(instance, '_loaded_rating'):
+        return
+    if not _saves_rating(update_fields):
+        return
+    instance._loaded_rating = Review.objects.filter(
+        pk=instance.pk).values_list('product_id', 'rating').first()
+
+
+def _rating_deltas(removed=(None, None), added=(None, None)):
+    # {product_id: {stars: change}} for the rating a save or delete replaced
+    deltas = defaultdict(Counter)
+    for (product_id, rating), delta in ((removed, -1), (added, 1)):
+        if product_id is not None and rating is not None:
+            deltas[product_id][rating] += delta
+    return deltas
+
+
+@receiver(post_save, sender=Review)
+def update_product_rating(sender, instance, update_fields=None, **kwargs):
+    if not _saves_rating(update_fields):
+        return
+    rating = (instance.product_id, instance.rating)
+    Product.objects.adjust_ratings(_rating_deltas(
+        removed=getattr(instance, '_loaded_rating', None) or (None, None), added=rating))
+    instance._loaded_rating = rating
+
+
+@receiver(post_delete, sender=Review)
+def remove_product_rating(sender, instance, origin=None, **kwargs):
+    if getattr(origin, 'model', type(origin)) is Product:
+        # Deleted along with its product, by a product or queryset delete()
+        return
+    Product.objects.adjust_ratings(_rating_deltas(
+        removed=getattr(instance, '_loaded_rating', (instance.product_id, instance.rating))))
+
+
+def _saves_payment_status(update_fields):
+    return update_fields is None or 'payment_status' in update_fields
+
+
+@receiver(pre_save, sender=Order)
+def remember_payment_status(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or hasattr(instance, '_loaded_payment_status'):
+        return
+    if not _saves_payment_status(update_fields):
+        return
+    instance._loaded_payment_status = Order.objects.filter(
+        pk=instance.pk).values_list('payment_status', flat=True).first()
+
+
+@receiver(post_save, sender=Order)
+def roll_up_completed_order(sender, instance, update_fields=None, **kwargs):
+    # Orders count in DailySales while they are complete
+    if not _saves_payment_status(update_fields):
+        return
+    was_complete = getattr(instance, '_loaded_payment_status', None) == Order.PS_COMPLETE
+    is_complete = instance.payment_status == Order.PS_COMPLETE
+    if was_complete != is_complete:
+        DailySales.objects.add_orders([instance.pk], sign=1 if is_complete else -1)
+    instance._loaded_payment_status = instance.payment_status
+
+
+@receiver(post_delete, sender=Cart)
+def forget_cart_pk(sender, instance, using, **kwargs):
+    # After commit, or a concurrent lookup could cache the pk again
+    transaction.on_commit(lambda: Cart.objects.forget_pk(instance.cart_id), using=using)
+
+
+@receiver(pre_save, sender=TaxRate)
+def remember_tax_rate_collection(sender, instance, **kwargs):
+    stored = TaxRate.objects.filter(pk=instance.pk).values_list('collection_id').first() \
+        if instance.pk is not None else None
+    instance._stored_collection_ids = set(stored or [])
+
+
+@receiver(post_save, sender=TaxRate)
+@receiver(post_delete, sender=TaxRate)
+def touch_taxed_products(sender, instance, **kwargs):
+    invalidate_rates()
+    # None stands for every collection
+    collection_ids = getattr(instance, '_stored_collection_ids', set()) | {instance.collection_id}
+    products = Product.objects.all()
+    if None not in collection_ids:
+        products = products.filter(collection_id__in=collection_ids)
+    # Changes their ETags, and invalidates their cached responses
+    products.update(last_updated=timezone.now())
@@ -0,0 +1,145 @@
+"""
+Tax rates and the taxed product price.
+
+A TaxRate row applies to a collection, a region, both or neither. For a
+product in collection C, seen from region R, the most specific rate wins:
+
+    (C, R)  >  (C, any region)  >  (any collection, R)  >  (any, any)
+
+and DEFAULT_TAX_RATE when no row applies. The region comes from the
+?region= parameter, so it is part of the cache key and the ETag.
+
+Tax is added to the effective price, the price after promotions that
+checkout charges (app/pricing.py).
+
+with_price_with_tax() annotates price_with_tax in SQL, so product lists can
+be ordered and filtered by it. When the query is compiled, the rates are
+turned into a CASE over collection_id. The arithmetic is done in whole
+cents and basis points: that is exact even on SQLite, where decimals are
+floats. ROUND takes halves away from zero, the same as add_tax() in Python.
+
+The rates live in a per-process dict. Saving or deleting a rate bumps the
+'tax' generation in the shared cache, and every process reloads the rates
+the next time it sees a new generation. The signals also touch last_updated
+on the affected products. That invalidates their cached responses and
+changes their ETags. In case a process misses the bump, for instance with a
+cache that isn't shared, it also compares the number of rows and their
+latest last_updated with the database every TAX_RATES_CHECK_SECONDS.
+"""
+import threading
+import time
+from decimal import ROUND_HALF_UP, Decimal
+from django.conf import settings
+from django.db.models import Count, DecimalField, Expression, F, Max
+from django.db.models.expressions import SQLiteNumericMixin
+from .caching import get_generations, invalidate
+from .models import TaxRate
+
+CENT = Decimal('0.01')
+REGION_PARAM = 'region'
+
+_rates = {'generation': None, 'version': None, 'checked': 0.0, 'rates': {}}
+_rates_lock = threading.Lock()
+
+
+def get_default_rate():
+    return Decimal(str(getattr(settings, 'DEFAULT_TAX_RATE', '0.10')))
+
+
+def get_region(request):
+    if request is None:
+        return ''
+    max_length = TaxRate._meta.get_field('region').max_length
+    return request.query_params.get(REGION_PARAM, '')[:max_length]
+
+
+def get_rates():
+    """{(collection_id or None, region): rate} for every TaxRate row."""
+    generation, = get_generations(['tax'])
+    now = time.monotonic()
+    if _rates['generation'] == generation:
+        if now < _rates['checked'] + getattr(settings, 'TAX_RATES_CHECK_SECONDS', 5):
+            return _rates['rates']
+        stats = TaxRate.objects.aggregate(count=Count('id'), last_updated=Max('last_updated'))
+        if (stats['count'], stats['last_updated']) == _rates['version']:
+            _rates['checked'] = now
+            return _rates['rates']
+    rows = list(TaxRate.objects.values_list('collection_id', 'region', 'rate', 'last_updated'))
+    rates = {(collection_id, region): rate for collection_id, region, rate, _ in rows}
+    version = (len(rows), max((row[3] for row in rows), default=None))
+    with _rates_lock:
+        _rates.update(generation=generation, version=version, checked=now, rates=rates)
+    return rates
+
+
+def invalidate_rates():
+    invalidate('tax')
+
+
+def get_region_rates(region):
+    """The region's default rate, and {collection_id: rate} where that differs."""
+    rates = get_rates()
+    default = rates.get((None, region), rates.get((None, ''), get_default_rate()))
+    by_collection = {}
+    for collection_id, _ in rates:
+        if collection_id is not None:
+            # A collection with rates for other regions only gets the default
+            rate = rates.get((collection_id, region), rates.get((collection_id, ''), default))
+            if rate != default:
+                by_collection[collection_id] = rate
+    return default, by_collection
+
+
+def get_rate(collection_id, region=''):
+    default, by_collection = get_region_rates(region)
+    return by_collection.get(collection_id, default)
+
+
+def add_tax(price, rate):
+    return (price * (1 + rate)).quantize(CENT, ROUND_HALF_UP)
+
+
+def _multiplier(rate):
+    # 1 + rate in basis points, 11000 for 10%
+    return int((1 + rate) * 10000)
+
+
+class PriceWithTax(SQLiteNumericMixin, Expression):
+    """
+    effective_price plus the region's tax, rounded to cents. The rates are looked
+    up when the query is compiled rather than when it is built, so querysets
+    that never select, filter or order by the annotation don't need them.
+    """
+    output_field = DecimalField(max_digits=9, decimal_places=2)
+
+    def __init__(self, region=''):
+        super().__init__()
+        self.region = region
+        self.price, self.collection_id = F('effective_price'), F('collection_id')
+
+    def get_source_expressions(self):
+        return [self.price, self.collection_id]
+
+    def set_source_expressions(self, exprs):
+        self.price, self.collection_id = exprs
+
+    def as_sql(self, compiler, connection):
+        price, params = compiler.compile(self.price)
+        default, by_collection = get_region_rates(self.region)
+        multiplier = '%s'
+        multiplier_params = [_multiplier(default)]
+        if by_collection:
+            collection_id, collection_params = compiler.compile(self.collection_id)
+            multiplier = 'CASE %s %s ELSE %%s END' % (
+                collection_id, ' '.join(['WHEN %s THEN %s'] * len(by_collection)))
+            multiplier_params = [*collection_params, *[
+                value for collection_id, rate in sorted(by_collection.items())
+                for value in (collection_id, _multiplier(rate))
+            ], *multiplier_params]
+        # Halves are exact in binary, so ROUND agrees with add_tax() on floats too
+        sql = 'ROUND(ROUND(%s * 100) * %s / 10000) / 100' % (price, multiplier)
+        return sql, [*params, *multiplier_params]
+
+
+def with_price_with_tax(queryset, region=''):
+    return queryset.annotate(price_with_tax=PriceWithTax(region))
@@ -1,3 +1,1923 @@
-from django.test import TestCase
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
+from uuid import uuid4
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.signals import request_started
+from django.core.management import CommandError, call_command
+from django.db import (DEFAULT_DB_ALIAS, close_old_connections, connection, connections,
+                       models, router)
+from django.db.models import Max, Subquery
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.http import HttpResponse
+from django.utils import timezone
+from threading import Barrier, Thread
+from rest_framework.mixins import ListModelMixin
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+from rest_framework.serializers import ModelSerializer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from .async_views import AsyncReadView
+from .caching import get_cache_stats, reset_cache_stats
+from .exports import export_lines
+from .middleware import request_metrics
+from .renderers import FastJSONRenderer, orjson
+from .pricing import discounted
+from .search import prefix_match
+from .serializers import ProductSerializer
+from .taxes import add_tax, get_rate, with_price_with_tax
+from .views import CartViewSet, CollectionViewSet, ProductViewSet
+from storefront.dbrouters import STICKY_COOKIE, ReplicaMiddleware
+from .models import (Cart, CartItem, Collection, Customer, DailySales, Order, OrderItem,
+                     Product, ProductSearchTerm, Promotion, QuantityLimitError, Review,
+                     TaxRate)
 
 # Create your tests here.
+
+
+def asgi_get(path, query_string='', headers=()):
+    """GET through storefront.asgi.application. Returns (status, headers, body)."""
+    from storefront.asgi import application
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': path, 'root_path': '',
+        'query_string': query_string.encode(), 'server': ('testserver', 80),
+        'headers': [(b'host', b'testserver')] + [
+            (name.encode(), value.encode()) for name, value in headers],
+    }
+    # Like the test clients, keep the test's connection and transaction
+    request_started.disconnect(close_old_connections)
+    try:
+        async_to_sync(application)(scope, receive, send)
+    finally:
+        request_started.connect(close_old_connections)
+    start = messages[0]
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], dict(start['headers']), body
+
+
+class StoreTestCase(TestCase):
+    def setUp(self):
+        # The locmem cache outlives the per-test transaction rollback
+        cache.clear()
+
+
+class ProductKeysetPaginationTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.collection = Collection.objects.create(title='Grocery')
+        # Duplicate titles and prices so the id tiebreaker matters.
+        Product.objects.bulk_create([
+            Product(title='Item %d' % (i // 3), unit_price=Decimal(10 + i % 4),
+                    inventory=10, collection=cls.collection)
+            for i in range(25)
+        ])
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def walk(self, url, link='next'):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            ids.extend(product['id'] for product in response.data['results'])
+            url = response.data[link]
+        return ids
+
+    def test_walks_default_ordering_without_gaps(self):
+        ids = self.walk('/store/products/?cursor=')
+        expected = list(Product.objects.order_by(
+            'title', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_walks_ordering_filter_fields(self):
+        for ordering in ['unit_price', '-unit_price', 'last_updated']:
+            ids = self.walk('/store/products/?cursor=&ordering=' + ordering)
+            tiebreaker = '-id' if ordering.startswith('-') else 'id'
+            expected = list(Product.objects.order_by(
+                ordering, tiebreaker).values_list('id', flat=True))
+            self.assertEqual(ids, expected)
+
+    def test_previous_link_returns_the_same_page(self):
+        first = self.client.get('/store/products/?cursor=&ordering=unit_price')
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+        self.assertIsNone(back.data['previous'])
+
+    def test_page_number_pagination_is_still_the_default(self):
+        response = self.client.get('/store/products/?page=2')
+        self.assertEqual(response.data['count'], 25)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/store/products/?cursor=garbage')
+        self.assertEqual(response.status_code, 404)
+
+
+class ProductSearchTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.bread = Product.objects.create(
+            title='Bread Ww Cluster', description='fresh wholewheat loaf',
+            unit_price=4, inventory=10, collection=collection)
+        cls.loaf = Product.objects.create(
+            title='Banana Loaf', description='bread made with bananas',
+            unit_price=6, inventory=10, collection=collection)
+        cls.juice = Product.objects.create(
+            title='Orange Juice', description=None,
+            unit_price=3, inventory=10, collection=collection)
+
+    def search(self, query, **params):
+        response = APIClient().get('/store/products/', {'search': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [product['id'] for product in response.data['results']]
+
+    def test_ranks_title_matches_first(self):
+        self.assertEqual(self.search('bread'), [self.bread.id, self.loaf.id])
+
+    def test_every_term_must_match(self):
+        self.assertEqual(self.search('bread banana'), [self.loaf.id])
+        self.assertEqual(self.search('bread juice'), [])
+
+    def test_matches_prefixes(self):
+        self.assertEqual(self.search('ORAN'), [self.juice.id])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.juice.title = 'Apple Juice'
+        self.juice.save()
+        self.assertEqual(self.search('orange'), [])
+        self.assertEqual(self.search('apple'), [self.juice.id])
+        self.bread.delete()
+        self.assertEqual(self.search('bread'), [self.loaf.id])
+
+    def test_index_follows_bulk_writes(self):
+        Product.objects.filter(pk=self.juice.pk).update(title='Apple Juice')
+        self.assertEqual(self.search('orange'), [])
+        self.assertEqual(self.search('apple'), [self.juice.id])
+
+        self.bread.description = 'rye'
+        Product.objects.bulk_update([self.bread], ['description'])
+        self.assertEqual(self.search('wholewheat'), [])
+        self.assertEqual(self.search('rye'), [self.bread.id])
+
+        added, = Product.objects.bulk_create([Product(
+            title='Cherry Cake', unit_price=5, inventory=1,
+            collection_id=self.bread.collection_id)])
+        self.assertEqual(self.search('cherry'), [added.id])
+
+    def test_upserts_index_the_stored_rows(self):
+        skipped = Product(pk=self.juice.pk, title='Grape Juice', unit_price=3, inventory=1,
+                          collection_id=self.juice.collection_id)
+        Product.objects.bulk_create([skipped], ignore_conflicts=True)
+        self.assertEqual(self.search('grape'), [])
+        self.assertEqual(self.search('orange'), [self.juice.id])
+
+        options = {'update_conflicts': True, 'update_fields': ['title']}
+        if connection.features.supports_update_conflicts_with_target:
+            options['unique_fields'] = ['id']
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.bulk_create([skipped], **options)
+        self.assertEqual(self.search('grape'), [self.juice.id])
+        self.assertEqual(self.search('orange'), [])
+
+    def test_prefixes_are_index_ranges(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.search('brea'), [self.bread.id, self.loaf.id])
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'LIKE' in query['sql']])
+        if connection.vendor == 'sqlite':
+            sql, params = ProductSearchTerm.objects.filter(prefix_match('brea')) \
+                .values('product_id').query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIn('(term>? AND term<?)', plan)
+
+    def test_falls_back_to_search_filter(self):
+        with self.settings(PRODUCT_SEARCH_BACKEND=None):
+            self.assertEqual(self.search('read'), [self.loaf.id, self.bread.id])
+
+
+class CollectionProductCountTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.grocery = Collection.objects.create(title='Grocery')
+        cls.beauty = Collection.objects.create(title='Beauty')
+
+    def make_product(self, collection, **kwargs):
+        return Product(title='Soap', unit_price=1, inventory=1,
+                       collection=collection, **kwargs)
+
+    def assertCounts(self, grocery, beauty):
+        self.assertEqual(
+            dict(Collection.objects.values_list('title', 'product_count')),
+            {'Grocery': grocery, 'Beauty': beauty})
+
+    def test_create_move_and_delete(self):
+        product = self.make_product(self.grocery)
+        product.save()
+        self.assertCounts(1, 0)
+
+        product = Product.objects.get(pk=product.pk)
+        product.collection = self.beauty
+        product.save()
+        self.assertCounts(0, 1)
+
+        product.delete()
+        self.assertCounts(0, 0)
+
+    def test_bulk_paths(self):
+        Product.objects.bulk_create(
+            [self.make_product(self.grocery) for _ in range(3)])
+        self.assertCounts(3, 0)
+
+        Product.objects.filter(pk__in=Product.objects.values('pk')[:2]) \
+            .update(collection=self.beauty)
+        self.assertCounts(1, 2)
+
+        Product.objects.all().delete()
+        self.assertCounts(0, 0)
+
+    def test_bulk_update_and_expressions(self):
+        products = Product.objects.bulk_create(
+            [self.make_product(self.grocery) for _ in range(3)])
+        products[0].collection = self.beauty
+        Product.objects.bulk_update(products, ['collection'])
+        self.assertCounts(2, 1)
+
+        Product.objects.filter(pk=products[1].pk).update(
+            collection_id=Subquery(Collection.objects.filter(pk=self.beauty.pk).values('pk')))
+        self.assertCounts(1, 2)
+
+    def test_list_reads_the_stored_count(self):
+        Product.objects.bulk_create(
+            [self.make_product(self.beauty) for _ in range(2)])
+        # ETag aggregate, page count, page rows: no join against products
+        with self.assertNumQueries(3):
+            response = APIClient().get('/store/collections/')
+        counts = {c['title']: c['product_count'] for c in response.data['results']}
+        self.assertEqual(counts, {'Grocery': 0, 'Beauty': 2})
+
+    def test_reconcile_repairs_drift(self):
+        self.make_product(self.grocery).save()
+        Collection.objects.update(product_count=7)
+        out = StringIO()
+        call_command('reconcile_product_counts', stdout=out)
+        self.assertIn('Repaired 2 drifted collections', out.getvalue())
+        self.assertCounts(1, 0)
+
+
+class CatalogCacheTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.collection = Collection.objects.create(title='Grocery')
+        cls.product = Product.objects.create(
+            title='Bread', unit_price=4, inventory=10, collection=cls.collection)
+        cls.other = Product.objects.create(
+            title='Milk', unit_price=2, inventory=10, collection=cls.collection)
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        reset_cache_stats()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_second_request_is_served_from_cache(self):
+        self.assertEqual(self.get('/store/products/?ordering=unit_price')['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.get('/store/products/?ordering=unit_price')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(self.get('/store/products/?ordering=-unit_price')['X-Cache'], 'MISS')
+        self.assertEqual(get_cache_stats()['products'], {'hit': 1, 'miss': 2})
+
+    def test_product_save_invalidates_its_detail_and_the_lists(self):
+        detail = '/store/products/%d/' % self.product.id
+        other = '/store/products/%d/' % self.other.id
+        for url in [detail, other, '/store/products/', '/store/collections/']:
+            self.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.title = 'Rye Bread'
+            self.product.save()
+
+        self.assertEqual(self.get(detail).data['title'], 'Rye Bread')
+        self.assertEqual(self.get('/store/products/')['X-Cache'], 'MISS')
+        self.assertEqual(self.get(other)['X-Cache'], 'HIT')
+        # The product count did not change
+        self.assertEqual(self.get('/store/collections/')['X-Cache'], 'HIT')
+
+    def test_product_create_invalidates_the_collection_count(self):
+        self.get('/store/collections/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(
+                title='Eggs', unit_price=3, inventory=1, collection=self.collection)
+        response = self.get('/store/collections/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['product_count'], 3)
+
+    def test_bulk_update_invalidates_every_product(self):
+        detail = '/store/products/%d/' % self.product.id
+        self.get(detail)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.update(inventory=0)
+        self.assertEqual(self.get(detail).data['inventory'], 0)
+
+    def test_promotion_changes_invalidate_linked_products(self):
+        promotion = Promotion.objects.create(description='Sale', discount=0.1)
+        detail = '/store/products/%d/' % self.product.id
+        other = '/store/products/%d/' % self.other.id
+        self.get(detail)
+        self.get(other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.promotions.add(promotion)
+        self.assertEqual(self.get(detail)['X-Cache'], 'MISS')
+        self.assertEqual(self.get(other)['X-Cache'], 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            promotion.delete()
+        self.assertEqual(self.get(detail)['X-Cache'], 'MISS')
+        self.assertEqual(self.get(other)['X-Cache'], 'HIT')
+
+
+class ConditionalGetTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.collection = Collection.objects.create(title='Grocery')
+        cls.product = Product.objects.create(
+            title='Bread', unit_price=4, inventory=10, collection=cls.collection)
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def test_detail_revalidates_with_etag_and_last_modified(self):
+        url = '/store/products/%d/' % self.product.id
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        cache.clear()
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        self.product.inventory = 9
+        self.product.save()
+        cache.clear()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_cache_hit_answers_conditional_request_without_queries(self):
+        url = '/store/products/?collection_id=%d' % self.collection.id
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_list_etag_follows_filters_and_deletes(self):
+        url = '/store/products/?unit_price__gt=1'
+        etag = self.client.get(url)['ETag']
+        self.assertNotIn('Last-Modified', self.client.get(url))
+        self.assertNotEqual(
+            self.client.get('/store/products/?unit_price__gt=2')['ETag'], etag)
+
+        Product.objects.create(
+            title='Milk', unit_price=2, inventory=1, collection=self.collection)
+        Product.objects.filter(title='Milk').delete()
+        cache.clear()
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.product.delete()
+        cache.clear()
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_collection_etag_changes_with_product_count(self):
+        url = '/store/collections/%d/' % self.collection.id
+        etag = self.client.get(url)['ETag']
+        Product.objects.create(
+            title='Milk', unit_price=2, inventory=1, collection=self.collection)
+        cache.clear()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['product_count'], 2)
+
+
+class CartItemQueryBudgetTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.bread, cls.milk = Product.objects.bulk_create([
+            Product(title='Bread', unit_price=4, inventory=10, collection=collection),
+            Product(title='Milk', unit_price=2, inventory=10, collection=collection),
+        ])
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.cart = Cart.objects.create()
+        self.item = CartItem.objects.create(cart=self.cart, product=self.bread, quantity=1)
+        self.url = '/store/carts/%s/items/' % self.cart.cart_id
+
+    def test_list(self):
+        # page count and the page of items joined to cart and product
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data['results'][0]['product']['title'], 'Bread')
+
+    def test_retrieve(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('%s%d/' % (self.url, self.item.id))
+        self.assertEqual(response.data['quantity'], 1)
+
+    def test_create_with_cached_cart_id(self):
+        self.assertEqual(Cart.objects.get_pk(self.cart.cart_id), self.cart.id)
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {'product_id': self.milk.id, 'quantity': 2})
+        self.assertEqual(response.status_code, 201)
+
+    def test_create_increments_existing_item(self):
+        response = self.client.post(self.url, {'product_id': self.bread.id, 'quantity': 2})
+        self.assertEqual(response.data, {'id': self.item.id, 'product_id': self.bread.id, 'quantity': 3})
+
+    def test_create_with_unknown_product(self):
+        response = self.client.post(self.url, {'product_id': 0, 'quantity': 2})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('product_id', response.data)
+
+    def test_update(self):
+        with self.assertNumQueries(2):
+            response = self.client.patch(
+                '%s%d/' % (self.url, self.item.id), {'quantity': 5})
+        self.assertEqual(response.data, {'quantity': 5})
+
+    def test_destroy(self):
+        with self.assertNumQueries(2):
+            response = self.client.delete('%s%d/' % (self.url, self.item.id))
+        self.assertEqual(response.status_code, 204)
+
+    def test_unknown_cart(self):
+        url = '/store/carts/00000000-0000-0000-0000-000000000000/items/'
+        response = self.client.post(url, {'product_id': self.milk.id, 'quantity': 2})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get('/store/carts/not-a-uuid/items/').status_code, 404)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_empty_cart_lists_no_items(self):
+        self.item.delete()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [])
+
+    def test_deleting_the_cart_evicts_its_cached_id(self):
+        pk = Cart.objects.get_pk(self.cart.cart_id)
+        cart_id = self.cart.cart_id
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.cart.delete()
+            # Kept until the delete commits
+            self.assertEqual(cache.get(Cart.objects.pk_cache_key(cart_id)), pk)
+        self.assertEqual(len(callbacks), 1)
+        self.assertIsNone(Cart.objects.get_pk(cart_id))
+
+
+class AddCartItemConcurrencyTests(TransactionTestCase):
+    threads = 8
+    adds_per_thread = 25
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.alias = DEFAULT_DB_ALIAS
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # Shared-cache in-memory SQLite fails concurrent writers outright
+            # instead of waiting for the lock. The threads write to a copy of
+            # the test database in a file instead, as the benchmarks do.
+            cls.temp_dir = tempfile.TemporaryDirectory()
+            path = os.path.join(cls.temp_dir.name, 'concurrency.sqlite3')
+            connection.ensure_connection()
+            with closing(sqlite3.connect(path)) as copy:
+                connection.connection.backup(copy)
+            cls.alias = 'concurrency'
+            connections.settings[cls.alias] = connections.configure_settings({
+                DEFAULT_DB_ALIAS: {},
+                cls.alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path,
+                            'OPTIONS': {'timeout': 30}},
+            })[cls.alias]
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.alias != DEFAULT_DB_ALIAS:
+            connections[cls.alias].close()
+            del connections[cls.alias]
+            del connections.settings[cls.alias]
+            cls.temp_dir.cleanup()
+        super().tearDownClass()
+
+    def test_no_lost_increments(self):
+        collection = Collection.objects.using(self.alias).create(title='Grocery')
+        product, = models.QuerySet(Product, using=self.alias).bulk_create([Product(
+            title='Bread', unit_price=4, effective_price=4, inventory=10,
+            collection_id=collection.id)])
+        cart = Cart.objects.using(self.alias).create()
+        items = CartItem.objects.db_manager(self.alias)
+        barrier = Barrier(self.threads)
+        errors = []
+
+        def add():
+            try:
+                barrier.wait()
+                for _ in range(self.adds_per_thread):
+                    items.add_quantity(cart.id, product.id, 1)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connections[self.alias].close()
+
+        workers = [Thread(target=add) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        item = items.get(cart_id=cart.id, product_id=product.id)
+        self.assertEqual(item.quantity, self.threads * self.adds_per_thread)
+
+
+class AddQuantityUpsertTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.bread = Product.objects.create(
+            title='Bread', unit_price=4, inventory=10, collection=collection)
+        cls.cart = Cart.objects.create()
+
+    def test_mysql_statement_qualifies_shared_columns(self):
+        # cart item and product both have an id, which MySQL rejects as
+        # ambiguous in ON DUPLICATE KEY UPDATE unless qualified
+        cursor = mock.MagicMock(rowcount=0)
+        with mock.patch.object(connection, 'vendor', 'mysql'), \
+                mock.patch.object(connection, 'cursor') as get_cursor:
+            get_cursor.return_value.__enter__.return_value = cursor
+            self.assertIsNone(CartItem.objects.add_quantity(self.cart.id, self.bread.id, 1))
+        sql = cursor.execute.call_args[0][0]
+        item, product = (connection.ops.quote_name(model._meta.db_table)
+                         for model in (CartItem, Product))
+        self.assertIn('SELECT %%s, %s.id, %%s FROM %s WHERE %s.id = %%s'
+                      % (product, product, product), sql)
+        self.assertIn('ON DUPLICATE KEY UPDATE '
+                      '{0}.id = IF({0}.quantity <= %s, LAST_INSERT_ID({0}.id), '
+                      '{0}.id + LAST_INSERT_ID(0)), '
+                      '{0}.quantity = IF({0}.quantity <= %s, {0}.quantity + %s, {0}.quantity)'
+                      .format(item), sql)
+
+    def test_mysql_full_item_is_rejected(self):
+        cursor = mock.MagicMock(rowcount=1, lastrowid=0)
+        with mock.patch.object(connection, 'vendor', 'mysql'), \
+                mock.patch.object(connection, 'cursor') as get_cursor:
+            get_cursor.return_value.__enter__.return_value = cursor
+            with self.assertRaises(QuantityLimitError):
+                CartItem.objects.add_quantity(self.cart.id, self.bread.id, 1)
+        self.assertEqual(cursor.execute.call_args[0][1][3:], [32766, 32766, 1])
+
+    def test_creates_then_increments(self):
+        first = CartItem.objects.add_quantity(self.cart.id, self.bread.id, 2)
+        second = CartItem.objects.add_quantity(self.cart.id, self.bread.id, 3)
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(CartItem.objects.get(pk=first.id).quantity, 5)
+        self.assertIsNone(CartItem.objects.add_quantity(self.cart.id, 0, 1))
+
+    def test_rejects_quantities_over_the_limit(self):
+        for returning in (True, False):
+            with self.subTest(returning=returning), \
+                    mock.patch.object(connection.features, 'can_return_columns_from_insert',
+                                      returning):
+                CartItem.objects.all().delete()
+                with self.assertRaises(QuantityLimitError):
+                    CartItem.objects.add_quantity(self.cart.id, self.bread.id, 32768)
+                CartItem.objects.add_quantity(self.cart.id, self.bread.id, 32000)
+                item = CartItem.objects.add_quantity(self.cart.id, self.bread.id, 767)
+                self.assertEqual(item.quantity, 32767)
+                with self.assertRaises(QuantityLimitError):
+                    CartItem.objects.add_quantity(self.cart.id, self.bread.id, 1)
+                self.assertEqual(CartItem.objects.get(pk=item.id).quantity, 32767)
+                self.assertIsNone(CartItem.objects.add_quantity(self.cart.id, 0, 1))
+
+    def test_api_rejects_quantities_over_the_limit(self):
+        CartItem.objects.create(cart=self.cart, product=self.bread, quantity=32000)
+        response = APIClient().post('/store/carts/%s/items/' % self.cart.cart_id,
+                                    {'product_id': self.bread.id, 'quantity': 1000})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('quantity', response.data)
+
+
+class BulkCartItemTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.products = Product.objects.bulk_create([
+            Product(title='Item %d' % i, unit_price=2, inventory=10, collection=collection)
+            for i in range(30)
+        ])
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.cart = Cart.objects.create()
+        self.url = '/store/carts/%s/items/bulk/' % self.cart.cart_id
+
+    def post(self, operations):
+        return self.client.post(self.url, operations, format='json')
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_restores_a_whole_cart_in_constant_queries(self):
+        operations = [{'product_id': p.id, 'quantity': 2} for p in self.products]
+        # cart id, product check, savepoint, cart lock, current items,
+        # insert, release, response
+        with self.assertNumQueries(8):
+            response = self.post(operations)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 30)
+        self.assertEqual(self.quantities(), {p.id: 2 for p in self.products})
+
+    def test_add_set_and_remove(self):
+        first, second, third = self.products[:3]
+        CartItem.objects.create(cart=self.cart, product=first, quantity=1)
+        CartItem.objects.create(cart=self.cart, product=second, quantity=1)
+        response = self.post([
+            {'op': 'add', 'product_id': first.id, 'quantity': 2},
+            {'op': 'remove', 'product_id': second.id},
+            {'op': 'set', 'product_id': third.id, 'quantity': 5},
+            {'op': 'add', 'product_id': third.id, 'quantity': 1},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {first.id: 3, third.id: 6})
+
+    def test_unknown_products_reject_the_whole_batch(self):
+        response = self.post([
+            {'product_id': self.products[0].id, 'quantity': 1},
+            {'product_id': 0, 'quantity': 1},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.quantities(), {})
+
+    def test_final_quantities_are_capped(self):
+        first, second = self.products[:2]
+        CartItem.objects.create(cart=self.cart, product=first, quantity=32000)
+        for operations in ([{'product_id': first.id, 'quantity': 1000}],
+                           [{'product_id': second.id, 'quantity': 20000},
+                            {'product_id': second.id, 'quantity': 20000}]):
+            response = self.post(operations)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(self.quantities(), {first.id: 32000})
+        response = self.post([{'product_id': first.id, 'quantity': 767},
+                              {'op': 'set', 'product_id': second.id, 'quantity': 32767}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {first.id: 32767, second.id: 32767})
+
+    def test_quantity_is_required_to_add(self):
+        response = self.post([{'product_id': self.products[0].id}])
+        self.assertEqual(response.status_code, 400)
+
+
+class CheckoutInventoryTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.bread, cls.milk = Product.objects.bulk_create([
+            Product(title='Bread', unit_price=4, inventory=5, collection=collection),
+            Product(title='Milk', unit_price=2, inventory=1, collection=collection),
+        ])
+        cls.user = get_user_model().objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret')
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create()
+
+    def checkout(self, **quantities):
+        for product, quantity in quantities.items():
+            CartItem.objects.create(
+                cart=self.cart, product=getattr(self, product), quantity=quantity)
+        return self.client.post('/store/orders/', {'cart_uuid': self.cart.cart_id})
+
+    def inventory(self):
+        return dict(Product.objects.values_list('title', 'inventory'))
+
+    def test_decrements_inventory(self):
+        response = self.checkout(bread=3, milk=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.inventory(), {'Bread': 2, 'Milk': 0})
+        self.assertEqual(
+            sorted(OrderItem.objects.values_list('product__title', 'quantity', 'unit_price')),
+            [('Bread', 3, Decimal('4.00')), ('Milk', 1, Decimal('2.00'))])
+        self.assertFalse(Cart.objects.filter(pk=self.cart.pk).exists())
+
+    def test_out_of_stock_lines_reject_the_order(self):
+        response = self.checkout(bread=3, milk=2)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['out_of_stock'], [
+            {'product_id': self.milk.id, 'requested': 2, 'available': 1}])
+        self.assertEqual(self.inventory(), {'Bread': 5, 'Milk': 1})
+        self.assertFalse(Order.objects.exists())
+        self.assertTrue(Cart.objects.filter(pk=self.cart.pk).exists())
+
+
+class OrderListQueryCountTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.products = Product.objects.bulk_create([
+            Product(title='Item %d' % i, unit_price=2, inventory=10, collection=collection)
+            for i in range(5)
+        ])
+        User = get_user_model()
+        cls.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret')
+        cls.staff = User.objects.create_user(
+            username='staff', email='staff@example.com', password='secret', is_staff=True)
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def place_orders(self, orders, items):
+        customer = Customer.objects.get(user=self.user)
+        for _ in range(orders):
+            order = Order.objects.create(customer=customer)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, quantity=1, unit_price=2)
+                for product in self.products[:items]
+            ])
+
+    def assertQueries(self, user, url, expected):
+        self.client.force_authenticate(user)
+        with self.assertNumQueries(expected):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_list_query_count_does_not_grow_with_orders_or_items(self):
+        for orders, items in [(1, 1), (10, 5)]:
+            self.place_orders(orders, items)
+            # customer, count, orders, items
+            self.assertQueries(self.user, '/store/orders/', 4)
+            # count, orders, items
+            self.assertQueries(self.staff, '/store/orders/', 3)
+            # customer, orders, items + products
+            response = self.assertQueries(
+                self.user, '/store/orders/?cursor=&expand=product', 3)
+            self.assertEqual(
+                response.data['results'][0]['items'][0]['product']['title'], 'Item 0')
+
+    def test_detail_query_count(self):
+        self.place_orders(1, 5)
+        order = Order.objects.get()
+        response = self.assertQueries(self.user, '/store/orders/%d/' % order.id, 3)
+        self.assertEqual(len(response.data['items']), 5)
+
+
+class TokenClaimsTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret')
+        cls.customer = Customer.objects.get(user=cls.user)
+        Order.objects.create(customer=cls.customer)
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def obtain_token(self):
+        response = self.client.post(
+            '/auth/jwt/create/', {'username': 'buyer', 'password': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_token_carries_customer_and_staff_claims(self):
+        access = AccessToken(self.obtain_token()['access'])
+        self.assertEqual(access['customer_id'], self.customer.id)
+        self.assertIs(access['is_staff'], False)
+
+    def test_refreshed_token_keeps_the_claims(self):
+        refresh = self.obtain_token()['refresh']
+        response = self.client.post('/auth/jwt/refresh/', {'refresh': refresh})
+        self.assertEqual(AccessToken(response.data['access'])['customer_id'], self.customer.id)
+
+    def test_orders_skip_user_and_customer_lookups(self):
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + self.obtain_token()['access'])
+        # count, orders, items
+        with self.assertNumQueries(3):
+            response = self.client.get('/store/orders/')
+        self.assertEqual(response.data['count'], 1)
+        with self.assertNumQueries(1):
+            response = self.client.get('/store/customers/me/')
+        self.assertEqual(response.data['user_id'], self.user.id)
+
+    def test_tokens_without_claims_fall_back_to_lookups(self):
+        self.client.credentials(
+            HTTP_AUTHORIZATION='JWT %s' % AccessToken.for_user(self.user))
+        # user, customer, count, orders, items
+        with self.assertNumQueries(5):
+            response = self.client.get('/store/orders/')
+        self.assertEqual(response.data['count'], 1)
+        # user, customer id, customer
+        with self.assertNumQueries(3):
+            response = self.client.get('/store/customers/me/')
+        self.assertEqual(response.data['user_id'], self.user.id)
+
+
+class AsyncCatalogViewTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.collection = Collection.objects.create(title='Grocery')
+        cls.products = Product.objects.bulk_create([
+            Product(title='Item %d' % i, slug='item-%d' % i, unit_price=i + 1,
+                    inventory=10, collection=cls.collection)
+            for i in range(15)
+        ])
+        cls.cart = Cart.objects.create()
+        CartItem.objects.create(cart=cls.cart, product=cls.products[0], quantity=2)
+
+    def get_async(self, url, **extra):
+        # AsyncClient takes raw header names, not META keys
+        headers = {key[5:].replace('_', '-').lower(): value for key, value in extra.items()}
+        with override_settings(ROOT_URLCONF='storefront.asgi_urls'):
+            return async_to_sync(self.async_client.get)(url, **headers)
+
+    def assertSameResponse(self, url, **extra):
+        expected = self.client.get(url, **extra)
+        response = self.get_async(url, **extra)
+        self.assertEqual(response.status_code, expected.status_code)
+        if expected['Content-Type'] == 'application/json':
+            # The browsable API embeds a fresh CSRF token in every page
+            self.assertEqual(response.content, expected.content)
+        for header in ('Content-Type', 'Allow', 'Vary', 'ETag', 'Last-Modified'):
+            self.assertEqual(response.get(header), expected.get(header), header)
+        return response
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=0)
+    def test_read_endpoints_match_the_sync_views(self):
+        urls = [
+            '/store/products/',
+            '/store/products/?page=2',
+            '/store/products/?page=last&ordering=-unit_price',
+            '/store/products/?collection_id=%d&unit_price__gt=3' % self.collection.id,
+            '/store/products/?search=item',
+            '/store/products/%d/' % self.products[0].id,
+            '/store/collections/',
+            '/store/carts/%s/' % self.cart.cart_id,
+        ]
+        # The async views never call the sync actions
+        with mock.patch.object(ProductViewSet, 'list', side_effect=AssertionError), \
+                mock.patch.object(ProductViewSet, 'retrieve', side_effect=AssertionError), \
+                mock.patch.object(CollectionViewSet, 'list', side_effect=AssertionError), \
+                mock.patch.object(CartViewSet, 'retrieve', side_effect=AssertionError):
+            for url in urls:
+                with self.subTest(url=url):
+                    expected = self.get_async(url)
+                    self.assertEqual(expected.status_code, 200)
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertSameResponse(url)
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=0)
+    def test_other_requests_fall_back_to_the_sync_views(self):
+        for url in ['/store/products/?cursor=',
+                    '/store/products/?page=9',
+                    '/store/products/?unit_price__gt=abc',
+                    '/store/products/0/',
+                    '/store/products/abc/',
+                    '/store/carts/not-a-uuid/',
+                    '/store/products/?format=api']:
+            with self.subTest(url=url):
+                self.assertSameResponse(url)
+        self.assertSameResponse('/store/products/', HTTP_ACCEPT='text/html')
+        self.assertSameResponse('/store/products/', HTTP_AUTHORIZATION='JWT invalid')
+        with override_settings(ROOT_URLCONF='storefront.asgi_urls'):
+            response = async_to_sync(self.async_client.post)(
+                '/store/products/', {'title': 'New'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_cache_and_conditional_get(self):
+        url = '/store/products/%d/' % self.products[0].id
+        first = self.get_async(url)
+        self.assertEqual(first['X-Cache'], 'MISS')
+        second = self.get_async(url)
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.content, first.content)
+        response = self.get_async(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_fallback_counts_one_cache_miss(self):
+        reset_cache_stats()
+        self.assertEqual(self.get_async('/store/products/?page=9').status_code, 404)
+        self.assertEqual(get_cache_stats()['products'], {'miss': 1})
+
+    def test_errors_are_not_hidden_by_the_fallback(self):
+        url = '/store/products/%d/' % self.products[0].id
+        with mock.patch.object(ProductViewSet, 'get_serializer', side_effect=TypeError):
+            with self.assertRaises(TypeError):
+                self.get_async(url)
+
+    def test_asgi_application_uses_them_only_when_enabled(self):
+        for enabled in (False, True):
+            with self.subTest(enabled=enabled), \
+                    override_settings(ASYNC_READ_VIEWS=enabled, CATALOG_CACHE_TIMEOUT=0), \
+                    mock.patch.object(AsyncReadView, 'respond', autospec=True,
+                                      side_effect=AsyncReadView.respond) as respond:
+                status, _, body = asgi_get('/store/products/')
+                self.assertEqual(status, 200)
+                self.assertEqual(json.loads(body)['count'], 15)
+                self.assertEqual(respond.called, enabled)
+
+
+class ImportCatalogTests(StoreTestCase):
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        return path
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        call_command('import_catalog', 'collections', self.write(
+            'collections.csv', 'id,title\n1,Grocery\n2,Beauty\n'), stdout=StringIO())
+
+    def import_products(self, content, **options):
+        path = self.write('products.jsonl', content)
+        call_command('import_catalog', 'products', path, stdout=StringIO(), **options)
+        return path
+
+    def test_upserts_by_slug(self):
+        Promotion.objects.create(id=7, description='Sale', discount=0.1)
+        lines = [
+            '{"slug": "bread", "title": "Bread", "unit_price": "2.50", "inventory": 3, '
+            '"collection_id": 1, "promotions": [7]}',
+            '{"slug": "soap", "title": "Soap", "unit_price": 1, "inventory": 9, '
+            '"collection_id": 1}',
+        ]
+        self.import_products('\n'.join(lines), key='slug')
+        bread = Product.objects.get(slug='bread')
+        self.assertEqual(list(bread.promotions.values_list('id', flat=True)), [7])
+        self.assertEqual(bread.effective_price, Decimal('2.25'))
+        self.assertEqual(Collection.objects.get(pk=1).product_count, 2)
+
+        # Moving soap to another collection updates the row and both counts
+        self.import_products(lines[1].replace('"collection_id": 1', '"collection_id": 2'),
+                             key='slug')
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(Product.objects.get(slug='soap').collection_id, 2)
+        self.assertEqual(
+            dict(Collection.objects.values_list('id', 'product_count')), {1: 1, 2: 1})
+        response = APIClient().get('/store/products/?search=soap')
+        self.assertEqual([p['title'] for p in response.data['results']], ['Soap'])
+
+    def test_csv_by_id_and_bad_rows(self):
+        path = self.write('products.csv',
+                          'id,title,description,unit_price,inventory,collection_id\n'
+                          '5,Bread,,2.50,3,1\n'
+                          '5,Brown bread,,2.75,3,1\n'
+                          '6,Soap,,abc,9,1\n')
+        with self.assertRaisesMessage(CommandError, 'Row 3: invalid value'):
+            call_command('import_catalog', 'products', path, stdout=StringIO())
+        self.assertFalse(Product.objects.exists())
+
+        with self.assertRaisesMessage(CommandError, 'Row 1: missing'):
+            self.import_products('{"title": "Bread", "unit_price": 1, "inventory": 1, '
+                                 '"collection_id": 1}')
+
+    def test_rejects_discounts_out_of_range(self):
+        for discount in ('1.5', '-0.1'):
+            path = self.write('promotions.csv', 'id,description,discount\n'
+                              '1,Sale,0.2\n2,Typo,%s\n' % discount)
+            with self.assertRaisesMessage(CommandError, 'Row 2: invalid value'):
+                call_command('import_catalog', 'promotions', path, '--restart',
+                             stdout=StringIO())
+        self.assertFalse(Promotion.objects.exists())
+        with self.assertRaises(ValidationError):
+            Promotion(description='Typo', discount=1.5).full_clean()
+
+    def test_resumes_from_checkpoint(self):
+        content = '\n'.join(
+            '{"id": %d, "title": "Item %d", "unit_price": 1, "inventory": 1, '
+            '"collection_id": 1}' % (i, i) for i in range(1, 6))
+        with mock.patch('app.management.commands.import_catalog.index_products',
+                        side_effect=[None, RuntimeError('interrupted')]):
+            with self.assertRaises(RuntimeError):
+                self.import_products(content, batch_size=2)
+        self.assertEqual(Product.objects.count(), 2)
+
+        out = StringIO()
+        call_command('import_catalog', 'products',
+                     os.path.join(self.directory.name, 'products.jsonl'),
+                     batch_size=2, stdout=out)
+        self.assertIn('Resuming after row 2.', out.getvalue())
+        self.assertIn('Imported 3 products', out.getvalue())
+        self.assertEqual(Product.objects.count(), 5)
+        self.assertEqual(Collection.objects.get(pk=1).product_count, 5)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory.name, 'products.jsonl.checkpoint')))
+
+
+class GenerateDatasetTests(StoreTestCase):
+    def test_generates_consistent_rows(self):
+        call_command('generate_dataset', collections=3, products=200, customers=20,
+                     orders=50, carts=5, reviews=30, batch_size=64, search_index=True,
+                     stdout=StringIO())
+        self.assertEqual(Product.objects.count(), 200)
+        self.assertEqual(Customer.objects.count(), 20)
+        self.assertEqual(Order.objects.count(), 50)
+        self.assertTrue(OrderItem.objects.exists())
+        self.assertEqual(
+            sum(Collection.objects.values_list('product_count', flat=True)), 200)
+        self.assertGreater(
+            len(set(Order.objects.values_list('placed_at', flat=True))), 1)
+        # auto_now is back on once the command is done
+        self.assertTrue(Product._meta.get_field('last_updated').auto_now)
+        self.assertTrue(Order._meta.get_field('placed_at').auto_now_add)
+        response = APIClient().get('/store/products/?search=%s' % Product.objects.first().title)
+        self.assertGreaterEqual(response.data['count'], 1)
+
+    def test_rows_are_dated_before_until(self):
+        call_command('generate_dataset', collections=2, products=50, customers=5,
+                     orders=10, carts=2, reviews=40, until=date(2025, 1, 1),
+                     stdout=StringIO())
+        self.assertTrue(Product.objects.filter(stars_5__gt=0).exists())
+        self.assertLessEqual(
+            Product.objects.aggregate(Max('last_updated'))['last_updated__max'],
+            datetime(2025, 1, 1, tzinfo=timezone.utc))
+
+
+class RequestMetricsTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.staff = User.objects.create_user(
+            username='staff', email='staff@example.com', password='secret', is_staff=True)
+        cls.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret')
+        Collection.objects.create(title='Grocery')
+
+    def setUp(self):
+        super().setUp()
+        request_metrics.reset()
+        self.client = APIClient()
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/store/collections/')
+        timing = response['Server-Timing']
+        self.assertIn('desc="%d queries"' % len(queries.captured_queries), timing)
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", serialize;dur=[\d.]+, '
+                                 r'render;dur=[\d.]+, total;dur=[\d.]+$')
+
+    def test_serialize_time(self):
+        def timings(path):
+            header = self.client.get(path)['Server-Timing']
+            return {name: float(ms) for name, ms in re.findall(r'(\w+);dur=([\d.]+)', header)}
+
+        def slowly(function):
+            def slow(*args):
+                time.sleep(0.01)
+                return function(*args)
+            return slow
+
+        cart = Cart.objects.create()
+        for title in ('Bread', 'Milk'):
+            CartItem.objects.create(cart=cart, quantity=1, product=Product.objects.create(
+                title=title, unit_price=1, inventory=1, collection=Collection.objects.get()))
+        with mock.patch.object(ModelSerializer, 'to_representation', autospec=True,
+                               side_effect=slowly(ModelSerializer.to_representation)), \
+                mock.patch.object(ProductSerializer, 'represent_values',
+                                  side_effect=slowly(ProductSerializer.represent_values)):
+            for path in ('/store/collections/', '/store/products/',
+                         '/store/carts/%s/' % cart.cart_id):
+                with self.subTest(path=path):
+                    timing = timings(path)
+                    self.assertGreaterEqual(timing['serialize'], 10)
+                    # The cart's items and their products are timed with it
+                    self.assertLess(timing['serialize'], timing['total'])
+        self.client.force_authenticate(self.staff)
+        routes = self.client.get('/store/stats/').data['routes']
+        self.assertGreaterEqual(routes['GET collection-list']['serialize_ms']['mean'], 10)
+
+    def test_stats_are_staff_only(self):
+        self.assertEqual(self.client.get('/store/stats/').status_code, 401)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/store/stats/').status_code, 403)
+
+    def test_stats_per_route(self):
+        for _ in range(3):
+            self.client.get('/store/collections/')
+        self.client.get('/store/products/')
+        self.client.force_authenticate(self.staff)
+        routes = self.client.get('/store/stats/').data['routes']
+        self.assertEqual(routes['GET collection-list']['count'], 3)
+        self.assertEqual(routes['GET collection-list']['queries']['max'], 3)
+        self.assertEqual(sum(routes['GET collection-list']['histogram'].values()), 3)
+        self.assertEqual(routes['GET product-list']['count'], 1)
+
+        self.assertEqual(self.client.delete('/store/stats/').status_code, 204)
+        # Only the reset itself is left
+        self.assertEqual(list(self.client.get('/store/stats/').data['routes']),
+                         ['DELETE stats'])
+
+    def test_old_minutes_leave_the_window(self):
+        with mock.patch('app.middleware.time.time', return_value=time.time() - 20 * 60):
+            self.client.get('/store/collections/')
+        self.assertEqual(request_metrics.snapshot(), {})
+        self.client.get('/store/collections/')
+        self.assertEqual(request_metrics.snapshot()['GET collection-list']['count'], 1)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ProductListFastPathTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        titles = ['Crème brûlée', 'Quote " and \\ slash', 'Tab\tand\nnewline',
+                  'Line\u2028separator\u2029', 'Emoji \U0001F35E', 'Control \x01 char']
+        Product.objects.bulk_create([
+            # x.x5 prices put price_with_tax on a rounding half
+            Product(title='%s %d' % (titles[i % len(titles)], i),
+                    description=None if i % 4 == 0 else 'Product %d' % i,
+                    unit_price=Decimal(i * 37 % 2000 + 5) / 10 + Decimal('0.05'),
+                    inventory=i, collection=collection,
+                    stars_1=i % 3, stars_3=i % 2, stars_4=i % 7, stars_5=i)
+            for i in range(30)
+        ])
+
+    def get_both(self, url):
+        fast = APIClient().get(url)
+        with mock.patch('app.fastlist.ValuesListMixin.list', ListModelMixin.list), \
+                mock.patch.object(ProductViewSet, 'renderer_classes',
+                                  [JSONRenderer, BrowsableAPIRenderer]):
+            slow = APIClient().get(url)
+        self.assertEqual(fast.status_code, 200)
+        self.assertEqual(fast.content, slow.content)
+        return fast
+
+    def test_matches_the_serializer_byte_for_byte(self):
+        for url in ['/store/products/', '/store/products/?page=3',
+                    '/store/products/?ordering=-unit_price',
+                    '/store/products/?unit_price__gt=50&collection_id=%d'
+                    % Collection.objects.get().id,
+                    '/store/products/?search=product']:
+            with self.subTest(url=url):
+                self.get_both(url)
+
+    def test_keyset_pages_match(self):
+        for url in ['/store/products/?cursor=', '/store/products/?cursor=&ordering=last_updated',
+                    '/store/products/?cursor=&search=product']:
+            with self.subTest(url=url):
+                while url:
+                    url = self.get_both(url).data['next']
+
+    def test_add_tax_rounds_like_the_float_rate(self):
+        for cents in range(0, 20000):
+            price = Decimal(cents) / 100
+            self.assertEqual(add_tax(price, Decimal('0.1')), round(price * Decimal(1.1), 2))
+
+    @skipUnless(orjson, 'orjson is not installed')
+    def test_fast_renderer_matches_json_renderer(self):
+        data = {'text': ''.join(map(chr, range(0, 0x3000))), 'number': Decimal('12.30'),
+                'float': 0.1, 'big': 2 ** 70, 'list': [None, True, (1, 2)],
+                'when': timezone.now(), 'id': uuid4()}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render({1: 'int key'}),
+                         JSONRenderer().render({1: 'int key'}))
+
+
+class TaxRateTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.food = Collection.objects.create(title='Food')
+        cls.books = Collection.objects.create(title='Books')
+        cls.bread = Product.objects.create(
+            title='Bread', unit_price=Decimal('2.05'), inventory=10, collection=cls.food)
+        cls.novel = Product.objects.create(
+            title='Novel', unit_price=Decimal('10.00'), inventory=10, collection=cls.books)
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def prices(self, **params):
+        response = self.client.get('/store/products/', params)
+        self.assertEqual(response.status_code, 200)
+        return {product['id']: product['price_with_tax'] for product in response.data['results']}
+
+    def add_rate(self, rate, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return TaxRate.objects.create(rate=Decimal(rate), **kwargs)
+
+    def test_most_specific_rate_wins(self):
+        self.add_rate('0.2', collection=self.food)
+        self.add_rate('0.19', region='DE')
+        self.add_rate('0.07', collection=self.food, region='DE')
+        self.assertEqual(self.prices(), {self.bread.id: 2.46, self.novel.id: 11.0})
+        self.assertEqual(self.prices(region='DE'), {self.bread.id: 2.19, self.novel.id: 11.9})
+        self.assertEqual(self.prices(region='FR'), {self.bread.id: 2.46, self.novel.id: 11.0})
+        response = self.client.get('/store/products/%d/' % self.bread.id, {'region': 'DE'})
+        self.assertEqual(response.data['price_with_tax'], Decimal('2.19'))
+
+    def test_collection_rate_for_another_region_falls_back(self):
+        self.add_rate('0.07', collection=self.food, region='DE')
+        self.add_rate('0.19', region='FR')
+        self.assertEqual(self.prices(), {self.bread.id: 2.26, self.novel.id: 11.0})
+        self.assertEqual(self.prices(region='FR'), {self.bread.id: 2.44, self.novel.id: 11.9})
+        self.assertEqual(self.prices(region='DE'), {self.bread.id: 2.19, self.novel.id: 11.0})
+        response = self.client.get('/store/products/%d/' % self.bread.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['price_with_tax'], Decimal('2.26'))
+
+    def test_orders_and_filters_by_price_with_tax(self):
+        self.add_rate('1.5', collection=self.food)
+        self.assertEqual(list(self.prices(ordering='-price_with_tax')),
+                         [self.novel.id, self.bread.id])
+        self.assertEqual(list(self.prices(ordering='price_with_tax', price_with_tax__gt=6)),
+                         [self.novel.id])
+        self.assertEqual(list(self.prices(price_with_tax__lt=6)), [self.bread.id])
+        response = self.client.get('/store/products/?cursor=&ordering=price_with_tax')
+        self.assertEqual([product['id'] for product in response.data['results']],
+                         [self.bread.id, self.novel.id])
+
+    def test_database_rounds_like_python(self):
+        self.add_rate('0.0725')
+        Product.objects.bulk_create([
+            Product(title='Item %d' % cents, unit_price=Decimal(cents) / 100,
+                    inventory=1, collection=self.food)
+            for cents in range(0, 100000, 347)
+        ])
+        rows = with_price_with_tax(Product.objects.all()) \
+            .values_list('unit_price', 'price_with_tax')
+        for unit_price, price_with_tax in rows:
+            self.assertEqual(price_with_tax, add_tax(unit_price, Decimal('0.0725')))
+
+    def test_rate_changes_reach_cached_responses(self):
+        url = '/store/products/%d/' % self.bread.id
+        with CaptureQueriesContext(connection) as context:
+            before = self.client.get(url)
+            self.assertEqual(self.client.get(url)['X-Cache'], 'HIT')
+            self.client.get('/store/products/')
+            self.client.get('/store/products/?ordering=price_with_tax')
+        # The rates are loaded once per process
+        self.assertEqual(sum('app_taxrate' in query['sql']
+                             for query in context.captured_queries), 1)
+
+        rate = self.add_rate('0.2', collection=self.food)
+        after = self.client.get(url, HTTP_IF_NONE_MATCH=before['ETag'])
+        self.assertEqual(after.status_code, 200)
+        self.assertEqual(after.data['price_with_tax'], Decimal('2.46'))
+        self.assertEqual(self.prices()[self.novel.id], 11.0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rate.delete()
+        self.assertEqual(self.client.get(url).data['price_with_tax'], Decimal('2.26'))
+
+
+    def test_checks_the_database_for_missed_changes(self):
+        self.assertEqual(get_rate(self.food.id), Decimal('0.10'))
+        # Never committed, so the generation isn't bumped. The same as a
+        # process that didn't see the bump.
+        TaxRate.objects.create(rate=Decimal('0.2'), collection=self.food)
+        with self.settings(TAX_RATES_CHECK_SECONDS=60), self.assertNumQueries(0):
+            self.assertEqual(get_rate(self.food.id), Decimal('0.10'))
+        with self.settings(TAX_RATES_CHECK_SECONDS=0):
+            self.assertEqual(get_rate(self.food.id), Decimal('0.2'))
+            # Up to date, only the check
+            with self.assertNumQueries(1):
+                self.assertEqual(get_rate(self.food.id), Decimal('0.2'))
+
+class PurgeCartsTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.product = Product.objects.create(
+            title='Milk', unit_price=Decimal('2.50'), inventory=10, collection=collection)
+        cls.old = Cart.objects.bulk_create([Cart() for _ in range(5)])
+        cls.recent = Cart.objects.create()
+        for cart in [*cls.old, cls.recent]:
+            CartItem.objects.create(cart=cart, product=cls.product, quantity=1)
+        Cart.objects.filter(pk__in=[cart.pk for cart in cls.old]).update(
+            created_at=timezone.now() - timedelta(days=40))
+
+    def purge(self, **options):
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('purge_carts', stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_deletes_old_carts_in_batches(self):
+        Cart.objects.get_pk(self.old[0].cart_id)
+        with CaptureQueriesContext(connection) as queries:
+            output = self.purge(days=30, batch_size=2)
+        self.assertIn('Deleted 5 carts and 5 items', output)
+        self.assertEqual(list(Cart.objects.all()), [self.recent])
+        self.assertEqual(CartItem.objects.get().cart, self.recent)
+        self.assertIsNone(Cart.objects.get_pk(self.old[0].cart_id))
+        # Three batches of a select and two deletes, and the empty select
+        deletes = [query for query in queries.captured_queries
+                   if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 6)
+
+    def test_many_small_batches(self):
+        old = Cart.objects.bulk_create([Cart() for _ in range(1200)])
+        Cart.objects.filter(pk__in=[cart.pk for cart in old]).update(
+            created_at=timezone.now() - timedelta(days=35))
+        with CaptureQueriesContext(connection) as queries:
+            output = self.purge(days=30, batch_size=1)
+        self.assertIn('Deleted 1205 carts and 5 items', output)
+        self.assertEqual(list(Cart.objects.all()), [self.recent])
+        # Each batch's select has the same two bounds, not one more per batch
+        selects = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('SELECT') and 'created_at' in query['sql']]
+        self.assertEqual(selects[-1].count('"created_at" >'), 1)
+
+    def test_dry_run(self):
+        output = self.purge(days=30, dry_run=True)
+        self.assertIn('Would delete 5 carts and 5 items', output)
+        self.assertEqual(Cart.objects.count(), 6)
+
+
+class ReviewRatingTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.milk, cls.bread = Product.objects.bulk_create([
+            Product(title=title, unit_price=Decimal('2.50'), inventory=10, collection=collection)
+            for title in ['Milk', 'Bread']])
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.reviews = '/store/products/%d/reviews/' % self.milk.id
+
+    def write(self, method, url, data=None):
+        # The invalidation of cached product responses runs on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            return getattr(self.client, method)(url, data)
+
+    def review(self, rating):
+        response = self.write(
+            'post', self.reviews, {'name': 'Ann', 'description': 'Good', 'rating': rating})
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def rating(self, product):
+        return self.client.get('/store/products/%d/' % product.id).data['rating']
+
+    def test_counts_follow_creates_updates_and_deletes(self):
+        self.assertEqual(self.rating(self.milk), {
+            'count': 0, 'average': None,
+            'histogram': {'1': 0, '2': 0, '3': 0, '4': 0, '5': 0}})
+        first = self.review(5)
+        self.review(4)
+        self.review(4)
+        self.assertEqual(self.rating(self.milk), {
+            'count': 3, 'average': 4.33,
+            'histogram': {'1': 0, '2': 0, '3': 0, '4': 2, '5': 1}})
+
+        self.write('patch', self.reviews + '%d/' % first, {'rating': 1})
+        self.write('patch', self.reviews + '%d/' % first, {'description': 'Sour'})
+        self.assertEqual(self.rating(self.milk)['histogram'],
+                         {'1': 1, '2': 0, '3': 0, '4': 2, '5': 0})
+        self.write('delete', self.reviews + '%d/' % first)
+        self.assertEqual(self.rating(self.milk)['average'], 4.0)
+        review = Review.objects.get(pk=self.review(2))
+        review.product = self.bread
+        with self.captureOnCommitCallbacks(execute=True):
+            review.save()
+        self.assertEqual(self.rating(self.milk)['count'], 2)
+        self.assertEqual(self.rating(self.bread)['histogram']['2'], 1)
+
+    def test_rating_is_required_and_bounded(self):
+        for rating in ['', 0, 6]:
+            response = self.client.post(
+                self.reviews, {'name': 'Ann', 'description': 'Good', 'rating': rating})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('rating', response.data)
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=0)
+    def test_list_and_detail_need_no_extra_queries(self):
+        self.review(3)
+        self.rating(self.bread)
+        # ETag aggregate, page count, page rows
+        with self.assertNumQueries(3):
+            response = self.client.get('/store/products/')
+        self.assertEqual(response.data['results'][1]['rating']['count'], 1)
+        # ETag, product
+        with self.assertNumQueries(2):
+            self.client.get('/store/products/%d/' % self.milk.id)
+
+    def test_deleting_the_product_skips_the_counts(self):
+        self.review(5)
+        with CaptureQueriesContext(connection) as queries:
+            self.milk.delete()
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith('UPDATE "app_product"')])
+
+    def test_rebuild_ratings(self):
+        self.review(5)
+        self.review(1)
+        Review.objects.create(product=self.bread, name='Old', description='No rating')
+        Product.objects.filter(pk=self.milk.pk).update(stars_5=7)
+        stdout = StringIO()
+        call_command('rebuild_ratings', batch_size=1, stdout=stdout)
+        self.assertIn('Repaired 1 drifted products out of 2.', stdout.getvalue())
+        self.assertEqual(Product.objects.get(pk=self.milk.pk).star_counts, [1, 0, 0, 0, 1])
+        self.assertEqual(Product.objects.get(pk=self.bread.pk).star_counts, [0, 0, 0, 0, 0])
+
+
+class DailySalesTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.grocery, cls.beauty = Collection.objects.bulk_create(
+            [Collection(title='Grocery'), Collection(title='Beauty')])
+        cls.milk, cls.bread, cls.soap = Product.objects.bulk_create([
+            Product(title='Milk', unit_price=2, inventory=10, collection=cls.grocery),
+            Product(title='Bread', unit_price=3, inventory=10, collection=cls.grocery),
+            Product(title='Soap', unit_price=5, inventory=10, collection=cls.beauty)])
+        User = get_user_model()
+        cls.customer = Customer.objects.get(user=User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret'))
+        cls.staff = User.objects.create_user(
+            username='staff', email='staff@example.com', password='secret', is_staff=True)
+        cls.today = timezone.localdate()
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def place_order(self, days_ago, lines):
+        order = Order.objects.create(customer=self.customer)
+        Order.objects.filter(pk=order.pk).update(
+            placed_at=timezone.now() - timedelta(days=days_ago))
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=quantity, unit_price=price)
+            for product, quantity, price in lines])
+        return Order.objects.get(pk=order.pk)
+
+    def complete(self, order, status=Order.PS_COMPLETE):
+        response = self.client.patch('/store/orders/%d/' % order.id, {'payment_status': status})
+        self.assertEqual(response.status_code, 200)
+
+    def rollup(self):
+        return sorted(DailySales.objects.values_list(
+            'day', 'product_id', 'collection_id', 'units', 'revenue'))
+
+    def test_completed_orders_roll_up_incrementally(self):
+        first = self.place_order(0, [(self.milk, 2, 2), (self.soap, 1, 5)])
+        second = self.place_order(0, [(self.milk, 1, Decimal('2.50'))])
+        self.assertEqual(self.rollup(), [])
+        self.complete(first)
+        self.complete(second)
+        self.complete(second)
+        self.assertEqual(self.rollup(), [
+            (self.today, self.milk.id, self.grocery.id, 3, Decimal('6.50')),
+            (self.today, self.soap.id, self.beauty.id, 1, Decimal('5.00'))])
+        self.complete(first, Order.PS_FAILED)
+        self.assertEqual(self.rollup()[0][3:], (1, Decimal('2.50')))
+
+    def test_backfill_matches_the_incremental_rollup(self):
+        for days_ago in [0, 1, 1, 3]:
+            self.complete(self.place_order(
+                days_ago, [(self.milk, days_ago + 1, 2), (self.bread, 1, 3)]))
+        self.place_order(1, [(self.soap, 4, 5)])
+        incremental = self.rollup()
+        DailySales.objects.all().delete()
+        stdout = StringIO()
+        call_command('backfill_sales', stdout=stdout)
+        self.assertIn('Rebuilt 4 days', stdout.getvalue())
+        self.assertEqual(self.rollup(), incremental)
+        call_command('backfill_sales', since=self.today, stdout=stdout)
+        self.assertEqual(self.rollup(), incremental)
+
+    def test_reports(self):
+        self.complete(self.place_order(0, [(self.milk, 5, 2), (self.soap, 1, 5)]))
+        self.complete(self.place_order(2, [(self.bread, 3, 3), (self.soap, 1, 5)]))
+        self.complete(self.place_order(10, [(self.bread, 10, 3)]))
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/store/reports/top-products/')
+        self.assertEqual([(row['title'], row['units'], row['revenue'])
+                          for row in response.data['results']],
+                         [(self.milk.title, 5, 10), (self.soap.title, 2, 10),
+                          (self.bread.title, 3, 9)])
+        response = self.client.get('/store/reports/top-products/?by=units&limit=1&since=%s'
+                                   % (self.today - timedelta(days=30)))
+        self.assertEqual(response.data['results'][0]['title'], self.bread.title)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                '/store/reports/sales/?group_by=collection&collection_id=%d' % self.beauty.id)
+        self.assertEqual(response.data['results'], [
+            {'day': self.today - timedelta(days=2), 'collection_id': self.beauty.id,
+             'units': 1, 'revenue': 5},
+            {'day': self.today, 'collection_id': self.beauty.id, 'units': 1, 'revenue': 5}])
+        response = self.client.get('/store/reports/sales/?since=%s&until=%s' % (
+            self.today - timedelta(days=10), self.today - timedelta(days=10)))
+        self.assertEqual(response.data['results'], [
+            {'day': self.today - timedelta(days=10), 'units': 10, 'revenue': 30}])
+
+    def test_reports_are_staff_only_and_validate(self):
+        self.assertEqual(self.client.get('/store/reports/sales/?since=tomorrow').status_code, 400)
+        self.assertEqual(self.client.get('/store/reports/top-products/?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/store/reports/sales/?since=%s&until=%s' % (
+            self.today, self.today - timedelta(days=1))).status_code, 400)
+        self.client.force_authenticate(self.customer.user)
+        self.assertEqual(self.client.get('/store/reports/sales/').status_code, 403)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTests(SimpleTestCase):
+    def route(self, request):
+        routes = {}
+
+        def get_response(request):
+            routes.update(
+                product=router.db_for_read(Product), order=router.db_for_read(Order),
+                customer=router.db_for_read(Customer), write=router.db_for_write(Product))
+            return HttpResponse()
+        response = ReplicaMiddleware(get_response)(request)
+        return routes, response
+
+    def test_safe_catalog_reads_use_the_replicas(self):
+        routes, response = self.route(RequestFactory().get('/store/products/'))
+        self.assertEqual(routes, {'product': 'replica', 'order': 'replica',
+                                  'customer': 'default', 'write': 'default'})
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+        self.assertEqual(router.db_for_read(Product), 'default')
+
+    def test_writers_read_from_the_primary_for_a_while(self):
+        routes, response = self.route(RequestFactory().post('/store/carts/'))
+        self.assertEqual(routes['product'], 'default')
+        self.assertEqual(response.cookies[STICKY_COOKIE]['max-age'], 5)
+        request = RequestFactory().get('/store/products/')
+        request.COOKIES[STICKY_COOKIE] = '1'
+        self.assertEqual(self.route(request)[0]['product'], 'default')
+
+    def test_transactions_read_from_the_primary(self):
+        with mock.patch.object(connections['default'], 'in_atomic_block', True):
+            routes, _ = self.route(RequestFactory().get('/store/products/'))
+        self.assertEqual(routes['product'], 'default')
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas_everything_uses_the_primary(self):
+        routes, response = self.route(RequestFactory().post('/store/carts/'))
+        self.assertEqual(set(routes.values()), {'default'})
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+
+@skipUnless('replica' in settings.DATABASE_REPLICAS,
+            'Needs a replica alias, e.g. SQLITE_REPLICA=1 with the dev settings')
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_requests(self):
+        collection = Collection.objects.create(title='Grocery')
+        Product.objects.create(title='Milk', unit_price=2, inventory=10, collection=collection)
+        client = APIClient()
+        with CaptureQueriesContext(connections['replica']) as replica, \
+                CaptureQueriesContext(connections['default']) as primary:
+            self.assertEqual(client.get('/store/products/').data['count'], 1)
+        self.assertTrue(replica.captured_queries)
+        self.assertFalse(primary.captured_queries)
+
+        self.assertEqual(client.post('/store/carts/').status_code, 201)
+        with CaptureQueriesContext(connections['replica']) as replica:
+            client.get('/store/collections/')
+        self.assertFalse(replica.captured_queries)
+
+
+class OrderExportTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.milk, cls.bread = Product.objects.bulk_create([
+            Product(title=title, unit_price=2, inventory=10, collection=collection)
+            for title in ['Milk', 'Bread']])
+        User = get_user_model()
+        cls.customer = Customer.objects.get(user=User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret'))
+        cls.staff = User.objects.create_user(
+            username='staff', email='staff@example.com', password='secret', is_staff=True)
+        cls.orders = Order.objects.bulk_create([
+            Order(customer=cls.customer, payment_status=status) for status in 'CPCF'])
+        Order.objects.filter(pk=cls.orders[0].pk).update(
+            placed_at=timezone.now() - timedelta(days=10))
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=i + 1, unit_price=Decimal('2.50'))
+            for i, order in enumerate(cls.orders[:3]) for product in [cls.milk, cls.bread]])
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def export(self, query=''):
+        response = self.client.get('/store/orders/export/' + query)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_has_a_row_per_item(self):
+        rows = self.export().splitlines()
+        self.assertEqual(rows[0], 'order_id,placed_at,customer_id,payment_status,'
+                                  'item_id,product_id,quantity,unit_price')
+        self.assertEqual(len(rows), 1 + 6 + 1)
+        self.assertEqual(rows[-1].split(',')[-4:], ['', '', '', ''])
+        self.assertEqual(rows[1].split(',')[-2:], ['1', '2.50'])
+
+    def test_jsonl_filters(self):
+        lines = self.export('?output=jsonl&payment_status=C&since=%s' % timezone.localdate())
+        orders = [json.loads(line) for line in lines.splitlines()]
+        self.assertEqual([order['id'] for order in orders], [self.orders[2].id])
+        self.assertEqual(orders[0]['items'][0], {
+            'id': orders[0]['items'][0]['id'], 'product': self.milk.id,
+            'quantity': 3, 'unit_price': 2.5})
+
+    def test_queries_per_chunk(self):
+        # orders and items for each chunk of 2, and the empty last chunk
+        with self.assertNumQueries(2 + 2 + 1):
+            lines = list(export_lines('jsonl', chunk_size=2))
+        self.assertEqual(len(lines), 4)
+
+    def test_staff_only(self):
+        self.client.force_authenticate(self.customer.user)
+        self.assertEqual(self.client.get('/store/orders/export/').status_code, 403)
+
+    def test_streams_under_asgi(self):
+        # The rows are read while the response is sent, outside the view
+        from storefront.asgi import StorefrontASGIHandler
+        token = AccessToken.for_user(self.staff)
+        with mock.patch.object(StorefrontASGIHandler, 'stream_block_size', 100):
+            status, headers, body = asgi_get(
+                '/store/orders/export/', 'output=csv', [('authorization', 'JWT %s' % token)])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'Content-Type'], b'text/csv')
+        self.assertEqual(body.decode(), self.export())
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command('export_orders', format='csv', payment_status='P', stdout=stdout)
+        self.assertEqual(len(stdout.getvalue().splitlines()), 1 + 2)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'orders.jsonl')
+            call_command('export_orders', format='jsonl', output=path, chunk_size=1)
+            with open(path) as file:
+                self.assertEqual(len(file.readlines()), 4)
+
+
+class PaymentStatusBulkTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        product = Product.objects.create(
+            title='Milk', unit_price=2, inventory=10, collection=collection)
+        User = get_user_model()
+        cls.customer = Customer.objects.get(user=User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret'))
+        cls.staff = User.objects.create_user(
+            username='staff', email='staff@example.com', password='secret', is_staff=True)
+        cls.orders = Order.objects.bulk_create([
+            Order(customer=cls.customer, payment_status=status) for status in 'PPPCF'])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=2, unit_price=2)
+            for order in cls.orders])
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def statuses(self):
+        return ''.join(Order.objects.order_by('id').values_list('payment_status', flat=True))
+
+    def test_applies_allowed_transitions_with_per_id_outcomes(self):
+        pending, other, third, complete, failed = [order.id for order in self.orders]
+        changes = [(pending, 'C'), (other, 'F'), (third, 'P'), (complete, 'F'),
+                   (failed, 'C'), (pending, 'F'), (10 ** 6, 'C')]
+        # savepoint, read, one UPDATE per status, the completed orders' sales, release
+        with self.assertNumQueries(1 + 1 + 2 + 2 + 1):
+            response = self.client.post('/store/orders/payment-status/', [
+                {'order_id': order_id, 'payment_status': status}
+                for order_id, status in changes], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['updated'], 2)
+        self.assertEqual([result['outcome'] for result in response.data['results']], [
+            'updated', 'updated', 'unchanged', 'invalid_transition', 'invalid_transition',
+            'duplicate', 'not_found'])
+        self.assertEqual(self.statuses(), 'CFPCF')
+        self.assertEqual(DailySales.objects.get().units, 2)
+
+    def test_batches_ids(self):
+        with mock.patch.object(connection.ops, 'bulk_batch_size', return_value=2):
+            outcomes = Order.objects.set_payment_statuses(
+                [(order.id, 'C') for order in self.orders[:3]])
+        self.assertEqual([outcome for _, outcome in outcomes], ['updated'] * 3)
+        self.assertEqual(self.statuses(), 'CCCCF')
+        self.assertEqual(DailySales.objects.get().units, 6)
+
+    def test_validation_and_permissions(self):
+        url = '/store/orders/payment-status/'
+        for data in [[], [{'order_id': 1, 'payment_status': 'X'}], {'order_id': 1}]:
+            self.assertEqual(self.client.post(url, data, format='json').status_code, 400)
+        self.client.force_authenticate(self.customer.user)
+        self.assertEqual(self.client.post(url, [], format='json').status_code, 403)
+
+    def test_command_reads_a_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'statuses.csv')
+            with open(path, 'w') as file:
+                file.write('order_id,payment_status\n%d,F\n%d,C\n%d,C\n' % (
+                    self.orders[0].id, self.orders[1].id, self.orders[4].id))
+            stdout = StringIO()
+            call_command('set_payment_statuses', path, batch_size=2, stdout=stdout)
+            self.assertIn('Updated 2 orders. 1 invalid_transition.', stdout.getvalue())
+            self.assertEqual(self.statuses(), 'FCPCF')
+
+            with open(path, 'a') as file:
+                file.write('%d,Z\n' % self.orders[2].id)
+            with self.assertRaisesMessage(CommandError, 'Row 4: invalid payment_status'):
+                call_command('set_payment_statuses', path, stdout=stdout)
+
+
+class PromotionPricingTests(StoreTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Grocery')
+        cls.milk, cls.bread = Product.objects.bulk_create([
+            Product(title=title, unit_price=Decimal('9.99'), inventory=10, collection=collection)
+            for title in ['Milk', 'Bread']])
+        cls.sale = Promotion.objects.create(description='Sale', discount=0.1)
+        cls.clearance = Promotion.objects.create(description='Clearance', discount=0.25)
+        cls.user = get_user_model().objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret')
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def prices(self):
+        return dict(Product.objects.values_list('title', 'effective_price'))
+
+    def test_best_promotion_wins(self):
+        self.assertEqual(self.prices(), {'Milk': Decimal('9.99'), 'Bread': Decimal('9.99')})
+        self.milk.promotions.add(self.sale, self.clearance)
+        self.assertEqual(self.milk.effective_price, Decimal('7.49'))
+        self.milk.promotions.remove(self.clearance)
+        self.assertEqual(self.prices()['Milk'], Decimal('8.99'))
+        self.milk.promotions.clear()
+        self.assertEqual(self.prices()['Milk'], Decimal('9.99'))
+
+    def test_promotion_changes_reprice_their_products(self):
+        self.sale.product_set.add(self.milk, self.bread)
+        self.assertEqual(self.prices(), {'Milk': Decimal('8.99'), 'Bread': Decimal('8.99')})
+        self.sale.discount = 0.5
+        self.sale.save()
+        self.assertEqual(self.prices(), {'Milk': Decimal('5.00'), 'Bread': Decimal('5.00')})
+        self.sale.product_set.remove(self.bread)
+        self.assertEqual(self.prices()['Bread'], Decimal('9.99'))
+        self.clearance.product_set.add(self.bread)
+        self.clearance.product_set.clear()
+        self.assertEqual(self.prices()['Bread'], Decimal('9.99'))
+        self.sale.delete()
+        self.assertEqual(self.prices()['Milk'], Decimal('9.99'))
+
+    def test_unit_price_changes_reprice(self):
+        self.milk.promotions.add(self.sale)
+        milk = Product.objects.get(pk=self.milk.pk)
+        milk.unit_price = Decimal('20.00')
+        milk.save(update_fields=['unit_price'])
+        self.assertEqual(self.prices()['Milk'], Decimal('18.00'))
+        Product.objects.filter(unit_price__gt=10).update(unit_price=Decimal('4.00'))
+        self.assertEqual(self.prices()['Milk'], Decimal('3.60'))
+
+    def test_saving_a_stale_instance_keeps_the_new_price(self):
+        milk = Product.objects.get(pk=self.milk.pk)
+        self.sale.product_set.add(self.milk)
+        milk.inventory = 5
+        milk.save()
+        self.assertEqual(self.prices()['Milk'], Decimal('8.99'))
+        # Saves that don't write the price leave it alone
+        milk = Product.objects.get(pk=self.milk.pk)
+        self.sale.product_set.remove(self.milk)
+        with CaptureQueriesContext(connection) as queries:
+            milk.save(update_fields=['inventory'])
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'app_product_promotions' in query['sql']])
+        self.assertEqual(self.prices()['Milk'], Decimal('9.99'))
+
+    def test_sql_matches_python_rounding(self):
+        prices = ['0.05', '0.15', '1.25', '9.99', '12.35', '333.33', '9999.99']
+        discounts = [0, 0.05, 0.1, 0.125, 1 / 3, 0.5, 0.9999, 1.5]
+        collection = Collection.objects.create(title='Rounding')
+        promotions = [Promotion.objects.create(description=str(discount), discount=discount)
+                      for discount in discounts]
+        expected = {}
+        for price in prices:
+            for promotion in promotions:
+                product = Product.objects.create(
+                    title='%s %s' % (price, promotion.discount), unit_price=Decimal(price),
+                    inventory=1, collection=collection)
+                product.promotions.add(promotion)
+                expected[product.id] = discounted(Decimal(price), promotion.discount)
+        self.assertEqual(dict(Product.objects.filter(collection=collection)
+                              .values_list('id', 'effective_price')), expected)
+
+    def test_checkout_and_cart_charge_the_effective_price(self):
+        self.milk.promotions.add(self.clearance)
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=self.milk, quantity=2)
+        self.assertEqual(
+            self.client.get('/store/carts/%s/' % cart.cart_id).data['total_price'],
+            Decimal('14.98'))
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/store/orders/', {'cart_uuid': cart.cart_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(OrderItem.objects.get().unit_price, Decimal('7.49'))
+
+    def test_tax_is_added_to_the_effective_price(self):
+        self.milk.promotions.add(self.clearance)
+        TaxRate.objects.create(rate=Decimal('0.2'))
+        response = self.client.get('/store/products/', {'ordering': 'price_with_tax'})
+        self.assertEqual([(product['title'], product['price_with_tax'])
+                          for product in response.data['results']],
+                         [('Milk', 8.99), ('Bread', 11.99)])
+        response = self.client.get('/store/products/%d/' % self.milk.id)
+        self.assertEqual(response.data['price_with_tax'], Decimal('8.99'))
+        self.assertEqual(add_tax(Decimal('7.49'), Decimal('0.2')), Decimal('8.99'))
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=0)
+    def test_list_and_detail_need_no_extra_queries(self):
+        self.milk.promotions.add(self.sale)
+        self.client.get('/store/products/')
+        # ETag aggregate, page count, page rows
+        with self.assertNumQueries(3):
+            response = self.client.get('/store/products/')
+        self.assertEqual([product['effective_price'] for product in response.data['results']],
+                         [9.99, 8.99])
+        # ETag, product
+        with self.assertNumQueries(2):
+            response = self.client.get('/store/products/%d/' % self.milk.id)
+        self.assertEqual(response.data['effective_price'], Decimal('8.99'))
+
+    def test_cached_detail_sees_promotion_changes(self):
+        url = '/store/products/%d/' % self.milk.id
+        self.assertEqual(self.client.get(url).data['effective_price'], Decimal('9.99'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.milk.promotions.add(self.sale)
+        self.assertEqual(self.client.get(url).data['effective_price'], Decimal('8.99'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sale.delete()
+        self.assertEqual(self.client.get(url).data['effective_price'], Decimal('9.99'))
+
+    def test_reprice_products(self):
+        self.milk.promotions.add(self.sale)
+        Promotion.objects.filter(pk=self.sale.pk).update(discount=0.2)
+        stdout = StringIO()
+        call_command('reprice_products', batch_size=1, stdout=stdout)
+        self.assertIn('Repriced 2 products.', stdout.getvalue())
+        self.assertEqual(self.prices()['Milk'], Decimal('7.99'))
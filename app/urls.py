@@ -21,6 +21,9 @@ carts_router.register(
     'items', viewset=views.CartItemViewSet, basename='cart-items')
 
 urlpatterns = [
+    path('stats/', views.StatsView.as_view(), name='stats'),
+    path('reports/sales/', views.SalesSeriesView.as_view(), name='sales-report'),
+    path('reports/top-products/', views.TopProductsView.as_view(), name='top-products-report'),
     path('', include(router.urls)),
     path('', include(products_router.urls)),
     path('', include(carts_router.urls))
@@ -1,7 +1,7 @@
 from django.shortcuts import get_list_or_404, get_object_or_404
-from django.http import HttpResponse
-from django.db.models import Value
-from django.db.models.aggregates import Count
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db import router
+from django.db.models import Prefetch, Sum, Value
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.views import APIView
 from rest_framework.decorators import api_view, action
@@ -9,30 +9,52 @@ from rest_framework.filters import SearchFilter, OrderingFilter
 from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
 from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import AllowAny, IsAuthenticated
-from .models import Product, Collection, Review, Cart, CartItem, Customer, Order
-from .serializers import ProductSerializer, CollectionSerializer, ReviewSerializer, CartSerializer, CartItemSerializer, AddCartItemSerializer, UpdateCartItemSerializer, CustomerSerializer, OrderSerializer, CreateOrderSerializer, UpdateOrderSerializer
+from rest_framework.renderers import BrowsableAPIRenderer
+from .models import Product, Collection, Review, Cart, CartItem, Customer, DailySales, Order, OrderItem
+from .serializers import ProductSerializer, CollectionSerializer, ReviewSerializer, CartSerializer, CartItemSerializer, AddCartItemSerializer, CartItemOperationSerializer, UpdateCartItemSerializer, CustomerSerializer, OrderSerializer, ExpandedOrderSerializer, CreateOrderSerializer, UpdateOrderSerializer, OutOfStockError, OrderExportQuerySerializer, PaymentStatusChangeSerializer, SalesSeriesQuerySerializer, TopProductsQuerySerializer
+from .authentication import ClaimsJWTAuthentication, get_customer_id
+from .caching import CachedResponseMixin, get_cache_stats, reset_cache_stats
+from .conditional import ConditionalGetMixin
+from .exports import CONTENT_TYPES, export_lines
+from .fastlist import ValuesListMixin
 from .filters import ProductFilter
+from .middleware import request_metrics
+from .pagination import KeysetOrPageNumberPagination
+from .search import ProductSearchFilter
+from .taxes import get_region, with_price_with_tax
 from .permissions import IsAdminOrReadOnly, IsAdminUser
+from .renderers import FastJSONRenderer
 import pprint
 from django.http import Http404
+from uuid import UUID
 from drf_yasg.utils import swagger_auto_schema
 # Create your views here.
 
 
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(CachedResponseMixin, ConditionalGetMixin, ValuesListMixin, ModelViewSet):
+    cache_namespace = 'products'
+    cache_object_namespace = 'product'
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, OrderingFilter]
     filterset_class = ProductFilter
+    pagination_class = KeysetOrPageNumberPagination
     permission_classes = [IsAdminOrReadOnly]
     search_fields = ['title', 'description']
-    ordering_fields = ['unit_price', 'last_updated']
+    ordering_fields = ['unit_price', 'price_with_tax', 'last_updated']
 
     def get_queryset(self):
         queryset = Product.objects.select_related('collection').all()
+        # Writes leave price_with_tax to the serializer, so their responses
+        # show the new price. Lists only need it this early to filter or
+        # order by it, an unused annotation still slows down their COUNTs.
+        if self.action == 'retrieve' or self.action == 'list' and self.filters_by_tax():
+            queryset = with_price_with_tax(queryset, get_region(self.request))
         # collection_id = self.request.query_params.get('collection_id')
 
         # if collection_id is not None:
@@ -44,16 +66,27 @@ class ProductViewSet(ModelViewSet):
 
         return queryset
 
+    def filters_by_tax(self):
+        params = self.request.query_params
+        return 'price_with_tax' in params.get(OrderingFilter.ordering_param, '') \
+            or any(name.startswith('price_with_tax') for name in params)
+
+    def get_values_queryset(self, queryset):
+        if 'price_with_tax' not in queryset.query.annotations:
+            queryset = with_price_with_tax(queryset, get_region(self.request))
+        return super().get_values_queryset(queryset)
+
     def get_serializer_context(self):
         # not compulsory but recommended.
         # Especially if your serializer Generates full URLs or depends on request data
         return {'request': self.request}
 
 
-class CollectionViewSet(ModelViewSet):
+class CollectionViewSet(CachedResponseMixin, ConditionalGetMixin, ModelViewSet):
     # ReadOnlyModelViewSet for read only. No create, update or delete.
-    queryset = Collection.objects.annotate(
-        product_count=Count('product'))
+    cache_namespace = 'collections'
+    cache_object_namespace = 'collection'
+    queryset = Collection.objects.all()
     serializer_class = CollectionSerializer
     permission_classes = [IsAdminOrReadOnly]
 
@@ -98,54 +131,46 @@ class CartItemViewSet(ModelViewSet):
             return UpdateCartItemSerializer
         return CartItemSerializer
 
-    def get_serializer_context(self):
-        # return {'cart_id': self.kwargs['cart_cart_id']} #Ordinarily, but since cart_cart_id is a uuid, not id.
-        # Get the UUID from URL
-
-        if not hasattr(self, 'this_cart_id'):
-            self.fetch_cart_id()
-
-        return {'cart_id': self.this_cart_id}
+    def get_cart_uuid(self):
+        try:
+            return UUID(self.kwargs['cart_cart_id'])
+        except ValueError:
+            raise NotFound('No cart with the given id was found.')
 
-    # Simply use UUID as Cart primary key to avoid all these complexity around get_queryset.
-    """
-    Using UUID as Cart primary key:
-    def get_queryset(self):
-        return CartItem.objects.filter(cart__cart_id=self.kwargs['cart_pk'])
-    """
-    # This current implementation is sending more queries to the db and I haven't figured how to solve it with select_/prefetch_related.
+    def get_serializer_context(self):
+        # Only adding an item needs the internal cart id, the other actions
+        # reach the cart through the join in get_queryset.
+        if self.request.method != 'POST':
+            return {}
+        cart_id = Cart.objects.get_pk(self.get_cart_uuid())
+        if cart_id is None:
+            raise NotFound('No cart with the given id was found.')
+        return {'cart_id': cart_id}
 
     def get_queryset(self):
-        # Get the UUID from URL
-        # cart_uuid = self.kwargs['cart_cart_id']
+        # One query: the items joined to their cart (by UUID) and product
+        return CartItem.objects.select_related('product') \
+            .filter(cart__cart_id=self.get_cart_uuid())
 
-        self.fetch_cart_id()
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        # An empty page can't tell an empty cart from an unknown one
+        if not response.data['results'] and Cart.objects.get_pk(self.get_cart_uuid()) is None:
+            raise NotFound('No cart with the given id was found.')
+        return response
 
-        if self.this_cart_id is not None:
-            return CartItem.objects.filter(cart_id=self.this_cart_id)
-        else:
-            return CartItem.objects.none()
-
-        # Convert to internal Cart ID
-        # try:
-        #     cart = Cart.objects.get(cart_id=cart_uuid)
-        #     self.this_cart_id = cart.id
-        #     # Now filter by the internal ID (much simpler!)
-        #     return CartItem.objects.filter(cart_id=cart.id)
-        # except Cart.DoesNotExist:
-        #     return CartItem.objects.none()
-
-    def fetch_cart_id(self):
-        # Get the UUID from URL
-        cart_uuid = self.kwargs['cart_cart_id']
-
-        # Convert to internal Cart ID
-        try:
-            cart = Cart.objects.get(cart_id=cart_uuid)
-            self.this_cart_id = cart.id
-        except Cart.DoesNotExist:
-            # 404 error
-            self.this_cart_id = None
+    @swagger_auto_schema(
+        request_body=CartItemOperationSerializer(many=True),
+        responses={200: CartItemSerializer(many=True)}
+    )
+    @action(detail=False, methods=['POST'])
+    def bulk(self, request, *args, **kwargs):
+        # Applies a list of add/set/remove operations in one transaction
+        serializer = CartItemOperationSerializer(
+            data=request.data, many=True, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        items = serializer.save()
+        return Response(CartItemSerializer(items, many=True).data)
 
 
 class CustomerViewSet(ModelViewSet):
@@ -153,10 +178,11 @@ class CustomerViewSet(ModelViewSet):
     serializer_class = CustomerSerializer
     permission_classes = [IsAdminUser]
 
+    authentication_classes = [ClaimsJWTAuthentication]
+
     @action(detail=False, methods=['GET', 'PUT'], permission_classes=[IsAuthenticated])
     def me(self, request):
-        customer = Customer.objects.get(
-            user_id=request.user.id)
+        customer = Customer.objects.get(pk=get_customer_id(request.user))
         if request.method == 'GET':
             serializer = CustomerSerializer(customer)
             return Response(serializer.data)
@@ -170,43 +196,152 @@ class CustomerViewSet(ModelViewSet):
 class OrderViewSet(ModelViewSet):
     queryset = Order.objects.all()
     # serializer_class = OrderSerializer
+    pagination_class = KeysetOrPageNumberPagination
+    authentication_classes = [ClaimsJWTAuthentication]
 
     http_method_names = ['get', 'post', 'patch', 'delete', 'head', 'options']
 
     def get_permissions(self):
-        if self.request.method in ['PATCH', 'DELETE']:
+        if self.request.method in ['PATCH', 'DELETE'] \
+                or self.action in ('export', 'set_payment_status'):
             return [IsAdminUser()]
         return [IsAuthenticated()]
 
     def create(self, request, *args, **kwargs):
         serializer = CreateOrderSerializer(
             data=request.data,
-            context={'customer_id': self.request.user.id}
+            context={'customer_id': get_customer_id(self.request.user)}
         )
         serializer.is_valid(raise_exception=True)
-        order = serializer.save()
+        try:
+            order = serializer.save()
+        except OutOfStockError as error:
+            return Response({'out_of_stock': error.lines}, status=status.HTTP_400_BAD_REQUEST)
         serializer = OrderSerializer(order)
         return Response(serializer.data)
 
+    def expand_product(self):
+        return self.request.query_params.get('expand') == 'product'
+
     def get_serializer_class(self):
         if self.request.method == 'POST':
             return CreateOrderSerializer
         elif self.request.method == 'PATCH':
             return UpdateOrderSerializer
+        elif self.expand_product():
+            return ExpandedOrderSerializer
         return OrderSerializer
 
     def get_queryset(self):
+        queryset = Order.objects.all()
+        if self.action in ('list', 'retrieve'):
+            # Items (and their products when expanded) are prefetched, so a
+            # page costs the same number of queries whatever its size.
+            items = OrderItem.objects.all()
+            if self.expand_product():
+                items = items.select_related('product')
+            queryset = queryset.prefetch_related(Prefetch('orderitem_set', queryset=items))
+
         user = self.request.user
         if user.is_staff:
-            return Order.objects.all()
-        customer_id = Customer.objects.only('id').get(user_id=user.id)
-        return Order.objects.filter(customer_id=customer_id)
-
-    # def get_serializer_context(self):
-    #     return {'customer_id': self.request.user.id}
+            return queryset
+        return queryset.filter(customer_id=get_customer_id(user))
 
     # Not complete yet. Get queryset depending on is_staff or user
 
+    @action(detail=False)
+    def export(self, request):
+        # Every matching order with its items, streamed, see app/exports.py
+        serializer = OrderExportQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        options = dict(serializer.validated_data)
+        file_format = options.pop('output')
+        # Picked now, the rows are read after the view has returned
+        lines = export_lines(file_format, using=router.db_for_read(Order), **options)
+        response = StreamingHttpResponse(lines, content_type=CONTENT_TYPES[file_format])
+        response['Content-Disposition'] = 'attachment; filename="orders.%s"' % file_format
+        return response
+
+    @action(detail=False, methods=['POST'], url_path='payment-status')
+    def set_payment_status(self, request):
+        # Applies a list of {order_id, payment_status} changes in one
+        # transaction and reports the outcome for each
+        serializer = PaymentStatusChangeSerializer(
+            data=request.data, many=True, allow_empty=False,
+            max_length=PaymentStatusChangeSerializer.max_batch)
+        serializer.is_valid(raise_exception=True)
+        outcomes = Order.objects.set_payment_statuses(
+            [(change['order_id'], change['payment_status']) for change in serializer.validated_data])
+        return Response({
+            'updated': sum(outcome == 'updated' for _, outcome in outcomes),
+            'results': [
+                {'order_id': order_id, 'payment_status': change['payment_status'], 'outcome': outcome}
+                for (order_id, outcome), change in zip(outcomes, serializer.validated_data)],
+        })
+
+
+class StatsView(APIView):
+    # Metrics of the process that serves the request, see app/middleware.py
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            'window_minutes': request_metrics.get_window(),
+            'routes': request_metrics.snapshot(),
+            'cache': get_cache_stats(),
+        })
+
+    def delete(self, request):
+        request_metrics.reset()
+        reset_cache_stats()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class SalesReportView(APIView):
+    # Answered from the DailySales rollup, so the cost follows the number of
+    # days and products in the range rather than the order history.
+    permission_classes = [IsAdminUser]
+    query_serializer_class = None
+
+    def get_sales(self, request):
+        serializer = self.query_serializer_class(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        sales = DailySales.objects.filter(day__range=(params['since'], params['until']))
+        for field in ('collection_id', 'product_id'):
+            if field in params:
+                sales = sales.filter(**{field: params[field]})
+        return params, sales.order_by()
+
+
+class SalesSeriesView(SalesReportView):
+    # Units and revenue per day, or per day and collection
+    query_serializer_class = SalesSeriesQuerySerializer
+
+    def get(self, request):
+        params, sales = self.get_sales(request)
+        fields = ['day'] if params['group_by'] == 'day' else ['day', 'collection_id']
+        rows = sales.values(*fields) \
+            .annotate(units=Sum('units'), revenue=Sum('revenue')).order_by(*fields)
+        return Response({'since': params['since'], 'until': params['until'],
+                         'results': list(rows)})
+
+
+class TopProductsView(SalesReportView):
+    # Best selling products of the range, by revenue or units
+    query_serializer_class = TopProductsQuerySerializer
+
+    def get(self, request):
+        params, sales = self.get_sales(request)
+        rows = list(sales.values('product_id')
+                    .annotate(units=Sum('units'), revenue=Sum('revenue'))
+                    .order_by('-' + params['by'], 'product_id')[:params['limit']])
+        titles = dict(Product.objects.filter(
+            pk__in=[row['product_id'] for row in rows]).values_list('id', 'title'))
+        return Response({'since': params['since'], 'until': params['until'], 'results': [
+            {'product': row['product_id'], 'title': titles.get(row['product_id']),
+             'units': row['units'], 'revenue': row['revenue']} for row in rows]})
+
 
 class UserAPIView(APIView):
 
@@ -280,8 +415,7 @@ class ProductDetail_before_mixins(APIView):
 @api_view(['GET', 'POST'])
 def collection_list(request):
     if request.method == 'GET':
-        queryset = Collection.objects.annotate(
-            product_count=Count('product'))
+        queryset = Collection.objects.all()
         collections = get_list_or_404(queryset)
         serializer = CollectionSerializer(collections, many=True)
         return Response(serializer.data)
@@ -294,9 +428,7 @@ def collection_list(request):
 
 @api_view(['GET', 'PUT', 'DELETE'])
 def collection_detail(request, id):
-    queryset = Collection.objects.annotate(
-        product_count=Count('product'))
-    collection = get_object_or_404(queryset, pk=id)
+    collection = get_object_or_404(Collection, pk=id)
     if request.method == 'GET':
         serializer = CollectionSerializer(collection)
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -306,7 +438,7 @@ def collection_detail(request, id):
         serializer.save()
         return Response(serializer.data)
     elif request.method == 'DELETE':
-        if collection.product_set.count() > 0:
+        if collection.product_set.exists():
             return Response({"error": "Cannot delete Collection because it contains some products"}, status=status.HTTP_400_BAD_REQUEST)
         else:
             collection.delete()
@@ -2,6 +2,11 @@
 ASGI config for storefront project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+With ASYNC_READ_VIEWS set, requests are resolved against
+storefront.asgi_urls, which serves the read-only catalog endpoints with
+async views. Otherwise they use ROOT_URLCONF, as under WSGI.
+
+Streaming responses are read in the sync thread, see send_response().
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -9,8 +14,53 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'storefront.settings.dev')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+
+class StorefrontASGIHandler(ASGIHandler):
+    urlconf = 'storefront.asgi_urls'
+    # Bytes of a streaming response read per trip to the sync thread
+    stream_block_size = 64 * 1024
+
+    async def get_response_async(self, request):
+        if settings.ASYNC_READ_VIEWS:
+            request.urlconf = self.urlconf
+        return await super().get_response_async(request)
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        # Django 4.1 iterates streaming content in the event loop, where
+        # content that reads the database, like the order export, raises
+        # SynchronousOnlyOperation. Read it in the sync thread instead, a
+        # block at a time.
+        headers = [(header.encode('ascii'), value.encode('latin1'))
+                   for header, value in response.items()]
+        headers += [(b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+                    for cookie in response.cookies.values()]
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': headers})
+        parts = iter(response)
+        read_block = sync_to_async(self.read_block, thread_sensitive=True)
+        while block := await read_block(parts):
+            await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+        await send({'type': 'http.response.body'})
+
+    def read_block(self, parts):
+        block, size = [], 0
+        for part in parts:
+            block.append(part)
+            size += len(part)
+            if size >= self.stream_block_size:
+                break
+        return b''.join(block)
+
+
+application = StorefrontASGIHandler()
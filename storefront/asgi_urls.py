@@ -0,0 +1,21 @@
+"""
+URL configuration used under ASGI when ASYNC_READ_VIEWS is set (see
+storefront/asgi.py).
+
+The read-only catalog and cart endpoints are served by the async views in
+app.async_views. Everything else, and every request those views don't
+handle, goes through the same sync views as under WSGI.
+"""
+from django.urls import include, path, re_path
+from app import async_views
+
+urlpatterns = [
+    # Named like the router's routes, which they shadow
+    path('store/products/', async_views.product_list, name='product-list'),
+    re_path(r'^store/products/(?P<pk>[^/.]+)/$', async_views.product_detail,
+            name='product-detail'),
+    path('store/collections/', async_views.collection_list, name='collection-list'),
+    re_path(r'^store/carts/(?P<cart_id>[^/.]+)/$', async_views.cart_detail,
+            name='cart-detail'),
+    path('', include('storefront.urls')),
+]
@@ -0,0 +1,88 @@
+"""
+Read replica routing.
+
+DATABASE_REPLICAS lists the aliases in DATABASES that are read-only
+replicas of `default`. ReplicaRouter sends reads of the catalog, reviews,
+order history and sales reports to a random replica. Everything else goes
+to the primary. A read only goes to a replica when all of these hold:
+
+  - it is made while serving a GET, HEAD or OPTIONS request, which
+    ReplicaMiddleware marks. Management commands, shells and writes never
+    read from a replica.
+  - the client hasn't made a write request in the last
+    REPLICA_STICKY_SECONDS. Writes set a short-lived cookie, so a client
+    reads its own writes while the replicas catch up.
+  - no transaction is open on the primary. Reads inside atomic() blocks,
+    such as the checkout in CreateOrderSerializer, see the rows they lock
+    and write.
+
+Writes always go to the primary, including saves of objects that were
+read from a replica.
+
+A cached catalog response (app/caching.py) can be built from a replica
+that hasn't caught up with the write that invalidated the cache. It then
+stays stale for at most CATALOG_CACHE_TIMEOUT.
+"""
+import random
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Set by ReplicaMiddleware for the requests whose reads may use a replica
+_reading_replicas = ContextVar('reading_replicas', default=False)
+
+STICKY_COOKIE = 'primary_db'
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+class ReplicaRouter:
+    # label_lower of the models whose reads may be served by a replica
+    replica_models = {
+        'app.collection', 'app.product', 'app.product_promotions', 'app.promotion',
+        'app.productsearchterm', 'app.taxrate', 'app.review',
+        'app.order', 'app.orderitem', 'app.dailysales',
+    }
+
+    def db_for_read(self, model, **hints):
+        replicas = get_replicas()
+        if not replicas or not _reading_replicas.get() \
+                or model._meta.label_lower not in self.replica_models \
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        return obj1._state.db in databases and obj2._state.db in databases or None
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Replicas get the schema by replication
+        return db not in get_replicas()
+
+
+class ReplicaMiddleware:
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        safe = request.method in self.safe_methods
+        token = _reading_replicas.set(
+            safe and bool(get_replicas()) and STICKY_COOKIE not in request.COOKIES)
+        try:
+            response = self.get_response(request)
+        finally:
+            _reading_replicas.reset(token)
+        if not safe and get_replicas():
+            response.set_cookie(
+                STICKY_COOKIE, '1', max_age=getattr(settings, 'REPLICA_STICKY_SECONDS', 5),
+                httponly=True, samesite='Lax')
+        return response
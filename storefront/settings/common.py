@@ -37,6 +37,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.middleware.RequestMetricsMiddleware',
+    'storefront.dbrouters.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -126,10 +128,48 @@ REST_FRAMEWORK = {
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=1),
     'AUTH_HEADER_TYPES': ('JWT',),
+    # Adds the customer_id and is_staff claims read by ClaimsJWTAuthentication
+    'TOKEN_OBTAIN_SERIALIZER': 'app.authentication.ClaimsTokenObtainPairSerializer',
 }
 
 AUTH_USER_MODEL = 'core.User'
 
+# Per process, fine for a single dev server. prod.py requires Redis.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Read replicas (storefront/dbrouters.py): aliases in DATABASES that serve
+# catalog and order history reads, and how long a client that wrote keeps
+# reading from the primary
+DATABASE_ROUTERS = ['storefront.dbrouters.ReplicaRouter']
+DATABASE_REPLICAS = []
+REPLICA_STICKY_SECONDS = 5
+
+# Seconds a cached catalog response is kept, 0 disables the cache (app/caching.py)
+CATALOG_CACHE_TIMEOUT = 300
+
+# Serve anonymous catalog reads with the async views in app/async_views.py
+# under ASGI. Off, as they are slower than the sync views on Django 4.1.
+ASYNC_READ_VIEWS = False
+
+# Applies where no TaxRate row does (app/taxes.py)
+DEFAULT_TAX_RATE = '0.10'
+
+# How often each process checks the database for tax rate changes it
+# wasn't told about through the cache (app/taxes.py)
+TAX_RATES_CHECK_SECONDS = 5
+
+# Per-route request metrics (app/middleware.py), served to staff by
+# /store/stats/ over the last REQUEST_METRICS_WINDOW minutes
+REQUEST_METRICS_WINDOW = 15
+SERVER_TIMING_HEADER = True
+
+# Serves ?search= on /store/products/. Set to None to use DRF's SearchFilter.
+PRODUCT_SEARCH_BACKEND = 'app.search.InvertedIndexBackend'
+
 DJOSER = {
     'SERIALIZERS': {
         'user_create': 'core.serializers.UserCreateSerializer',
@@ -33,3 +33,20 @@ DATABASES = {
         },
     }
 }
+
+if os.environ.get('SQLITE_REPLICA'):
+    # Two SQLite files, to try the replica routing locally. Nothing
+    # replicates between them: copy db.sqlite3 over db-replica.sqlite3 to
+    # bring the replica up to date. Tests mirror the replica onto default.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        },
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db-replica.sqlite3',
+            'TEST': {'MIRROR': 'default'},
+        },
+    }
+    DATABASE_REPLICAS = ['replica']
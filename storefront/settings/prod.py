@@ -1,4 +1,5 @@
 import os
+from django.core.exceptions import ImproperlyConfigured
 from .common import *
 import dj_database_url
 
@@ -17,3 +18,25 @@ DATABASES = {
         },
     }
 }
+
+# Comma separated URLs of read replicas of the default database
+DATABASE_REPLICAS = []
+for number, url in enumerate(filter(None, os.environ.get('REPLICA_DATABASE_URLS', '').split(',')), 1):
+    DATABASES['replica%d' % number] = {
+        **dj_database_url.parse(url),
+        'OPTIONS': DATABASES['default']['OPTIONS'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append('replica%d' % number)
+
+# The catalog cache, cart ids and tax rates are invalidated through the
+# cache, so every worker has to share it. LocMem is per process.
+if 'REDIS_URL' not in os.environ:
+    raise ImproperlyConfigured('Set REDIS_URL, production needs a shared cache.')
+CACHES = {
+    'default': {
+        # Needs the redis package
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
+    }
+}